@@ -54,5 +54,7 @@ setup(
                    'Intended Audience :: Developers',
                    'Operating System :: OS Independent',
                    'Programming Language :: Python',
+                   'Programming Language :: Python :: 2.6',
+                   'Programming Language :: Python :: 2.7',
                    'Topic :: Utilities'],
 )
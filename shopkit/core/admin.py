@@ -13,6 +13,20 @@ class PricedItemAdminMixin(object):
     get_price.short_description = _('price')
 
 
+class OrderAdminMixin(PricedItemAdminMixin):
+    """
+    Admin mixin for orders, computing the totals of all orders in the
+    changelist with a single query.
+    """
+    def queryset(self, request):
+        qs = super(OrderAdminMixin, self).queryset(request)
+
+        if hasattr(qs, 'with_totals'):
+            qs = qs.with_totals()
+
+        return qs
+
+
 class OrderStateChangeInline(admin.TabularInline):
     model = get_model_from_string(ORDERSTATE_CHANGE_MODEL)
 
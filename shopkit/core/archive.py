@@ -0,0 +1,235 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Archival of old confirmed orders.
+
+Orders are exported along with their items and state changes, using
+:mod:`shopkit.core.export`, to compressed JSON Lines files in
+`SHOPKIT_ORDER_ARCHIVE_PATH`, after which they are removed from the
+database. For every archived order, an object of
+`SHOPKIT_ARCHIVED_ORDER_MODEL` is kept with a summary of the order and its
+location in the archive, so customers can still look up their order
+history through
+:meth:`get_all_orders(include_archived=True) <shopkit.core.basemodels.AbstractCustomerBase.get_all_orders>`.
+
+Only the orders, their items, state changes and processed state change
+events are archived. Orders to which other objects are related, such as
+payments, would lose those objects when removed and are skipped instead;
+they are reported by :func:`archive_orders`.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import datetime
+import gzip
+import os
+
+from itertools import islice
+
+from django.db import models
+
+from shopkit.core.export import iter_orders, write_jsonl
+from shopkit.core.utils import get_model_from_string, \
+                               transaction_or_savepoint, bulk_create
+from shopkit.core.settings import ORDER_MODEL, ORDERITEM_MODEL, \
+                                  ORDERSTATE_CHANGE_MODEL, \
+                                  ORDERSTATE_EVENT_MODEL, \
+                                  ARCHIVED_ORDER_MODEL, ORDER_ARCHIVE_PATH
+
+
+def get_archivable(before):
+    """ Return confirmed orders added before `before`. """
+    order_class = get_model_from_string(ORDER_MODEL)
+
+    return order_class.objects.filter(confirmed=True, date_added__lt=before)
+
+
+def get_unarchivable(pks):
+    """
+    Return a dictionary mapping the primary keys of those orders in `pks`
+    which cannot be archived to the names of the models whose objects
+    would be removed along with them, without being archived.
+
+    Objects referring to an order, or to one of its items or state changes,
+    are considered, except for processed state change events. Relations
+    which are not deleted in cascade are ignored.
+    """
+    order_class = get_model_from_string(ORDER_MODEL)
+    orderitem_class = get_model_from_string(ORDERITEM_MODEL)
+    orderstate_change_class = get_model_from_string(ORDERSTATE_CHANGE_MODEL)
+
+    if ORDERSTATE_EVENT_MODEL:
+        event_class = get_model_from_string(ORDERSTATE_EVENT_MODEL)
+    else:
+        event_class = None
+
+    archived_models = (order_class, orderitem_class, orderstate_change_class)
+
+    # Archived models along with the lookup of their order
+    checks = ((order_class, 'pk'),
+              (orderitem_class, 'order'),
+              (orderstate_change_class, 'order'))
+
+    unarchivable = {}
+    for (model_class, order_lookup) in checks:
+        for related in model_class._meta.get_all_related_objects():
+            if related.model in archived_models:
+                continue
+
+            on_delete = getattr(related.field.rel, 'on_delete',
+                                models.CASCADE)
+            if on_delete is not models.CASCADE:
+                continue
+
+            lookup = '%s__%s' % (related.field.name, order_lookup)
+            related_objects = related.model._base_manager.filter(
+                **{'%s__in' % lookup: pks}
+            )
+
+            if related.model is event_class:
+                related_objects = \
+                    related_objects.filter(processed__isnull=True)
+
+            model_name = related.model._meta.object_name
+            for pk in related_objects.values_list(lookup, flat=True):
+                unarchivable.setdefault(pk, set()).add(model_name)
+
+    return unarchivable
+
+
+def write_archive(orders, filename):
+    """
+    Write `orders` to the compressed file `filename` in
+    `SHOPKIT_ORDER_ARCHIVE_PATH`. The file is written under a temporary name
+    first, so that only complete archives exist.
+    """
+    path = os.path.join(ORDER_ARCHIVE_PATH, filename)
+
+    stream = gzip.open(path + '.tmp', 'wb')
+    try:
+        write_jsonl(orders, stream)
+    finally:
+        stream.close()
+
+    os.rename(path + '.tmp', path)
+
+
+def archive_batch(orders):
+    """
+    Archive a list of orders, as yielded by
+    :func:`iter_orders <shopkit.core.export.iter_orders>`, and remove them
+    from the database. The archive file is written before the orders are
+    removed, in a single transaction.
+
+    Orders returned by :func:`get_unarchivable` are left in place.
+
+    :returns: a list with the primary keys of the skipped orders
+    """
+    order_class = get_model_from_string(ORDER_MODEL)
+    orderitem_class = get_model_from_string(ORDERITEM_MODEL)
+    orderstate_change_class = get_model_from_string(ORDERSTATE_CHANGE_MODEL)
+    archived_order_class = get_model_from_string(ARCHIVED_ORDER_MODEL)
+
+    pk_name = order_class._meta.pk.attname
+    unarchivable = get_unarchivable([order[pk_name] for order in orders])
+
+    for (pk, model_names) in sorted(unarchivable.items()):
+        logger.error(u'Not archiving order %d, as the following related '
+                     u'objects would be lost: %s',
+                     pk, u', '.join(sorted(model_names)))
+
+    orders = [order for order in orders if order[pk_name] not in unarchivable]
+    if not orders:
+        return sorted(unarchivable)
+
+    pks = [order[pk_name] for order in orders]
+
+    filename = 'orders-%d-%d.jsonl.gz' % (pks[0], pks[-1])
+    write_archive(orders, filename)
+
+    archived_orders = []
+    for (line, order) in enumerate(orders):
+        archived_orders.append(archived_order_class(
+            order_pk=order[pk_name],
+            customer_pk=order.get('customer_id'),
+            state=order['state'],
+            date_added=order['date_added'],
+            total_items=order['total_items'],
+            total_price=order['total_price'],
+            archive=filename,
+            line=line
+        ))
+
+    with transaction_or_savepoint():
+        bulk_create(archived_order_class, archived_orders)
+
+        orderstate_change_class.objects.filter(order__in=pks).delete()
+        orderitem_class.objects.filter(order__in=pks).delete()
+
+        # Only processed events remain, which are removed along with the
+        # orders
+        order_class.objects.filter(pk__in=pks).delete()
+
+    logger.debug(u'Archived %d orders to %s', len(pks), filename)
+
+    return sorted(unarchivable)
+
+
+def archive_orders(before, batch_size=1000):
+    """
+    Archive all confirmed orders added before `before`, in batches of
+    `batch_size` orders, each of which is written to its own file.
+
+    Orders which cannot be archived, see :func:`get_unarchivable`, are
+    skipped and logged as errors.
+
+    :returns: a tuple with the amount of orders archived and a list with the
+              primary keys of the skipped orders
+    """
+    assert ARCHIVED_ORDER_MODEL, \
+        'Please configure SHOPKIT_ARCHIVED_ORDER_MODEL.'
+    assert ORDER_ARCHIVE_PATH, \
+        'Please configure SHOPKIT_ORDER_ARCHIVE_PATH.'
+
+    queryset = get_archivable(before).with_totals()
+
+    order_class = get_model_from_string(ORDER_MODEL)
+    pk_name = order_class._meta.pk.attname
+
+    archived = 0
+    skipped = []
+    last_pk = None
+    while True:
+        # Archived orders are removed and skipped ones are left behind, so
+        # every batch starts after the last order of the previous one
+        orders = list(islice(iter_orders(queryset, after=last_pk,
+                                         chunk_size=batch_size),
+                             batch_size))
+        if not orders:
+            break
+
+        last_pk = orders[-1][pk_name]
+
+        batch_skipped = archive_batch(orders)
+
+        archived += len(orders) - len(batch_skipped)
+        skipped.extend(batch_skipped)
+
+    return (archived, skipped)
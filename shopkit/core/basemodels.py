@@ -22,10 +22,15 @@ logger = logging.getLogger(__name__)
 import datetime
 
 from django.utils.translation import ugettext_lazy as _
-from django.db import models
+from django.db import models, DEFAULT_DB_ALIAS
 
-from shopkit.core.settings import MAX_NAME_LENGTH
+from shopkit.core.settings import MAX_NAME_LENGTH, NUMBER_SEQUENCE_MODEL, \
+                                  ORDER_NUMBER_BLOCK_SIZE, ARCHIVED_ORDER_MODEL
 from shopkit.core.managers import ActiveItemManager
+from shopkit.core.utils import get_model_from_string, increment_or_create, \
+                               supports_upsert, upsert_increment, \
+                               transaction_or_savepoint
+from shopkit.core.utils.numbering import get_allocator
 
 """
 Generic abstract base classes for:
@@ -42,9 +47,25 @@ class AbstractCustomerBase(models.Model):
         verbose_name_plural = _('customers')
         abstract = True
 
-    def get_all_orders(self):
-        """ Get all orders by the customer """
-        return self.order_set.all()
+    def get_all_orders(self, include_archived=False):
+        """
+        Get all orders by the customer. With `include_archived`, orders moved
+        to the archive are included as well, as archived order objects. In
+        that case a list ordered by date, most recent first, is returned
+        rather than a `QuerySet`.
+        """
+        orders = self.order_set.all()
+
+        if not include_archived or not ARCHIVED_ORDER_MODEL:
+            return orders
+
+        archived_order_class = get_model_from_string(ARCHIVED_ORDER_MODEL)
+        archived = archived_order_class.objects.filter(customer_pk=self.pk)
+
+        orders = list(orders) + list(archived)
+        orders.sort(key=lambda order: order.date_added, reverse=True)
+
+        return orders
 
     def get_confirmed_orders(self):
         """
@@ -354,3 +375,108 @@ class NumberedOrderBase(models.Model):
         self.save()
 
 
+class NumberSequenceBase(models.Model):
+    """
+    Base class for named sequences of numbers, used for allocating order
+    and invoice numbers.
+    """
+
+    class Meta:
+        verbose_name = _('number sequence')
+        verbose_name_plural = _('number sequences')
+        abstract = True
+
+    name = models.SlugField(_('name'), max_length=255, unique=True)
+    value = models.PositiveIntegerField(_('value'), default=0)
+    """ The last number allocated from this sequence. """
+
+    @classmethod
+    def next_value(cls, name, count=1, using=DEFAULT_DB_ALIAS):
+        """
+        Raise the sequence called `name` by `count`, creating it when it
+        does not exist yet, and return the new value. The query is run on
+        the database connection `using`.
+
+        The value is raised and read back atomically: with a single
+        `INSERT ... ON CONFLICT ... RETURNING` query where supported, or by
+        an `UPDATE` followed by reading the locked row within the same
+        transaction otherwise. When no transaction is being managed, one is
+        started for this. Within a managed transaction, the sequence stays
+        locked until that transaction ends, so the numbers allocated are
+        gap-free: when the transaction is rolled back, so is the allocation.
+        """
+        if supports_upsert(using):
+            sequence = cls(name=name)
+            upsert_increment(sequence, ('name', ), {'value': count}, using)
+
+            return sequence.value
+
+        with transaction_or_savepoint(using):
+            increment_or_create(cls, {'name': name}, {'value': count},
+                                using=using)
+
+            sequences = cls.objects.using(using).filter(name=name)
+
+            # Only available from Django 1.4 on; the row is locked by the
+            # update in this transaction regardless
+            if hasattr(sequences, 'select_for_update'):
+                sequences = sequences.select_for_update()
+
+            return sequences.values_list('value', flat=True)[0]
+
+    def __unicode__(self):
+        return self.name
+
+
+class SequenceNumberedOrderBase(NumberedOrderBase):
+    """
+    Base class for `Order` with invoice and order numbers allocated from
+    the number sequences in `SHOPKIT_NUMBER_SEQUENCE_MODEL`.
+
+    Invoice numbers are gap-free, as required by law in many countries,
+    when the order is confirmed within a transaction, as
+    `process_confirm()` does. Order numbers are allocated in blocks of
+    `SHOPKIT_ORDER_NUMBER_BLOCK_SIZE` by every process, which means they
+    are unique but not gap-free.
+    """
+
+    class Meta:
+        abstract = True
+
+    order_number_sequence = 'order'
+    """ Name of the sequence used for order numbers. """
+
+    order_number_format = u'%(number)d'
+    """ Format for order numbers. """
+
+    invoice_number_sequence = 'invoice'
+    """ Name of the sequence used for invoice numbers. """
+
+    invoice_number_format = u'%(number)d'
+    """ Format for invoice numbers. """
+
+    @staticmethod
+    def get_number_sequence_class():
+        """ Return the model used for number sequences. """
+        assert NUMBER_SEQUENCE_MODEL, \
+            'Please configure SHOPKIT_NUMBER_SEQUENCE_MODEL.'
+
+        return get_model_from_string(NUMBER_SEQUENCE_MODEL)
+
+    def generate_invoice_number(self):
+        """ Allocate the next number from the invoice number sequence. """
+        sequence_class = self.get_number_sequence_class()
+
+        number = sequence_class.next_value(self.invoice_number_sequence)
+
+        return self.invoice_number_format % {'number': number}
+
+    def generate_order_number(self):
+        """ Allocate an order number from the block of this process. """
+        sequence_class = self.get_number_sequence_class()
+
+        allocator = get_allocator(self.order_number_sequence,
+                                  ORDER_NUMBER_BLOCK_SIZE)
+        number = allocator.allocate(sequence_class)
+
+        return self.order_number_format % {'number': number}
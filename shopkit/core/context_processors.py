@@ -16,20 +16,30 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
-from shopkit.core.utils import get_model_from_string
-from shopkit.core.settings import CART_MODEL
+from django.utils.functional import SimpleLazyObject
+
+from shopkit.core.utils import get_cart_from_request
+from shopkit.core.snapshots import get_cart_summary
+
 
 def cart(request):
     """
     Request context processor adding the shopping cart to the current
     context as `cart`.
 
-    .. todo::
-        Make this lazy object: we should only perform the actual
-        database query when this object is requested from within
-        template.
-
+    The cart is a lazy object: the actual database query is only performed
+    when it is used from within a template. It is the same instance as
+    the one used by views, as both get it through
+    :func:`get_cart_from_request <shopkit.core.utils.get_cart_from_request>`.
     """
-    cart_class = get_model_from_string(CART_MODEL)
-    return {'cart': cart_class.from_request(request)}
+    return {'cart': SimpleLazyObject(lambda: get_cart_from_request(request))}
 
+
+def cart_summary(request):
+    """
+    Request context processor adding a summary of the shopping cart to the
+    current context as `cart_summary`, for read-only displays such as a
+    mini-cart. When `SHOPKIT_CART_SNAPSHOT` is enabled and the snapshot in
+    the session is valid, this requires no database queries at all.
+    """
+    return {'cart_summary': get_cart_summary(request)}
@@ -0,0 +1,173 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Streaming export of orders along with their items and state changes, for
+example for accounting systems.
+
+Orders are fetched in chunks ordered by primary key, without instantiating
+models. The items and state changes for each chunk are fetched with a
+single query each, so that memory use does not depend on the amount of
+orders exported. As every exported order carries its primary key, an export
+can be resumed by passing the last exported primary key as `after`.
+
+Usage::
+
+    from shopkit.core.export import iter_orders, write_jsonl
+
+    with open('orders.jsonl', 'w') as stream:
+        write_jsonl(iter_orders(after=last_pk), stream)
+
+"""
+
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.encoding import smart_str
+
+from shopkit.core.utils import get_model_from_string
+from shopkit.core.settings import ORDER_MODEL, ORDERITEM_MODEL, \
+                                  ORDERSTATE_CHANGE_MODEL
+
+
+def get_field_names(model_class):
+    """ Return the names of the columns of `model_class`, as in `values()`. """
+    return [field.attname for field in model_class._meta.fields]
+
+
+def group_by_order(queryset, order_pks):
+    """
+    Return a dictionary with lists of values for the objects in
+    `queryset` belonging to the orders with primary keys `order_pks`.
+    """
+    grouped = dict((pk, []) for pk in order_pks)
+
+    values = queryset.filter(order__in=order_pks).order_by('order', 'pk')
+    for row in values.values().iterator():
+        grouped[row['order_id']].append(row)
+
+    return grouped
+
+
+def iter_orders(queryset=None, after=None, chunk_size=1000):
+    """
+    Generator yielding a dictionary with the values of every order in
+    `queryset`, ordered by primary key. The items and state changes of
+    each order are included as lists of dictionaries under `items` and
+    `state_changes`.
+
+    :param queryset: orders to export, defaults to all orders
+    :param after: only export orders with a primary key greater than this
+    :param chunk_size: amount of orders fetched at a time
+    """
+    order_class = get_model_from_string(ORDER_MODEL)
+    orderitem_class = get_model_from_string(ORDERITEM_MODEL)
+    orderstate_change_class = get_model_from_string(ORDERSTATE_CHANGE_MODEL)
+
+    if queryset is None:
+        queryset = order_class.objects.all()
+
+    queryset = queryset.order_by('pk')
+    pk_name = order_class._meta.pk.attname
+
+    last_pk = after
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+
+        orders = list(chunk.values()[:chunk_size])
+        if not orders:
+            break
+
+        order_pks = [order[pk_name] for order in orders]
+        last_pk = order_pks[-1]
+
+        items = group_by_order(orderitem_class.objects.all(), order_pks)
+        state_changes = group_by_order(orderstate_change_class.objects.all(),
+                                       order_pks)
+
+        for order in orders:
+            order['items'] = items[order[pk_name]]
+            order['state_changes'] = state_changes[order[pk_name]]
+
+            yield order
+
+
+def write_jsonl(orders, stream):
+    """
+    Write `orders`, as yielded by :func:`iter_orders`, to `stream` as JSON
+    Lines: one JSON document per order.
+
+    :returns: the primary key of the last order written
+    """
+    pk_name = get_model_from_string(ORDER_MODEL)._meta.pk.attname
+    last_pk = None
+
+    for order in orders:
+        stream.write(json.dumps(order, cls=DjangoJSONEncoder))
+        stream.write('\n')
+
+        last_pk = order[pk_name]
+
+    return last_pk
+
+
+def write_csv(orders, stream):
+    """
+    Write `orders`, as yielded by :func:`iter_orders`, to `stream` as CSV,
+    with a row for every order item. The columns of the order are prefixed
+    with `order_` and repeated for every item, those of the item with
+    `item_`. The state changes of the order are included as a JSON list in
+    the `order_state_changes` column.
+
+    :returns: the primary key of the last order written
+    """
+    order_class = get_model_from_string(ORDER_MODEL)
+
+    order_fields = get_field_names(order_class)
+    item_fields = get_field_names(get_model_from_string(ORDERITEM_MODEL))
+
+    writer = csv.writer(stream)
+    writer.writerow(['order_%s' % name for name in order_fields] + \
+                    ['order_state_changes'] + \
+                    ['item_%s' % name for name in item_fields])
+
+    def encode(value):
+        if value is None:
+            return ''
+
+        return smart_str(value)
+
+    pk_name = order_class._meta.pk.attname
+    last_pk = None
+
+    for order in orders:
+        order_row = [encode(order[name]) for name in order_fields]
+        order_row.append(json.dumps(order['state_changes'],
+                                    cls=DjangoJSONEncoder))
+
+        # Orders without items still get a row
+        for item in order['items'] or [{}]:
+            writer.writerow(order_row + \
+                            [encode(item.get(name)) for name in item_fields])
+
+        last_pk = order[pk_name]
+
+    return last_pk
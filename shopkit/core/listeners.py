@@ -19,15 +19,125 @@
 import logging
 logger = logging.getLogger(__name__)
 
+import threading
+
 from django.core.exceptions import ImproperlyConfigured
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 
-from django.template.loader import render_to_string
+from django.conf import settings
+from django.template import Context
+from django.template.loader import select_template
 from django.contrib.sites.models import Site
 
 from django.utils import translation
 
+from shopkit.core.utils import get_model_from_string
 from shopkit.core.utils.listeners import Listener
+from shopkit.core.settings import EMAIL_BATCH_SIZE, CUSTOMER_MODEL
+from shopkit.core.signals import order_state_change
+
+
+class EmailBatch(object):
+    """
+    Collects the messages of emailing listeners and sends them in batches
+    over a single connection, rather than opening a connection for every
+    message. While a batch is active, all messages created by
+    :class:`EmailingListener` in the current thread are added to it.
+
+    Example::
+
+        with EmailBatch(batch_size=200):
+            for order in orders:
+                order.state = order_states.ORDER_STATE_SHIPPED
+                order.save()
+
+    Messages are sent whenever `batch_size` messages have been collected,
+    unless it is `None`, and when leaving the batch. When leaving the batch because of an exception,
+    the remaining messages are discarded unless `flush_on_error` is set.
+    """
+
+    _local = threading.local()
+
+    def __init__(self, batch_size=EMAIL_BATCH_SIZE, flush_on_error=False,
+                 fail_silently=False, connection=None):
+        self.batch_size = batch_size
+        self.flush_on_error = flush_on_error
+        self.fail_silently = fail_silently
+        self.connection = connection
+
+        self.messages = []
+        self.previous = None
+
+    @classmethod
+    def get_active(cls):
+        """ Return the active batch for this thread, if any. """
+        return getattr(cls._local, 'batch', None)
+
+    def get_connection(self):
+        """ Return the open connection used for sending the messages. """
+        if not self.connection:
+            self.connection = get_connection(fail_silently=self.fail_silently)
+
+            self.connection.open()
+
+        return self.connection
+
+    def add(self, message):
+        """
+        Add a message, sending the batch when it is full, unless
+        `batch_size` is `None`.
+        """
+        self.messages.append(message)
+
+        if self.batch_size and len(self.messages) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Send the collected messages. Returns the amount sent. When sending
+        fails, the messages are kept in the batch and the exception is
+        re-raised.
+        """
+        if not self.messages:
+            return 0
+
+        messages = self.messages
+        self.messages = []
+
+        logger.debug(u'Sending batch of %d messages', len(messages))
+
+        try:
+            return self.get_connection().send_messages(messages) or 0
+        except:
+            # Messages added in the meantime go after the failed ones
+            self.messages = messages + self.messages
+            raise
+
+    def close(self):
+        """ Close the connection, if it has been opened. """
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def __enter__(self):
+        self.previous = self.get_active()
+        self._local.batch = self
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._local.batch = self.previous
+
+        try:
+            if exc_type is None or self.flush_on_error:
+                self.flush()
+            else:
+                logger.warning(u'Discarding %d messages because of %s',
+                               len(self.messages), exc_type.__name__)
+
+                self.messages = []
+        finally:
+            self.close()
 
 
 class StateChangeListener(Listener):
@@ -53,8 +163,10 @@ class StateChangeListener(Listener):
         should be handled at all (whether or not it matches the specified)
         state change) and then calls the `handle()` method.
         """
-        # Match the new state, if given
-        if self.new_state and not self.new_state == sender.state:
+        # Match the new state, if given. As signals might be sent by the
+        # `processorderevents` command, the order might have changed state
+        # again in the meantime: use the state from the signal.
+        if self.new_state and not self.new_state == kwargs['new_state']:
             logger.debug(u'Signal for %s doesn\'t match listener for %s', sender, self)
             return
 
@@ -82,19 +194,159 @@ class StateChangeLogger(StateChangeListener):
     def handler(self, sender, **kwargs):
         """ Handle the signal by writing out a debug log message. """
         old_state = kwargs['old_state']
-        new_state = sender.state
+        new_state = kwargs['new_state']
 
         logger.debug(u'State change signal: from %s to %s for %s',
                      old_state, new_state, sender)
 
 
+class CustomerStatsListener(StateChangeListener):
+    """
+    Listener recalculating the statistics of the customer of an order upon
+    every state change, for customers using
+    :class:`CustomerStatsMixin <shopkit.core.models.CustomerStatsMixin>`.
+    As the statistics are recalculated rather than adjusted, handling a
+    state change more than once does no harm.
+
+    Shops confirming orders without changing their state should call
+    `update_customer_stats()` on the customer after confirmation.
+    """
+
+    def handler(self, sender, **kwargs):
+        """ Recalculate the statistics for the customer of the order. """
+        customer_pk = getattr(sender, 'customer_id', None)
+
+        if customer_pk is None:
+            return
+
+        customer_class = get_model_from_string(CUSTOMER_MODEL)
+        customer_class.update_stats(
+            customer_class.objects.filter(pk=customer_pk))
+
+
+class StateChangeRegistry(object):
+    """
+    Dispatch table for :class:`StateChangeListener` subclasses, indexed by
+    their `old_state` and `new_state`. Rather than connecting every
+    listener to `order_state_change` and having each of them check the
+    state change, the registry is connected once and only instantiates
+    and calls the listeners matching the state change.
+
+    As in :meth:`StateChangeListener.dispatch`, listeners without (or with
+    a false) `old_state` or `new_state` match any state.
+
+    Example::
+
+        state_change_registry.register(OrderPaidListener)
+        state_change_registry.register(OrderShippedListener, foo='bar')
+    """
+
+    def __init__(self, signal=order_state_change):
+        self.signal = signal
+
+        self._listeners = {}
+        self._count = 0
+
+    def register(self, listener_class, **initkwargs):
+        """
+        Register `listener_class`, to be instantiated with `initkwargs` for
+        matching state changes. The registry is connected to its signal
+        upon the first registration.
+        """
+        key = (listener_class.old_state or None,
+               listener_class.new_state or None)
+
+        # Keep track of the order of registration
+        self._count += 1
+        self._listeners.setdefault(key, []).append(
+            (self._count, listener_class, initkwargs))
+
+        self.signal.connect(self.dispatch, weak=False,
+                            dispatch_uid='shopkit.core.listeners.%d' % id(self))
+
+    def get_listeners(self, old_state, new_state):
+        """
+        Return the listener classes and init arguments matching a state
+        change, in the order in which they were registered.
+        """
+        keys = set([(old_state, new_state), (None, new_state),
+                    (old_state, None), (None, None)])
+
+        listeners = []
+        for key in keys:
+            listeners.extend(self._listeners.get(key, ()))
+
+        listeners.sort()
+
+        return [(listener_class, initkwargs) \
+                for (count, listener_class, initkwargs) in listeners]
+
+    def dispatch(self, sender, **kwargs):
+        """
+        Call the handlers of the listeners matching the state change. All
+        handlers are called, even when one of them fails; the first
+        exception raised is re-raised afterwards.
+        """
+        listeners = self.get_listeners(kwargs['old_state'],
+                                       kwargs['new_state'])
+
+        error = None
+        for (listener_class, initkwargs) in listeners:
+            try:
+                listener_class(**initkwargs).handler(sender, **kwargs)
+            except Exception as e:
+                logger.exception(u'Listener %s failed for %s',
+                                 listener_class.__name__, sender)
+
+                if error is None:
+                    error = e
+
+        if error is not None:
+            raise error
+
+
+state_change_registry = StateChangeRegistry()
+""" Default registry for listeners of `order_state_change`. """
+
+
 class EmailingListener(Listener):
-    """ Listener which sends out emails. """
+    """
+    Listener which sends out emails.
+
+    Compiled templates are cached by template names and active language,
+    so sending many messages only costs rendering them. The cache is
+    bypassed when `DEBUG` is enabled, so changes to templates show up
+    right away.
+    """
 
     body_template_name = None
     body_html_template_name = None
     subject_template_name = None
 
+    _template_cache = {}
+
+    def get_template(self, template_names):
+        """
+        Return the first existing template in `template_names`, compiling
+        it only when it has not been used before for the active language.
+        """
+        if settings.DEBUG:
+            return select_template(template_names)
+
+        key = (tuple(template_names), translation.get_language())
+
+        template = self._template_cache.get(key)
+        if template is None:
+            template = select_template(template_names)
+
+            self._template_cache[key] = template
+
+        return template
+
+    def render_template(self, template_names, context):
+        """ Render the first existing template in `template_names`. """
+        return self.get_template(template_names).render(Context(context))
+
     def get_subject_template_names(self):
         """
         Returns a list of template names to be used for the request. Must
@@ -134,6 +386,9 @@ class EmailingListener(Listener):
         """
         Context for the message template rendered. Defaults to sender, the
         current site object and kwargs.
+
+        The current site is cached by Django, so no query is performed
+        for every message.
         """
 
         current_site = Site.objects.get_current()
@@ -161,17 +416,18 @@ class EmailingListener(Listener):
         recipients = self.get_recipients()
         sender = self.get_sender()
 
-        subject = render_to_string(self.get_subject_template_names(), context)
+        subject = self.render_template(self.get_subject_template_names(),
+                                       context)
         # Clean the subject a bit for common errors (newlines!)
         subject = subject.strip().replace('\n', ' ')
 
-        body = render_to_string(self.get_body_template_names(), context)
+        body = self.render_template(self.get_body_template_names(), context)
 
         email = EmailMultiAlternatives(subject, body, sender, recipients)
 
         html_body_template_names = self.get_body_html_template_names()
         if html_body_template_names:
-            html_body = render_to_string(html_body_template_names, context)
+            html_body = self.render_template(html_body_template_names, context)
             email.attach_alternative(html_body, 'text/html')
 
         return email
@@ -186,7 +442,19 @@ class EmailingListener(Listener):
 
         message = self.create_message(context)
 
-        message.send()
+        self.send_message(message)
+
+    def send_message(self, message):
+        """
+        Send the message, or add it to the active :class:`EmailBatch`,
+        if any.
+        """
+        batch = EmailBatch.get_active()
+
+        if batch:
+            batch.add(message)
+        else:
+            message.send()
 
 
 class TranslatedEmailingListener(EmailingListener):
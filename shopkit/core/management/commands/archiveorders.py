@@ -0,0 +1,82 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import datetime
+import time
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from shopkit.core.archive import archive_orders, get_archivable
+from shopkit.core.settings import ARCHIVED_ORDER_MODEL, ORDER_ARCHIVE_PATH, \
+                                  ORDER_ARCHIVE_DAYS
+
+
+class Command(NoArgsCommand):
+    """
+    Move confirmed orders older than a given amount of days, along with their
+    items and state changes, to the archive. See :mod:`shopkit.core.archive`.
+    """
+
+    help = 'Archive confirmed orders older than a given amount of days.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', action='store', type='int',
+                    dest='days', default=ORDER_ARCHIVE_DAYS,
+                    help='Age in days after which orders are archived, '
+                         'defaults to %d.' % ORDER_ARCHIVE_DAYS),
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=1000,
+                    help='Amount of orders to archive per file.'),
+        make_option('--dry-run', action='store_true',
+                    dest='dry_run', default=False,
+                    help='Only count the orders to be archived.'),
+    )
+
+    def handle_noargs(self, **options):
+        if not ARCHIVED_ORDER_MODEL or not ORDER_ARCHIVE_PATH:
+            raise CommandError('Please configure both '
+                               'SHOPKIT_ARCHIVED_ORDER_MODEL and '
+                               'SHOPKIT_ORDER_ARCHIVE_PATH.')
+
+        before = datetime.datetime.now() - \
+            datetime.timedelta(days=options['days'])
+
+        verbosity = int(options['verbosity'])
+
+        if options['dry_run']:
+            if verbosity > 0:
+                self.stdout.write('Would archive %d orders.\n' % \
+                                  get_archivable(before).count())
+            return
+
+        started = time.time()
+
+        (archived, skipped) = archive_orders(before,
+                                             batch_size=options['batch_size'])
+
+        if verbosity > 0:
+            self.stdout.write('Archived %d orders in %.1fs.\n' % \
+                              (archived, time.time() - started))
+
+        if skipped:
+            raise CommandError('Skipped %d orders with related objects '
+                               'which would not be archived: %s' % \
+                               (len(skipped),
+                                ', '.join(str(pk) for pk in skipped)))
@@ -0,0 +1,80 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from shopkit.core.export import iter_orders, write_csv, write_jsonl
+
+
+class Command(NoArgsCommand):
+    """
+    Export orders, with their items and state changes, as CSV or JSON Lines
+    using :mod:`shopkit.core.export`.
+
+    The primary key of the last exported order is reported when done, so
+    that a next export can continue from there using `--after`.
+    """
+
+    help = 'Export orders with their items and state changes.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--format', action='store', type='choice',
+                    choices=('jsonl', 'csv'), dest='format', default='jsonl',
+                    help='Output format: jsonl (default) or csv.'),
+        make_option('--after', action='store', type='int',
+                    dest='after', default=None,
+                    help='Only export orders with a primary key greater '
+                         'than this.'),
+        make_option('--output', action='store',
+                    dest='output', default=None,
+                    help='File to write to, defaults to standard output.'),
+        make_option('--chunk-size', action='store', type='int',
+                    dest='chunk_size', default=1000,
+                    help='Amount of orders to fetch at a time.'),
+    )
+
+    def handle_noargs(self, **options):
+        writers = {'jsonl': write_jsonl,
+                   'csv': write_csv}
+        writer = writers[options['format']]
+
+        if options['chunk_size'] < 1:
+            raise CommandError('The chunk size should be at least 1.')
+
+        orders = iter_orders(after=options['after'],
+                             chunk_size=options['chunk_size'])
+
+        if options['output']:
+            stream = open(options['output'], 'w')
+        else:
+            stream = self.stdout
+
+        try:
+            last_pk = writer(orders, stream)
+        finally:
+            if options['output']:
+                stream.close()
+
+        if int(options['verbosity']) > 0:
+            if last_pk is None:
+                self.stderr.write('No orders exported.\n')
+            else:
+                self.stderr.write('Exported orders up to and including '
+                                 'primary key %d.\n' % last_pk)
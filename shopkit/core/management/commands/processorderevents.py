@@ -0,0 +1,192 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import logging
+logger = logging.getLogger(__name__)
+
+import time
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from shopkit.core.listeners import EmailBatch
+from shopkit.core.utils import get_model_from_string
+from shopkit.core.settings import ORDERSTATE_EVENT_MODEL, \
+                                  ORDERSTATE_EVENT_MAX_ATTEMPTS
+
+
+class Command(NoArgsCommand):
+    """
+    Process the outbox of order state changes configured in
+    `SHOPKIT_ORDERSTATE_EVENT_MODEL`, sending the `order_state_change` signal
+    for every pending event.
+
+    Events are claimed before processing them, so several workers can run
+    at the same time. Events for which a listener raised an exception are
+    retried on a next run, until they have been attempted `--max-attempts`
+    times.
+
+    With `--batch-emails`, messages of emailing listeners are sent over a
+    single connection for every batch of events. Events are only marked
+    processed once their messages have been sent; when sending fails, the
+    whole batch of events is retried on a next run.
+    """
+
+    help = 'Send the order_state_change signal for stored state change events.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=100,
+                    help='Amount of events to fetch at a time.'),
+        make_option('--max-attempts', action='store', type='int',
+                    dest='max_attempts', default=ORDERSTATE_EVENT_MAX_ATTEMPTS,
+                    help='Amount of attempts after which events are given '
+                         'up on, defaults to %d.' % \
+                         ORDERSTATE_EVENT_MAX_ATTEMPTS),
+        make_option('--loop', action='store_true',
+                    dest='loop', default=False,
+                    help='Keep waiting for new events.'),
+        make_option('--batch-emails', action='store_true',
+                    dest='batch_emails', default=False,
+                    help='Send emails in batches over a single connection.'),
+        make_option('--sleep', action='store', type='float',
+                    dest='sleep', default=5,
+                    help='Seconds to wait for new events when looping.'),
+    )
+
+    def handle_noargs(self, **options):
+        if not ORDERSTATE_EVENT_MODEL:
+            raise CommandError('Please configure '
+                               'SHOPKIT_ORDERSTATE_EVENT_MODEL.')
+
+        orderstate_event_class = get_model_from_string(ORDERSTATE_EVENT_MODEL)
+
+        verbosity = int(options['verbosity'])
+
+        while True:
+            processed, failed = self.process_events(
+                orderstate_event_class,
+                options['batch_size'], options['max_attempts'],
+                options['batch_emails'])
+
+            if verbosity > 0 and (processed or failed or not options['loop']):
+                self.stdout.write('Processed %d events, %d failed.\n' % \
+                                  (processed, failed))
+
+            if not options['loop']:
+                break
+
+            if not (processed or failed):
+                time.sleep(options['sleep'])
+
+    def process_events(self, orderstate_event_class, batch_size, max_attempts,
+                       batch_emails=False):
+        """
+        Process pending events in batches ordered by primary key. Returns
+        the amount of events processed and failed.
+        """
+        processed = 0
+        failed = 0
+        last_pk = None
+
+        while True:
+            events = orderstate_event_class.get_pending(max_attempts)
+            if last_pk is not None:
+                events = events.filter(pk__gt=last_pk)
+
+            events = list(events.select_related('order', 'state_change')\
+                                [:batch_size])
+            if not events:
+                break
+
+            last_pk = events[-1].pk
+
+            if batch_emails:
+                batch_processed, batch_failed = \
+                    self.process_batch_emails(events)
+            else:
+                batch_processed, batch_failed = self.process_batch(events)
+
+            processed += batch_processed
+            failed += batch_failed
+
+        return processed, failed
+
+    def process_batch(self, events):
+        """
+        Claim and process `events`, marking them processed right away.
+        Returns the amount of events processed and failed.
+        """
+        processed = 0
+        failed = 0
+
+        for event in events:
+            # Skip events claimed by another worker
+            if not event.claim():
+                continue
+
+            if event.process():
+                processed += 1
+            else:
+                failed += 1
+
+        return processed, failed
+
+    def process_batch_emails(self, events):
+        """
+        Claim and process `events`, collecting the messages of emailing
+        listeners in a single :class:`EmailBatch`, which is sent at once
+        after processing the events. Events are only marked processed after
+        all of their messages have been sent. When sending
+        fails, the error is stored on the events so they are retried, which
+        might send some of their messages twice but never loses any. Returns
+        the amount of events processed and failed.
+        """
+        succeeded = []
+        failed = 0
+
+        with EmailBatch(batch_size=None) as email_batch:
+            for event in events:
+                # Skip events claimed by another worker
+                if not event.claim():
+                    continue
+
+                if event.process(mark_processed=False):
+                    succeeded.append(event)
+                else:
+                    failed += 1
+
+            try:
+                email_batch.flush()
+            except Exception as e:
+                logger.exception(u'Sending emails for %d events failed',
+                                 len(succeeded))
+
+                for event in succeeded:
+                    event.mark_failed(e)
+
+                # Don't retry sending when leaving the batch
+                email_batch.messages = []
+
+                return 0, failed + len(succeeded)
+
+        for event in succeeded:
+            event.mark_processed()
+
+        return len(succeeded), failed
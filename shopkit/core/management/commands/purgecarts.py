@@ -0,0 +1,129 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import datetime
+import time
+
+from optparse import make_option
+
+from django.core.exceptions import FieldError
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import transaction
+
+from shopkit.core.utils import get_model_from_string
+from shopkit.core.settings import CART_MODEL, CARTITEM_MODEL, \
+                                  CART_ACTIVITY_FIELD, CART_PURGE_DAYS
+
+
+class Command(NoArgsCommand):
+    """
+    Delete abandoned shopping carts, as returned by `get_abandoned()` on
+    the `Cart` model, along with their items.
+
+    Carts are processed in batches ordered by primary key, each of which is
+    deleted in its own transaction, so that neither all carts have to be
+    loaded into memory nor tables are locked for a long time. Carts are
+    checked to still be abandoned right before deletion, as items may have
+    been added to them since their batch was selected.
+    """
+
+    help = 'Delete shopping carts without orders which have been inactive ' \
+           'for a given amount of days.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', action='store', type='int',
+                    dest='days', default=CART_PURGE_DAYS,
+                    help='Amount of days without activity after which carts '
+                         'are deleted, defaults to %d.' % CART_PURGE_DAYS),
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=1000,
+                    help='Amount of carts to delete at a time.'),
+        make_option('--sleep', action='store', type='float',
+                    dest='sleep', default=0,
+                    help='Seconds to wait between batches.'),
+        make_option('--dry-run', action='store_true',
+                    dest='dry_run', default=False,
+                    help='Only count the carts and items to be deleted.'),
+    )
+
+    def handle_noargs(self, **options):
+        cart_class = get_model_from_string(CART_MODEL)
+        cartitem_class = get_model_from_string(CARTITEM_MODEL)
+
+        verbosity = int(options['verbosity'])
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+
+        before = datetime.datetime.now() - \
+            datetime.timedelta(days=options['days'])
+
+        try:
+            abandoned = cart_class.get_abandoned(before)
+            abandoned.exists()
+        except FieldError:
+            raise CommandError('%s has no field %s, please configure '
+                               'SHOPKIT_CART_ACTIVITY_FIELD.' % \
+                               (CART_MODEL, CART_ACTIVITY_FIELD))
+
+        started = time.time()
+
+        carts = 0
+        items = 0
+        last_pk = None
+        while True:
+            batch = abandoned.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+
+            pks = list(batch.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+
+            last_pk = pks[-1]
+
+            if dry_run:
+                items += cartitem_class.objects.filter(cart__in=pks).count()
+            else:
+                with transaction.commit_on_success():
+                    # Carts may have become active again in the meantime
+                    pks = list(abandoned.filter(pk__in=pks).values_list(
+                        'pk', flat=True))
+
+                    cartitems = cartitem_class.objects.filter(cart__in=pks)
+                    items += cartitems.count()
+
+                    cartitems.delete()
+                    cart_class.objects.filter(pk__in=pks).delete()
+
+            carts += len(pks)
+
+            if verbosity > 1:
+                self.stdout.write('%d carts processed, %.1f carts/s\n' % \
+                    (carts, carts / max(time.time() - started, 0.001)))
+
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        if verbosity > 0:
+            elapsed = time.time() - started
+
+            self.stdout.write('%s %d carts and %d items in %.1fs '
+                              '(%.1f carts/s).\n' % \
+                              (dry_run and 'Would delete' or 'Deleted',
+                               carts, items, elapsed,
+                               carts / max(elapsed, 0.001)))
@@ -0,0 +1,52 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from shopkit.core.utils import get_model_from_string
+from shopkit.core.settings import CART_MODEL
+from shopkit.core.models import SummarizedCartMixin
+
+
+class Command(NoArgsCommand):
+    """
+    Recalculate the persistent summaries of shopping carts using a
+    :class:`SummarizedCartMixin <shopkit.core.models.SummarizedCartMixin>`.
+    """
+
+    help = 'Recalculate the total items and total price of shopping carts.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=500,
+                    help='Amount of carts to process at a time.'),
+    )
+
+    def handle_noargs(self, **options):
+        cart_class = get_model_from_string(CART_MODEL)
+
+        if not issubclass(cart_class, SummarizedCartMixin):
+            raise CommandError('%s does not keep a summary, please use '
+                               'SummarizedCartMixin.' % CART_MODEL)
+
+        updated = cart_class.update_summaries(batch_size=options['batch_size'])
+
+        if int(options['verbosity']) > 0:
+            self.stdout.write('Updated summaries for %d carts.\n' % updated)
@@ -0,0 +1,56 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from shopkit.core.utils import get_model_from_string
+from shopkit.core.settings import CUSTOMER_MODEL
+from shopkit.core.models import CustomerStatsMixin
+
+
+class Command(NoArgsCommand):
+    """
+    Recalculate the order statistics of customers using a
+    :class:`CustomerStatsMixin <shopkit.core.models.CustomerStatsMixin>`.
+    """
+
+    help = 'Recalculate the order statistics of all customers.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=500,
+                    help='Amount of customers to process at a time.'),
+    )
+
+    def handle_noargs(self, **options):
+        if not CUSTOMER_MODEL:
+            raise CommandError('Please configure SHOPKIT_CUSTOMER_MODEL.')
+
+        customer_class = get_model_from_string(CUSTOMER_MODEL)
+
+        if not issubclass(customer_class, CustomerStatsMixin):
+            raise CommandError('%s does not keep statistics, please use '
+                               'CustomerStatsMixin.' % CUSTOMER_MODEL)
+
+        updated = customer_class.update_stats(batch_size=options['batch_size'])
+
+        if int(options['verbosity']) > 0:
+            self.stdout.write('Updated statistics for %d customers.\n' % \
+                              updated)
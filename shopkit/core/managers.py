@@ -16,7 +16,10 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
-from django.db import models
+from django.db import models, connection
+
+from shopkit.core.settings import ORDERITEM_MODEL
+from shopkit.core.utils import get_model_from_string
 
 class ActiveItemManager(models.Manager):
     """ 
@@ -34,3 +37,51 @@ class ActiveItemManager(models.Manager):
         return qs
 
 
+class OrderQuerySet(models.query.QuerySet):
+    """ QuerySet for orders. """
+
+    def with_totals(self):
+        """
+        Annotate the orders with `total_items` and `total_price`, the sum
+        of the quantities and of `quantity * piece_price` of their items,
+        computed by the database. `OrderBase.get_total_items()` and
+        `get_total_price()` use these annotations when present, so listing
+        orders with their totals takes a single query.
+        """
+        orderitem_class = get_model_from_string(ORDERITEM_MODEL)
+
+        qn = connection.ops.quote_name
+
+        item_opts = orderitem_class._meta
+        opts = self.model._meta
+
+        subquery = 'SELECT COALESCE(SUM(%%s), 0) FROM %(items)s ' \
+                   'WHERE %(items)s.%(order)s = %(orders)s.%(pk)s ' \
+                   'AND %(items)s.%(quantity)s > 0' % {
+            'items': qn(item_opts.db_table),
+            'order': qn(item_opts.get_field('order').column),
+            'orders': qn(opts.db_table),
+            'pk': qn(opts.pk.column),
+            'quantity': qn(item_opts.get_field('quantity').column)
+        }
+
+        quantity = '%s.%s' % (qn(item_opts.db_table),
+                              qn(item_opts.get_field('quantity').column))
+        piece_price = '%s.%s' % (qn(item_opts.db_table),
+                                 qn(item_opts.get_field('piece_price').column))
+
+        return self.extra(select={
+            'total_items': subquery % quantity,
+            'total_price': subquery % ('%s * %s' % (quantity, piece_price))
+        })
+
+
+class OrderManager(models.Manager):
+    """ Manager for orders, returning an :class:`OrderQuerySet`. """
+
+    def get_query_set(self):
+        return OrderQuerySet(self.model, using=self._db)
+
+    def with_totals(self):
+        """ See :meth:`OrderQuerySet.with_totals`. """
+        return self.get_query_set().with_totals()
@@ -20,24 +20,42 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+import copy
+import datetime
+import gzip
+import json
+import os
+
 from decimal import Decimal
 
+import django
 from django.contrib.auth.models import User
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models.fields import FieldDoesNotExist
 from django.utils.translation import ugettext_lazy as _
-from django.db import models
+from django.db import models, transaction, IntegrityError
 
 from shopkit.core.settings import PRODUCT_MODEL, CART_MODEL, \
                                   CARTITEM_MODEL, ORDER_MODEL, \
                                   ORDERITEM_MODEL, CUSTOMER_MODEL, \
                                   ORDERSTATE_CHANGE_MODEL, ORDER_STATES, \
-                                  DEFAULT_ORDER_STATE
+                                  DEFAULT_ORDER_STATE, CART_ACTIVITY_FIELD, \
+                                  ORDERSTATE_EVENT_MODEL, \
+                                  ORDERSTATE_EVENT_MAX_ATTEMPTS, \
+                                  ORDERSTATE_EVENT_CLAIM_TIMEOUT, \
+                                  ORDER_ARCHIVE_PATH, ARCHIVED_ORDER_MODEL
 from shopkit.core import signals
 from shopkit.core.basemodels import AbstractPricedItemBase, DatedItemBase, \
                                     QuantizedItemBase, AbstractCustomerBase
+from shopkit.core.managers import OrderManager
 
-from shopkit.core.utils import get_model_from_string
+from shopkit.core.utils import get_model_from_string, supports_upsert, \
+                               upsert_increment, increment_or_create, \
+                               transaction_or_savepoint, bulk_create
+from shopkit.core.utils.updates import DeferredIncrements
+from shopkit.core.snapshots import CartSnapshot, cart_changed, \
+                                   snapshots_enabled
 
 from shopkit.core.exceptions import AlreadyConfirmedException
 
@@ -62,6 +80,164 @@ class UserCustomerBase(AbstractCustomerBase, User):
         abstract = True
 
 
+class CustomerStatsMixin(models.Model):
+    """
+    Mixin class for customers keeping statistics on their orders, so that
+    these do not have to be calculated from the orders on every request.
+    The `Order` model is expected to have a `customer` foreign key.
+
+    The statistics are recalculated for the customer of an order whenever
+    its state changes by
+    :class:`CustomerStatsListener <shopkit.core.listeners.CustomerStatsListener>`,
+    and for all customers by the `updatecustomerstats` management command.
+    Orders archived in `SHOPKIT_ARCHIVED_ORDER_MODEL`, if configured, are
+    included as confirmed orders.
+    """
+
+    class Meta:
+        abstract = True
+
+    order_count = models.PositiveIntegerField(_('confirmed orders'),
+                                              default=0, editable=False)
+    """ Amount of confirmed orders. """
+
+    lifetime_value = PriceField(verbose_name=_('lifetime value'),
+                                default=Decimal('0.00'), editable=False)
+    """ Total price of all confirmed orders. """
+
+    first_order_date = models.DateTimeField(_('first order'), null=True,
+                                            blank=True, editable=False)
+    """ Date of the first order, confirmed or not. """
+
+    last_order_date = models.DateTimeField(_('last confirmed order'),
+                                           null=True, blank=True,
+                                           editable=False)
+    """ Date of the last confirmed order. """
+
+    stats_fields = ('order_count', 'lifetime_value',
+                    'first_order_date', 'last_order_date')
+
+    @classmethod
+    def update_stats(cls, queryset=None, batch_size=500):
+        """
+        Recalculate the statistics for all customers in `queryset`, or all
+        customers when it is not given, `batch_size` customers at a time.
+        For every batch, the orders are aggregated at once and only
+        customers for which the statistics changed are updated.
+
+        :returns: the amount of customers updated
+        """
+
+        if queryset is None:
+            queryset = cls.objects.all()
+
+        order_class = get_model_from_string(ORDER_MODEL)
+
+        updated = 0
+        last_pk = None
+        while True:
+            batch = queryset.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+
+            current = list(batch.values('pk', *cls.stats_fields)[:batch_size])
+            if not current:
+                break
+
+            last_pk = current[-1]['pk']
+
+            stats = dict((row['pk'], {'order_count': 0,
+                                      'lifetime_value': Decimal('0.00'),
+                                      'first_order_date': None,
+                                      'last_order_date': None}) \
+                         for row in current)
+
+            # Clear the default ordering, which would end up in GROUP BY
+            orders = order_class.objects.filter(
+                customer__in=stats.keys()).order_by()
+            confirmed = orders.filter(confirmed=True)
+
+            for row in orders.values('customer').annotate(
+                    first=models.Min('date_added')):
+                stats[row['customer']]['first_order_date'] = row['first']
+
+            for row in confirmed.values('customer').annotate(
+                    count=models.Count('pk'), last=models.Max('date_added')):
+                stats[row['customer']]['order_count'] = row['count']
+                stats[row['customer']]['last_order_date'] = row['last']
+
+            for (pk, total_price) in confirmed.with_totals().values_list(
+                    'customer', 'total_price'):
+                # Some databases return floats for sums of decimals
+                if not isinstance(total_price, Decimal):
+                    total_price = Decimal(str(total_price))
+
+                stats[pk]['lifetime_value'] += total_price
+
+            if ARCHIVED_ORDER_MODEL:
+                cls._add_archived_stats(stats)
+
+            for row in current:
+                pk = row.pop('pk')
+
+                if row != stats[pk]:
+                    cls.objects.filter(pk=pk).update(**stats[pk])
+                    updated += 1
+
+        logger.debug(u'Updated statistics for %d customers', updated)
+
+        return updated
+
+    @staticmethod
+    def _add_archived_stats(stats):
+        """
+        Add the orders in `SHOPKIT_ARCHIVED_ORDER_MODEL`, all of which have
+        been confirmed, to `stats`, a dictionary mapping customer pks to
+        their statistics.
+        """
+        archived_order_class = get_model_from_string(ARCHIVED_ORDER_MODEL)
+
+        archived = archived_order_class.objects.filter(
+            customer_pk__in=stats.keys()).order_by()
+
+        for row in archived.values('customer_pk').annotate(
+                count=models.Count('pk'), total=models.Sum('total_price'),
+                first=models.Min('date_added'),
+                last=models.Max('date_added')):
+            customer_stats = stats[row['customer_pk']]
+
+            # Some databases return floats for sums of decimals
+            total = row['total']
+            if not isinstance(total, Decimal):
+                total = Decimal(str(total))
+
+            customer_stats['order_count'] += row['count']
+            customer_stats['lifetime_value'] += total
+
+            # Archived orders are older than the ones left, but not all
+            # customers need to have orders left
+            dates = [date for date in (customer_stats['first_order_date'],
+                                       row['first']) if date]
+            customer_stats['first_order_date'] = min(dates)
+
+            dates = [date for date in (customer_stats['last_order_date'],
+                                       row['last']) if date]
+            customer_stats['last_order_date'] = max(dates)
+
+    def update_customer_stats(self):
+        """ Recalculate the statistics for this customer. """
+
+        assert self.pk, 'Cannot update the statistics of an unsaved customer.'
+
+        self.update_stats(self.__class__.objects.filter(pk=self.pk))
+
+        stats = self.__class__.objects.filter(pk=self.pk).values(
+            *self.stats_fields)[0]
+
+        for (field, value) in stats.iteritems():
+            setattr(self, field, value)
+
+
 class ProductBase(AbstractPricedItemBase):
     """ Abstract base class for products in the webshop. """
 
@@ -114,10 +290,70 @@ class CartItemBase(AbstractPricedItemBase, QuantizedItemBase):
 
         return price
 
+    @classmethod
+    def get_piece_prices(cls, cartitems, **kwargs):
+        """
+        Gets the prices per piece for a sequence of cart items at once,
+        returning them as a list in the same order as `cartitems`.
+
+        By default every product is asked for its price separately. Price
+        extensions which are able to resolve the prices for many products
+        in one go should override this.
+        """
+
+        return [cartitem.product.get_price(quantity=cartitem.quantity,
+                                           **kwargs)
+                for cartitem in cartitems]
+
     def get_piece_price(self, **kwargs):
-        """ Gets the price per piece for a given quantity of items. """
+        """
+        Gets the price per piece for a given quantity of items. When the
+        price has already been determined by the pricing pass of the cart,
+        :meth:`CartBase.get_item_prices`, that value is used instead.
+        """
+
+        cached = getattr(self, '_piece_price', None)
+
+        if cached and cached[0] == kwargs and cached[1] == self.quantity:
+            return cached[2]
+
+        return self.get_piece_prices([self], **kwargs)[0]
+
+    def _register_change(self, cart_id):
+        """
+        Register a change of the items of the cart with pk `cart_id`,
+        marking the cart as active and bumping its snapshot version.
+        """
+
+        cart_class = self._meta.get_field('cart').rel.to
+        cart_class.touch(cart_id)
+
+        cart_changed(cart_id)
+
+    def save(self, *args, **kwargs):
+        """ Save the item, registering the change to the cart. """
+
+        super(CartItemBase, self).save(*args, **kwargs)
+
+        self._register_change(self.cart_id)
+
+    def quantity_added(self, quantity):
+        """
+        Called when the quantity of this item has been raised by `quantity`
+        directly in the database, bypassing `save()`, as `add_item()` on the
+        cart does. By default, this registers the change to the cart.
+        """
 
-        return self.product.get_price(quantity=self.quantity, **kwargs)
+        self._register_change(self.cart_id)
+
+    def delete(self, *args, **kwargs):
+        """ Delete the item, registering the change to the cart. """
+
+        cart_id = self.cart_id
+
+        super(CartItemBase, self).delete(*args, **kwargs)
+
+        self._register_change(cart_id)
 
     def get_order_line(self):
         """
@@ -166,19 +402,125 @@ class CartBase(AbstractPricedItemBase):
 
         return cart
 
+    @classmethod
+    def get_abandoned(cls, before):
+        """
+        Get carts which have not been used to create an order and for which
+        the last activity, as stored in the field configured with
+        `SHOPKIT_CART_ACTIVITY_FIELD`, lies before `before`.
+        """
+        order_class = get_model_from_string(ORDER_MODEL)
+        ordered = order_class.objects.filter(cart__isnull=False).values('cart')
+
+        abandoned = cls.objects.filter(
+            **{'%s__lt' % CART_ACTIVITY_FIELD: before})
+
+        return abandoned.exclude(pk__in=ordered)
+
+    @classmethod
+    def touch(cls, pk):
+        """
+        Set the activity field of the cart with the given pk, as configured
+        with `SHOPKIT_CART_ACTIVITY_FIELD`, to the current time, so that it
+        is not considered abandoned. This is done whenever the items of the
+        cart change, as these changes do not save the cart itself. Carts
+        without such a field are left alone.
+        """
+
+        if not pk:
+            return
+
+        try:
+            field = cls._meta.get_field(CART_ACTIVITY_FIELD)
+        except FieldDoesNotExist:
+            return
+
+        now = datetime.datetime.now()
+        if not isinstance(field, models.DateTimeField):
+            now = now.date()
+
+        cls.objects.filter(pk=pk).update(**{field.attname: now})
+
     def to_request(self, request):
         """
-        Store a reference to the current `Cart` object in the session.
+        Store a reference to the current `Cart` object in the session. When
+        snapshots are enabled, see
+        :func:`snapshots_enabled <shopkit.core.snapshots.snapshots_enabled>`,
+        a :class:`CartSnapshot <shopkit.core.snapshots.CartSnapshot>` is
+        stored along with it.
         """
         assert self.pk, 'Cart object not saved'
 
         logger.debug('Storing shopping cart with pk %d in session.' % self.pk)
         request.session['cart_pk'] = self.pk
 
+        if snapshots_enabled():
+            CartSnapshot.from_cart(self).to_request(request)
+
+    def delete(self, *args, **kwargs):
+        """ Delete the cart, registering the change. """
+
+        pk = self.pk
+
+        super(CartBase, self).delete(*args, **kwargs)
+
+        cart_changed(pk)
+
     def get_items(self):
-        """ Gets items from the cart with a quantity > 0. """
+        """
+        Gets items from the cart with a quantity > 0, together with their
+        products.
+        """
+
+        return self.cartitem_set.filter(quantity__gt=0).select_related('product')
+
+    def get_item_prices(self, **kwargs):
+        """
+        Prices all items in the cart in a single pass. Items and products
+        are fetched in one query, after which the prices for all of them
+        are resolved at once through `get_piece_prices()` on the cart item
+        class. This way, the amount of queries needed to price a cart does
+        not depend on the amount of items in it.
+
+        The result is cached on the cart until items are added or removed
+        through it.
+
+        :returns: list of `(cartitem, piece_price, total_price)` tuples
+        """
+
+        cached = getattr(self, '_item_prices', None)
+        if cached and cached[0] == kwargs:
+            return cached[1]
+
+        logger.debug(u'Calculating item prices for shopping cart.')
+
+        cartitems = list(self.get_items())
 
-        return self.cartitem_set.filter(quantity__gt=0)
+        if cartitems:
+            cartitem_class = cartitems[0].__class__
+            piece_prices = cartitem_class.get_piece_prices(cartitems, **kwargs)
+        else:
+            piece_prices = []
+
+        item_prices = []
+        for (cartitem, piece_price) in zip(cartitems, piece_prices):
+            assert isinstance(piece_price, Decimal)
+
+            # Make sure the regular price API of the item uses this price
+            cartitem._piece_price = (kwargs, cartitem.quantity, piece_price)
+
+            item_prices.append((cartitem,
+                                piece_price,
+                                cartitem.get_total_price(**kwargs)))
+
+        self._item_prices = (kwargs, item_prices)
+
+        return item_prices
+
+    def _reset_item_prices(self):
+        """ Clear the item prices cached by `get_item_prices()`. """
+
+        self._item_prices = None
 
     def get_item(self, product, create=True, **kwargs):
         """ Either instantiates and returns a CartItem for the
@@ -208,6 +550,9 @@ class CartBase(AbstractPricedItemBase):
             logger.debug(u'Found existing cart item for product \'%s\'' \
                             % product)
 
+            # Prevent a query when the item refers back to this cart
+            cartitem.cart = self
+
         except cartitem_class.DoesNotExist:
             if create:
                 logger.debug(u'Product \'%s\' not already in Cart, creating item.' \
@@ -227,28 +572,149 @@ class CartBase(AbstractPricedItemBase):
             a CartItem for the Product-Cart combination or updates
             it when a CartItem already exists.
 
-            When `kwargs` are specified, these are passed along to
-            `get_item` and signify properties of the `CartItem`.
+            When `kwargs` are specified, these signify properties of the
+            `CartItem`, like they do for `get_item`.
+
+            The quantity is raised atomically, without reading the item
+            first, so concurrent requests adding the same product do not
+            lose each other's additions. Where the database supports it, a
+            single `INSERT ... ON CONFLICT` query is used. Otherwise, an F()
+            based `UPDATE` is attempted before creating the item, retrying
+            the update when the item was created concurrently.
 
             :returns: added `CartItem`
         """
         # assert isinstance(quantity, int), 'Quantity not an integer.'
 
-        cartitem = self.get_item(product, **kwargs)
+        assert self.pk, 'Cart object not saved'
+        assert product.pk, 'No pk for product, please save first'
 
-        assert cartitem.product == product
-        assert cartitem.product.pk, 'No pk for product, please save first'
+        cartitem_class = get_model_from_string(CARTITEM_MODEL)
 
-        # We can do this without querying the actual value from the
-        # database.
-        # cartitem.quantity = models.F('quantity') + quantity
-        cartitem.quantity += quantity
+        if supports_upsert():
+            cartitem = cartitem_class(cart=self, product=product, **kwargs)
+            upsert_increment(cartitem, ('cart', 'product'),
+                             {'quantity': quantity})
+
+            cartitem.quantity_added(quantity)
+
+        else:
+            lookup = dict(cart=self, product=product, **kwargs)
+
+            (cartitem, created) = increment_or_create(cartitem_class, lookup,
+                                                      {'quantity': quantity})
+
+            if not created:
+                cartitem = cartitem_class.objects.get(**lookup)
+                cartitem.cart = self
+
+                cartitem.quantity_added(quantity)
 
-        cartitem.save()
         assert cartitem.pk
 
+        self._reset_item_prices()
+
         return cartitem
 
+    def add_items(self, items):
+        """
+        Adds many products to the current shopping Cart at once, for example
+        from a quick order form or when reordering a previous order.
+
+        `items` is a sequence of `(product, quantity, kwargs)` tuples, where
+        `kwargs` is optional and signifies properties of newly created
+        `CartItem`'s, like it does for `add_item`. As a cart holds only one
+        item per product, quantities for the same product are combined.
+
+        Existing items are fetched in a single query, after which their
+        quantities are increased using one `UPDATE` query per distinct
+        quantity. New items are created using `bulk_create()` when the
+        version of Django supports it. Note that the latter does not set the
+        primary key on the resulting items. All of this happens atomically;
+        when some of the new items have been created concurrently, the new
+        items are added one by one instead, as `add_item()` does.
+
+        :returns: list of added `CartItem`'s
+        """
+
+        assert self.pk, 'Cart object not saved'
+
+        cartitem_class = get_model_from_string(CARTITEM_MODEL)
+
+        # Combine the quantities for every product, retaining their order
+        products = []
+        quantities = {}
+        for item in items:
+            (product, quantity) = item[:2]
+            kwargs = len(item) > 2 and item[2] or {}
+
+            assert product.pk, 'No pk for product, please save first'
+
+            if product.pk in quantities:
+                quantities[product.pk][1] += quantity
+            else:
+                quantities[product.pk] = [product, quantity, kwargs]
+                products.append(product.pk)
+
+        with transaction_or_savepoint():
+            existing = dict((cartitem.product_id, cartitem) for cartitem in \
+                cartitem_class.objects.filter(cart=self, product__in=products))
+
+            cartitems = []
+            new_cartitems = []
+            increments = {}
+            for product_pk in products:
+                (product, quantity, kwargs) = quantities[product_pk]
+
+                if product_pk in existing:
+                    cartitem = existing[product_pk]
+                    cartitem.quantity += quantity
+
+                    increments.setdefault(quantity, []).append(cartitem.pk)
+                else:
+                    logger.debug(u'Product \'%s\' not already in Cart, creating item.',
+                                 product)
+
+                    cartitem = cartitem_class(cart=self,
+                                              product=product,
+                                              quantity=quantity,
+                                              **kwargs)
+                    new_cartitems.append(cartitem)
+
+                cartitem.cart = self
+                cartitem.product = product
+
+                cartitems.append(cartitem)
+
+            for (quantity, pks) in increments.iteritems():
+                cartitem_class.objects.filter(pk__in=pks).update(
+                    quantity=models.F('quantity') + quantity)
+
+            try:
+                with transaction_or_savepoint():
+                    bulk_create(cartitem_class, new_cartitems)
+
+            except IntegrityError:
+                logger.debug(u'Items added to cart %d concurrently, adding '
+                             u'them one by one.', self.pk)
+
+                for cartitem in new_cartitems:
+                    (product, quantity, kwargs) = \
+                        quantities[cartitem.product.pk]
+
+                    increment_or_create(cartitem_class,
+                                        {'cart': self, 'product': product},
+                                        {'quantity': quantity}, kwargs)
+
+        logger.debug(u'Added %d items to cart %d, %d of which were new',
+                     len(cartitems), self.pk, len(new_cartitems))
+
+        self.touch(self.pk)
+        cart_changed(self.pk)
+        self._reset_item_prices()
+
+        return cartitems
+
     def remove_item(self, product, **kwargs):
         """
         Remove item from cart.
@@ -262,6 +728,8 @@ class CartBase(AbstractPricedItemBase):
 
         if cartitem:
             cartitem.delete()
+            self._reset_item_prices()
+
             return True
 
         return False
@@ -269,18 +737,12 @@ class CartBase(AbstractPricedItemBase):
     def get_total_items(self):
         """
         Gets the total quantity of products in the shopping cart.
-
-        .. todo::
-            Use aggregation here.
         """
 
-        quantity = 0
-
-        for cartitem in self.get_items():
-            quantity += cartitem.quantity
+        quantity = self.cartitem_set.filter(quantity__gt=0).aggregate(
+            models.Sum('quantity'))['quantity__sum']
 
-        # assert isinstance(quantity, int)
-        return quantity
+        return quantity or 0
 
     def get_price(self, **kwargs):
         """ Wraps the `get_total_price` function. """
@@ -294,12 +756,10 @@ class CartBase(AbstractPricedItemBase):
 
         logger.debug(u'Calculating total price for shopping cart.')
 
-        # logger.debug(self.get_items()[0].get_total_price())
-
         price = Decimal("0.0")
 
-        for cartitem in self.get_items():
-            item_price = cartitem.get_total_price(**kwargs)
+        for (cartitem, piece_price, item_price) in \
+                self.get_item_prices(**kwargs):
             logger.debug(u'Adding price %f for item \'%s\' to total cart price.' % \
                 (item_price, cartitem))
             assert isinstance(item_price, Decimal)
@@ -316,6 +776,230 @@ class CartBase(AbstractPricedItemBase):
         return unicode(self.product)
 
 
+class SummarizedCartMixin(models.Model):
+    """
+    Mixin class for `Cart`'s which keep a persistent summary of their items
+    in `total_items` and `total_price` fields, so that displaying these does
+    not require the items in the cart to be fetched and priced.
+
+    The summary is updated incrementally by
+    :class:`SummarizedCartItemMixin`, which should be used for the
+    `CartItem` model. As the summary is based on the prices at the time the
+    items were changed, it can be recalculated using the
+    `updatecartsummaries` management command.
+    """
+
+    class Meta:
+        abstract = True
+
+    total_items = models.IntegerField(_('total items'), default=0,
+                                      editable=False)
+    """ Total quantity of products in the cart. """
+
+    total_price = PriceField(verbose_name=_('total price'),
+                             default=Decimal('0.00'), editable=False)
+    """ Total price for the items in the cart. """
+
+    @classmethod
+    def adjust_summary(cls, pk, items, price):
+        """
+        Add `items` and `price` to the summary of the cart with the given
+        `pk`, using a single `UPDATE` query which does not depend on the
+        values currently known to Python.
+        """
+
+        logger.debug(u'Adjusting summary for cart %d with %d items and price %s',
+                     pk, items, price)
+
+        cls.objects.filter(pk=pk).update(
+            total_items=models.F('total_items') + items,
+            total_price=models.F('total_price') + price)
+
+    @classmethod
+    def update_summaries(cls, queryset=None, batch_size=500):
+        """
+        Recalculate the summaries for all carts in `queryset`, or all carts
+        when it is not given, `batch_size` carts at a time. For every batch,
+        the items are fetched and priced at once and only carts for which
+        the summary changed are updated.
+
+        :returns: the amount of carts updated
+        """
+
+        if queryset is None:
+            queryset = cls.objects.all()
+
+        cartitem_class = get_model_from_string(CARTITEM_MODEL)
+
+        updated = 0
+        last_pk = None
+        while True:
+            batch = queryset.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+
+            summaries = list(batch.values_list('pk', 'total_items',
+                                               'total_price')[:batch_size])
+            if not summaries:
+                break
+
+            last_pk = summaries[-1][0]
+
+            totals = dict((pk, [0, Decimal('0.00')]) for (pk, i, p) in summaries)
+
+            cartitems = list(cartitem_class.objects.filter(
+                cart__in=totals.keys(), quantity__gt=0).select_related('product'))
+
+            if cartitems:
+                piece_prices = cartitem_class.get_piece_prices(cartitems)
+            else:
+                piece_prices = []
+
+            for (cartitem, piece_price) in zip(cartitems, piece_prices):
+                total = totals[cartitem.cart_id]
+                total[0] += cartitem.quantity
+                total[1] += cartitem.quantity*piece_price
+
+            for (pk, total_items, total_price) in summaries:
+                if [total_items, total_price] != totals[pk]:
+                    cls.objects.filter(pk=pk).update(total_items=totals[pk][0],
+                                                     total_price=totals[pk][1])
+                    updated += 1
+
+        logger.debug(u'Updated summaries for %d carts', updated)
+
+        return updated
+
+    def update_summary(self):
+        """ Recalculate the summary for this cart. """
+
+        assert self.pk, 'Cannot update the summary of an unsaved cart.'
+
+        self.update_summaries(self.__class__.objects.filter(pk=self.pk))
+
+        (self.total_items, self.total_price) = \
+            self.__class__.objects.filter(pk=self.pk).values_list(
+                'total_items', 'total_price')[0]
+
+    def add_items(self, items):
+        """
+        Add items in bulk. As this bypasses saving the individual items,
+        the summary is recalculated afterwards.
+        """
+
+        cartitems = super(SummarizedCartMixin, self).add_items(items)
+
+        self.update_summary()
+
+        return cartitems
+
+    def get_total_items(self):
+        """ Gets the total quantity of products from the summary. """
+
+        return self.total_items
+
+    def get_total_price(self, **kwargs):
+        """
+        Gets the total price from the summary. When `kwargs` are given, the
+        price is calculated as these might affect it.
+        """
+
+        if kwargs:
+            return super(SummarizedCartMixin, self).get_total_price(**kwargs)
+
+        return self.total_price
+
+
+class SummarizedCartItemMixin(object):
+    """
+    Mixin class for `CartItem`'s belonging to a cart with a
+    :class:`SummarizedCartMixin`. Whenever the quantity of an item changes,
+    or an item is deleted, the summary of the cart is adjusted accordingly.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SummarizedCartItemMixin, self).__init__(*args, **kwargs)
+
+        self._store_summary_quantity()
+
+    def _store_summary_quantity(self):
+        """ Remember the quantity as currently accounted for in the cart. """
+
+        if self.pk:
+            self._summary_quantity = max(self.quantity, 0)
+        else:
+            self._summary_quantity = 0
+
+    def update_cart_summary(self, old_quantity):
+        """
+        Adjust the summary of the cart with the difference between the
+        price and quantity for `old_quantity` and the current quantity.
+        """
+
+        new_quantity = max(self.quantity, 0)
+
+        if self.pk is None:
+            new_quantity = 0
+
+        if old_quantity == new_quantity:
+            return
+
+        old_item = copy.copy(self)
+        old_item.quantity = old_quantity
+
+        new_item = copy.copy(self)
+        new_item.quantity = new_quantity
+
+        # Price the old and new quantity in one go
+        lines = [item for item in (old_item, new_item) if item.quantity]
+        piece_prices = self.get_piece_prices(lines)
+
+        price = Decimal('0.00')
+        for (item, piece_price) in zip(lines, piece_prices):
+            if item is new_item:
+                price += item.quantity*piece_price
+            else:
+                price -= item.quantity*piece_price
+
+        items = new_quantity - old_quantity
+
+        cart_class = self._meta.get_field('cart').rel.to
+        cart_class.adjust_summary(self.cart_id, items, price)
+
+        # Keep the cart instance we know about up to date
+        cart = getattr(self, self._meta.get_field('cart').get_cache_name(), None)
+        if cart:
+            cart.total_items += items
+            cart.total_price += price
+
+        self._store_summary_quantity()
+
+    def quantity_added(self, quantity):
+        """ Update the summary of the cart for the added quantity. """
+
+        super(SummarizedCartItemMixin, self).quantity_added(quantity)
+
+        self.update_cart_summary(max(self.quantity - quantity, 0))
+
+    def save(self, *args, **kwargs):
+        """ Save the item and update the summary of the cart. """
+
+        super(SummarizedCartItemMixin, self).save(*args, **kwargs)
+
+        self.update_cart_summary(self._summary_quantity)
+
+    def delete(self, *args, **kwargs):
+        """ Delete the item and update the summary of the cart. """
+
+        cart_id = self.cart_id
+
+        super(SummarizedCartItemMixin, self).delete(*args, **kwargs)
+
+        # Deleting clears the pk, we still need the cart though
+        self.cart_id = cart_id
+        self.update_cart_summary(self._summary_quantity)
+
+
 class OrderItemBase(AbstractPricedItemBase, QuantizedItemBase):
     """
     Abstract base class for order items. An `OrderItem` should, ideally, copy all
@@ -405,10 +1089,20 @@ class OrderItemBase(AbstractPricedItemBase, QuantizedItemBase):
         keeping or discount usage administration. By default it merely
         emits a debug message.
 
-        When overriding, be sure to call the superclass.
+        When overriding, be sure to call the superclass. Rather than saving
+        related objects, overrides should use `register_increment()` where
+        possible, so that the changes can be applied in bulk.
         """
         logger.debug(u'Registering order item confirmation for %s', self)
 
+    def register_increment(self, model_class, pks, field, amount):
+        """
+        Raise `field` by `amount` for the objects of `model_class` with the
+        given primary key(s). This is delegated to the order, see
+        :meth:`OrderBase.register_increment`.
+        """
+        self.order.register_increment(model_class, pks, field, amount)
+
     def get_parent(self):
         """
         Get the relevant Order. Used to have a generic API for Carts
@@ -425,8 +1119,13 @@ class OrderStateChangeBase(models.Model):
         verbose_name_plural = _('order state changes')
         abstract = True
 
+        # Composite indexes can only be declared from Django 1.5 on
+        if django.VERSION >= (1, 5):
+            index_together = (('order', 'date'), )
+
     order = models.ForeignKey(ORDER_MODEL)
-    date = models.DateTimeField(auto_now_add=True, verbose_name=_('date'))
+    date = models.DateTimeField(auto_now_add=True, verbose_name=_('date'),
+                                db_index=True)
     """ Date at which the state change ocurred. """
 
     state = models.PositiveSmallIntegerField(_('status'),
@@ -459,6 +1158,159 @@ class OrderStateChangeBase(models.Model):
             }
 
 
+class OrderStateEventBase(models.Model):
+    """
+    Abstract base class for an outbox of order state changes. When
+    `SHOPKIT_ORDERSTATE_EVENT_MODEL` is configured, an event is stored along
+    with every state change, in the same transaction, instead of sending the
+    `order_state_change` signal right away. The `processorderevents`
+    management command then sends the signals, retrying events for which
+    listeners raised an exception.
+
+    As events might be retried, listeners should be prepared to be called
+    more than once for the same state change.
+    """
+
+    class Meta:
+        verbose_name = _('order state event')
+        verbose_name_plural = _('order state events')
+        abstract = True
+
+    order = models.ForeignKey(ORDER_MODEL)
+    state_change = models.ForeignKey(ORDERSTATE_CHANGE_MODEL)
+
+    old_state = models.PositiveSmallIntegerField(_('old status'),
+                                                 choices=ORDER_STATES,
+                                                 null=True, blank=True)
+    """ State of the order before the change, if any. """
+
+    new_state = models.PositiveSmallIntegerField(_('new status'),
+                                                 choices=ORDER_STATES)
+    """ State of the order after the change. """
+
+    date = models.DateTimeField(auto_now_add=True, verbose_name=_('date'))
+    """ Date at which the event was stored. """
+
+    attempts = models.PositiveSmallIntegerField(_('attempts'), default=0)
+    """ Amount of times the listeners have been called for this event. """
+
+    processed = models.DateTimeField(_('processed'), null=True, blank=True,
+                                     db_index=True)
+    """ Date at which the listeners ran successfully. """
+
+    last_error = models.TextField(_('last error'), blank=True)
+    """ The last exception raised by a listener. """
+
+    claimed_until = models.DateTimeField(_('claimed until'), null=True,
+                                         blank=True, editable=False)
+    """ Date until which a worker has claimed this event, if any. """
+
+    @classmethod
+    def get_pending(cls, max_attempts=ORDERSTATE_EVENT_MAX_ATTEMPTS):
+        """
+        Return the events which have not been processed yet, oldest first,
+        leaving out events which have been attempted `max_attempts` times
+        and events currently claimed by a worker.
+        """
+        unclaimed = models.Q(claimed_until__isnull=True) | \
+                    models.Q(claimed_until__lt=datetime.datetime.now())
+
+        return cls.objects.filter(unclaimed, processed__isnull=True,
+                                  attempts__lt=max_attempts).order_by('pk')
+
+    def claim(self, timeout=ORDERSTATE_EVENT_CLAIM_TIMEOUT):
+        """
+        Claim this event for `timeout` seconds and register an attempt to
+        process it. The event is only claimed when it has not been
+        processed, nor attempted or claimed by another worker in the
+        meantime, allowing several workers to process events concurrently.
+        When a worker fails to mark the event processed or failed within
+        `timeout`, for example because it died, the event can be claimed
+        again. Returns whether or not the event was claimed.
+        """
+        now = datetime.datetime.now()
+        claimed_until = now + datetime.timedelta(seconds=timeout)
+
+        unclaimed = models.Q(claimed_until__isnull=True) | \
+                    models.Q(claimed_until__lt=now)
+
+        claimed = self.__class__.objects.filter(unclaimed, pk=self.pk,
+            attempts=self.attempts, processed__isnull=True
+        ).update(attempts=models.F('attempts') + 1,
+                 claimed_until=claimed_until)
+
+        transaction.commit_unless_managed()
+
+        if claimed:
+            self.attempts += 1
+            self.claimed_until = claimed_until
+
+        return bool(claimed)
+
+    def mark_processed(self):
+        """
+        Mark this event as processed, clearing the last error and releasing
+        the claim.
+        """
+        self.processed = datetime.datetime.now()
+        self.last_error = u''
+        self.claimed_until = None
+
+        self.__class__.objects.filter(pk=self.pk).update(
+            processed=self.processed, last_error=self.last_error,
+            claimed_until=None)
+
+        transaction.commit_unless_managed()
+
+    def mark_failed(self, error):
+        """
+        Store `error` as the last error of this event and release the claim,
+        leaving the event to be retried.
+        """
+        self.last_error = u'%s: %s' % (error.__class__.__name__, error)
+        self.claimed_until = None
+
+        self.__class__.objects.filter(pk=self.pk).update(
+            last_error=self.last_error, claimed_until=None)
+
+        transaction.commit_unless_managed()
+
+    def process(self, mark_processed=True):
+        """
+        Send the `order_state_change` signal for this event. When no listener
+        raises an exception, the event is marked as processed, unless
+        `mark_processed` is `False`; the caller should then call
+        :meth:`mark_processed` itself, for example once the messages sent by
+        the listeners have actually been delivered. Otherwise the last
+        exception is stored and `False` is returned.
+        """
+        results = signals.order_state_change.send_robust(
+                                        sender=self.order,
+                                        old_state=self.old_state,
+                                        new_state=self.new_state,
+                                        state_change=self.state_change)
+
+        errors = [response for (receiver, response) in results \
+                  if isinstance(response, Exception)]
+
+        if errors:
+            logger.warning(u'Listeners for %s raised %d exception(s): %s',
+                           self, len(errors), errors)
+
+            self.mark_failed(errors[-1])
+        elif mark_processed:
+            self.mark_processed()
+
+        return not errors
+
+    def __unicode__(self):
+        return _(u'%(order)s from %(old_state)s to %(new_state)s') % \
+            {'order': self.order_id,
+             'old_state': self.old_state,
+             'new_state': self.new_state
+            }
+
+
 class OrderBase(AbstractPricedItemBase, DatedItemBase):
     """ Abstract base class for orders. """
 
@@ -488,31 +1340,46 @@ class OrderBase(AbstractPricedItemBase, DatedItemBase):
     would be lowered twice etcetera.
     """
 
+    objects = OrderManager()
+
+    def __init__(self, *args, **kwargs):
+        super(OrderBase, self).__init__(*args, **kwargs)
+
+        # Every save logs the state, so the state loaded from the database
+        # is the latest state logged.
+        if self.pk:
+            self._logged_state = self.state
+        else:
+            self._logged_state = None
+
     def get_items(self):
         """ Get all order items (with a quantity greater than 0). """
         return self.orderitem_set.filter(quantity__gt=0)
 
     def get_total_items(self):
         """
-        Gets the total quantity of products in the shopping cart.
-
-        .. todo::
-            Use aggregation here.
+        Gets the total quantity of products in the order. When the order
+        has been annotated by `with_totals()`, the annotation is used.
         """
 
-        quantity = 0
+        if hasattr(self, 'total_items'):
+            return int(self.total_items)
 
-        for orderitem in self.get_items():
-            # assert isinstance(orderitem.quantity, int)
-            quantity += orderitem.quantity
+        quantity = self.get_items().aggregate(
+            models.Sum('quantity'))['quantity__sum']
 
-        return quantity
+        return quantity or 0
 
     @classmethod
     def from_cart(cls, cart):
         """
         Instantiate an order based on the basis of a
         shopping cart, copying all the items.
+
+        The order items are created using `from_cartitem()` on the
+        `OrderItem` model and inserted with a single `bulk_create()` query
+        when the version of Django supports it. Note that this bypasses the
+        `save()` method of the order items.
         """
 
         order = cls(cart=cart)
@@ -522,32 +1389,51 @@ class OrderBase(AbstractPricedItemBase, DatedItemBase):
 
         orderitem_class = get_model_from_string(ORDERITEM_MODEL)
 
-        for cartitem in cart.cartitem_set.all():
+        # Price all cart items in one pass before copying them
+        orderitems = []
+        for (cartitem, piece_price, total_price) in cart.get_item_prices():
             orderitem = orderitem_class.from_cartitem(cartitem=cartitem,
                                                       order=order)
-            orderitem.save()
 
             assert orderitem, 'Something went wrong creating an \
                                OrderItem from a CartItem.'
-            assert orderitem.pk
 
-        assert len(cart.get_items()) == len(order.get_items())
+            orderitems.append(orderitem)
+
+        # Insert all items with a single query, where available
+        bulk_create(orderitem_class, orderitems)
+
+        assert order.get_items().count() == len(orderitems)
 
         return order
 
-    def _update_state(self, message=None):
+    def _update_state(self, message=None, created=False):
         """
         Update the order state, optionaly attach a message to the state
         change. When no message has been given and the order state is the
         same as the previous order state, no action is performed.
+
+        The state last logged is kept track of on the order, so the latest
+        state change is only looked up when the state differs from it or
+        a message is given. For newly `created` orders, no lookup is
+        necessary at all.
         """
 
         assert self.pk, 'Cannot update state for unsaved order.'
 
+        if not message and self._logged_state is not None and \
+                self._logged_state == self.state:
+            logger.debug(u'Same state %s for %s, not saving change.',
+                         self.state, self)
+            return
+
         orderstate_change_class = \
             get_model_from_string(ORDERSTATE_CHANGE_MODEL)
 
-        latest_statechange = orderstate_change_class.get_latest(order=self)
+        if created:
+            latest_statechange = None
+        else:
+            latest_statechange = orderstate_change_class.get_latest(order=self)
 
         if latest_statechange:
             latest_state = latest_statechange.state
@@ -562,8 +1448,21 @@ class OrderBase(AbstractPricedItemBase, DatedItemBase):
             state_change = orderstate_change_class(state=self.state,
                                                    order=self,
                                                    message=message)
+
+            if ORDERSTATE_EVENT_MODEL:
+                # Store the state change along with an event for the outbox
+                if transaction.is_managed():
+                    self._log_state_change(state_change, latest_state)
+                else:
+                    with transaction.commit_on_success():
+                        self._log_state_change(state_change, latest_state)
+
+                return
+
             state_change.save()
 
+            self._logged_state = self.state
+
             # There's a new state change to be made
             logger.debug(u'Saved state change from %s to %s for %s with message \'%s\'',
                          latest_state,
@@ -584,17 +1483,41 @@ class OrderBase(AbstractPricedItemBase, DatedItemBase):
                     raise response
 
         else:
+            self._logged_state = self.state
+
             logger.debug(u'Same state %s for %s, not saving change.',
                          self.state, self)
 
+    def _log_state_change(self, state_change, old_state):
+        """
+        Save `state_change` along with an event in the outbox configured in
+        `SHOPKIT_ORDERSTATE_EVENT_MODEL`, to be processed by the
+        `processorderevents` management command.
+        """
+        orderstate_event_class = get_model_from_string(ORDERSTATE_EVENT_MODEL)
+
+        state_change.save()
+
+        orderstate_event_class.objects.create(order=self,
+                                              state_change=state_change,
+                                              old_state=old_state,
+                                              new_state=self.state)
+
+        self._logged_state = self.state
+
+        logger.debug(u'Stored state change event from %s to %s for %s',
+                     old_state, self.state, self)
+
     def save(self, *args, **kwargs):
         """
         Make sure we log a state change where applicable.
         """
 
+        created = self.pk is None
+
         result = super(OrderBase, self).save(*args, **kwargs)
 
-        self._update_state()
+        self._update_state(created=created)
 
         return result
 
@@ -613,6 +1536,51 @@ class OrderBase(AbstractPricedItemBase, DatedItemBase):
         if self.confirmed:
             raise AlreadyConfirmedException(self)
 
+    def register_increment(self, model_class, pks, field, amount):
+        """
+        Raise `field` by `amount` for the objects of `model_class` with the
+        given primary key(s), for example in order to lower the stock of a
+        product or register the use of a discount.
+
+        Within `process_confirm()`, increments are collected and applied
+        with as few `UPDATE` queries as possible at the end of the
+        confirmation. Otherwise they are applied right away.
+        """
+        increments = getattr(self, '_deferred_increments', None)
+
+        if increments is None:
+            increments = DeferredIncrements()
+            increments.add(model_class, pks, field, amount)
+            increments.apply()
+        else:
+            increments.add(model_class, pks, field, amount)
+
+    def process_confirm(self):
+        """
+        Confirmation pipeline: runs `prepare_confirm()` and `confirm()`
+        atomically, in a transaction of its own or, when a transaction is
+        being managed, in a savepoint of it. Increments registered during the
+        confirmation through `register_increment()`, such as stock
+        decrements and discount usage, are collected and applied in bulk
+        at the end.
+
+        :raises: AlreadyConfirmedException, or any other exception raised
+                 by `prepare_confirm()`, in which case nothing is changed
+        """
+        with transaction_or_savepoint():
+            self.prepare_confirm()
+
+            self._deferred_increments = DeferredIncrements()
+            try:
+                self.confirm()
+
+                queries = self._deferred_increments.apply()
+                logger.debug(u'Applied confirmation increments for %s in %d queries',
+                             self, queries)
+
+            finally:
+                self._deferred_increments = None
+
     def confirm(self):
         """
         Method which performs actions to be taken upon order confirmation.
@@ -630,6 +1598,9 @@ class OrderBase(AbstractPricedItemBase, DatedItemBase):
         this method should *not* raise errors under normal circumstances as
         this could lead to potential data/state inconsistencies.
 
+        To confirm an order within a single transaction and perform the
+        updates registered by the items in bulk, use `process_confirm()`.
+
         In general, it makes sense to connect this method to a change in order
         state such that it is called automatically. For example:
 
@@ -656,7 +1627,10 @@ class OrderBase(AbstractPricedItemBase, DatedItemBase):
         self.cart = None
         self.save()
 
-        for item in self.get_items():
+        for item in self.get_items().select_related('product'):
+            # Prevent a query for the order of every item
+            item.order = self
+
             item.confirm()
 
     def get_price(self, **kwargs):
@@ -666,9 +1640,20 @@ class OrderBase(AbstractPricedItemBase, DatedItemBase):
 
     def get_total_price(self, **kwargs):
         """
-        Gets the total price for all items in the order.
+        Gets the total price for all items in the order. When the order
+        has been annotated by `with_totals()` and no arguments are given,
+        the annotation is used.
         """
 
+        if not kwargs and hasattr(self, 'total_price'):
+            price = self.total_price
+
+            # Some databases return floats for sums of decimals
+            if not isinstance(price, Decimal):
+                price = Decimal(str(price))
+
+            return price
+
         logger.debug(u'Calculating total price for order.')
 
         # logger.debug(self.get_items()[0].get_total_price())
@@ -693,6 +1678,75 @@ class OrderBase(AbstractPricedItemBase, DatedItemBase):
             }
 
 
+class ArchivedOrderBase(models.Model):
+    """
+    Abstract base class for the lookup of orders moved to the archive by
+    :mod:`shopkit.core.archive`. Besides a summary of the order, it keeps
+    track of the file and line in which the order, its items and its state
+    changes are stored.
+    """
+
+    class Meta:
+        verbose_name = _('archived order')
+        verbose_name_plural = _('archived orders')
+        abstract = True
+
+    order_pk = models.PositiveIntegerField(_('order'), unique=True)
+    """ Primary key of the order before it was archived. """
+
+    customer_pk = models.PositiveIntegerField(_('customer'), null=True,
+                                              blank=True, db_index=True)
+    """ Primary key of the customer of the order, if any. """
+
+    state = models.PositiveSmallIntegerField(_('status'),
+                                             choices=ORDER_STATES)
+    date_added = models.DateTimeField(_('date added'))
+    total_items = models.PositiveIntegerField(_('total items'), default=0)
+    total_price = PriceField(verbose_name=_('total price'),
+                             default=Decimal('0.00'))
+
+    archive = models.CharField(_('archive'), max_length=255)
+    """ Name of the archive file, relative to `SHOPKIT_ORDER_ARCHIVE_PATH`. """
+
+    line = models.PositiveIntegerField(_('line'))
+    """ Line of the order within the archive file, starting at 0. """
+
+    date_archived = models.DateTimeField(_('date archived'),
+                                         auto_now_add=True)
+
+    def load(self):
+        """
+        Load the order from the archive, as a dictionary with the values of
+        the order and lists of `items` and `state_changes`.
+        """
+        archive = gzip.open(os.path.join(ORDER_ARCHIVE_PATH, self.archive))
+
+        try:
+            for (number, line) in enumerate(archive):
+                if number == self.line:
+                    return json.loads(line)
+        finally:
+            archive.close()
+
+        raise ObjectDoesNotExist('Order %d not found in archive %s' % \
+                                 (self.order_pk, self.archive))
+
+    def get_total_items(self):
+        return self.total_items
+
+    def get_total_price(self):
+        return self.total_price
+
+    def get_price(self):
+        return self.total_price
+
+    def __unicode__(self):
+        return _(u"%(pk)d on %(date)s (archived)") % \
+            {'pk': self.order_pk,
+             'date': self.date_added.date()
+            }
+
+
 class AddressBase(models.Model):
     """
     Base class for address models.
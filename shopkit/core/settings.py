@@ -65,4 +65,101 @@ ORDERITEM_MODEL = getattr(settings, 'SHOPKIT_ORDERITEM_MODEL')
 MAX_NAME_LENGTH = getattr(settings, 'SHOPKIT_MAX_NAME_LENGTH', 255)
 """ (Optional) The maximum name length for named products in the webshop. 
     This defaults to 255.
-"""
\ No newline at end of file
+"""
+
+CART_SNAPSHOT = getattr(settings, 'SHOPKIT_CART_SNAPSHOT', False)
+"""
+(Optional) When enabled, a compact snapshot of the shopping cart is stored
+in the session along with its primary key, allowing read-only displays of
+the cart to be rendered without querying the database. This requires a
+cache shared between processes, such as memcached; snapshots are not used
+with the local memory cache. This defaults to `False`. See
+:mod:`shopkit.core.snapshots`.
+"""
+
+CART_SNAPSHOT_TIMEOUT = getattr(settings, 'SHOPKIT_CART_SNAPSHOT_TIMEOUT', 60*60*24*14)
+"""
+(Optional) Time in seconds for which the versions of cart snapshots are
+kept in the cache. Snapshots older than this are considered stale. This
+defaults to two weeks, the default session age.
+"""
+
+CART_ACTIVITY_FIELD = getattr(settings, 'SHOPKIT_CART_ACTIVITY_FIELD', 'date_modified')
+"""
+(Optional) Date field of the `Cart` model signifying the last activity of a
+shopping cart, used to find abandoned carts. This defaults to
+`date_modified`, as provided by
+:class:`DatedItemBase <shopkit.core.basemodels.DatedItemBase>`.
+"""
+
+CART_PURGE_DAYS = getattr(settings, 'SHOPKIT_CART_PURGE_DAYS', 30)
+"""
+(Optional) Amount of days without activity after which shopping carts
+without an order are considered abandoned and removed by the `purgecarts`
+management command. This defaults to 30.
+"""
+
+NUMBER_SEQUENCE_MODEL = getattr(settings, 'SHOPKIT_NUMBER_SEQUENCE_MODEL', None)
+"""
+(Optional) Model, based on
+:class:`NumberSequenceBase <shopkit.core.basemodels.NumberSequenceBase>`,
+used for allocating order and invoice numbers by
+:class:`SequenceNumberedOrderBase <shopkit.core.basemodels.SequenceNumberedOrderBase>`.
+"""
+
+ORDER_NUMBER_BLOCK_SIZE = getattr(settings, 'SHOPKIT_ORDER_NUMBER_BLOCK_SIZE', 100)
+"""
+(Optional) Amount of order numbers allocated at a time by every process,
+so that the number sequence is only accessed once every so many orders.
+This defaults to 100.
+"""
+
+ORDERSTATE_EVENT_MODEL = getattr(settings, 'SHOPKIT_ORDERSTATE_EVENT_MODEL', None)
+"""
+(Optional) Model, based on
+:class:`OrderStateEventBase <shopkit.core.models.OrderStateEventBase>`,
+used as an outbox for order state changes. When configured, listeners for
+`order_state_change` are no longer called while saving an order but by the
+`processorderevents` management command instead.
+"""
+
+ORDERSTATE_EVENT_MAX_ATTEMPTS = getattr(settings, 'SHOPKIT_ORDERSTATE_EVENT_MAX_ATTEMPTS', 5)
+"""
+(Optional) Amount of times the listeners for a state change event are
+called before the event is given up on. This defaults to 5.
+"""
+
+ORDERSTATE_EVENT_CLAIM_TIMEOUT = getattr(settings, 'SHOPKIT_ORDERSTATE_EVENT_CLAIM_TIMEOUT', 300)
+"""
+(Optional) Amount of seconds for which an order state change event is
+claimed by a worker. Other workers only claim the event after this time,
+which should therefore exceed the time needed to process a batch of events.
+This defaults to 300.
+"""
+
+EMAIL_BATCH_SIZE = getattr(settings, 'SHOPKIT_EMAIL_BATCH_SIZE', 100)
+"""
+(Optional) Amount of messages collected by an
+:class:`EmailBatch <shopkit.core.listeners.EmailBatch>` before they are sent
+over its connection. This defaults to 100.
+"""
+
+ARCHIVED_ORDER_MODEL = getattr(settings, 'SHOPKIT_ARCHIVED_ORDER_MODEL', None)
+"""
+(Optional) Model, based on
+:class:`ArchivedOrderBase <shopkit.core.models.ArchivedOrderBase>`, keeping
+track of orders moved to the archive by the `archiveorders` management
+command. See :mod:`shopkit.core.archive`.
+"""
+
+ORDER_ARCHIVE_PATH = getattr(settings, 'SHOPKIT_ORDER_ARCHIVE_PATH', None)
+"""
+(Optional) Directory in which archived orders are stored as compressed
+JSON Lines files.
+"""
+
+ORDER_ARCHIVE_DAYS = getattr(settings, 'SHOPKIT_ORDER_ARCHIVE_DAYS', 365*2)
+"""
+(Optional) Age in days after which confirmed orders are archived by the
+`archiveorders` management command. This defaults to two years.
+"""
@@ -0,0 +1,195 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import logging
+logger = logging.getLogger(__name__)
+
+import uuid
+
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.functional import SimpleLazyObject
+
+from shopkit.core.settings import CART_SNAPSHOT, CART_SNAPSHOT_TIMEOUT
+from shopkit.core.utils import get_cart_from_request
+
+
+"""
+Session snapshots of shopping carts.
+
+When `SHOPKIT_CART_SNAPSHOT` is enabled, `to_request()` on a cart stores a
+compact, versioned summary of the cart in the session. Read-only displays,
+such as a mini-cart in the page header, can use this snapshot without any
+database query through :func:`get_cart_summary`.
+
+Every change to a cart replaces its version, which is kept in Django's cache
+framework, so that stale snapshots can be detected. This requires a cache
+shared by all processes serving the shop, such as memcached: with the local
+memory cache, a process would not notice changes made by other processes.
+When the default cache is local to the process, or a dummy cache,
+snapshots are not used, see :func:`snapshots_enabled`.
+"""
+
+
+_enabled = None
+
+
+def snapshots_enabled():
+    """
+    Whether or not snapshots are used: when `SHOPKIT_CART_SNAPSHOT` is
+    enabled and the default cache is shared between processes.
+    """
+    global _enabled
+
+    if _enabled is None:
+        _enabled = CART_SNAPSHOT
+
+        if _enabled and isinstance(cache, (LocMemCache, DummyCache)):
+            logger.warning(u'Cart snapshots require a cache shared between '
+                           u'processes, not using them with %s.',
+                           cache.__class__.__name__)
+
+            _enabled = False
+
+    return _enabled
+
+
+def _get_version_key(cart_pk):
+    """ Cache key for the version of the cart with the given pk. """
+    return 'shopkit.cart.%d.version' % cart_pk
+
+
+def get_cart_version(cart_pk):
+    """
+    Get the current version of the cart with the given pk, or `None` when
+    it is not known.
+    """
+    return cache.get(_get_version_key(cart_pk))
+
+
+def bump_cart_version(cart_pk):
+    """
+    Register a change to the cart with the given pk, rendering any snapshot
+    made before stale.
+
+    :returns: the new version
+    """
+    version = uuid.uuid4().hex
+
+    logger.debug(u'New version %s for cart %d', version, cart_pk)
+    cache.set(_get_version_key(cart_pk), version, CART_SNAPSHOT_TIMEOUT)
+
+    return version
+
+
+def cart_changed(cart_pk):
+    """
+    Bump the version of the cart with the given pk, if snapshots are
+    enabled and the cart has been saved.
+    """
+    if cart_pk and snapshots_enabled():
+        bump_cart_version(cart_pk)
+
+
+class CartSnapshot(object):
+    """
+    Compact, read-only representation of a cart, offering the parts of the
+    API of `Cart` objects relevant to a summary of the cart.
+    """
+
+    session_key = 'cart_snapshot'
+    """ Key under which snapshots are stored in the session. """
+
+    def __init__(self, data):
+        self.data = data
+
+    @classmethod
+    def from_cart(cls, cart):
+        """ Create a snapshot for the given (saved) cart. """
+        assert cart.pk, 'Cart object not saved'
+
+        version = get_cart_version(cart.pk) or bump_cart_version(cart.pk)
+
+        items = list(cart.get_items().values_list('product', 'quantity'))
+
+        data = {'version': version,
+                'pk': cart.pk,
+                'items': items,
+                'total_items': cart.get_total_items(),
+                'total_price': str(cart.get_total_price())}
+
+        return cls(data)
+
+    @classmethod
+    def from_request(cls, request):
+        """
+        Get the snapshot from the session, or `None` when no snapshot is
+        available or when it is stale.
+        """
+        data = request.session.get(cls.session_key, None)
+
+        if not data or data['pk'] != request.session.get('cart_pk', None):
+            return None
+
+        if data['version'] != get_cart_version(data['pk']):
+            logger.debug(u'Snapshot for cart %d is stale', data['pk'])
+            return None
+
+        return cls(data)
+
+    def to_request(self, request):
+        """ Store this snapshot in the session. """
+        logger.debug(u'Storing snapshot of cart %d in session', self.data['pk'])
+
+        request.session[self.session_key] = self.data
+
+    def get_items(self):
+        """ Get the items in the cart as `(product_pk, quantity)` tuples. """
+        return self.data['items']
+
+    def get_total_items(self):
+        """ Get the total quantity of products in the cart. """
+        return self.data['total_items']
+
+    def get_total_price(self):
+        """ Get the total price for all items in the cart. """
+        return Decimal(self.data['total_price'])
+
+    def get_price(self):
+        """ Wraps `get_total_price()`. """
+        return self.get_total_price()
+
+
+def get_cart_summary(request):
+    """
+    Get a summary of the cart for read-only displays: the snapshot from the
+    session when it is still valid and the (lazy) cart itself otherwise.
+    Both offer `get_total_items()` and `get_total_price()`.
+    """
+    snapshot = None
+
+    if snapshots_enabled():
+        snapshot = CartSnapshot.from_request(request)
+
+    if snapshot:
+        return snapshot
+
+    return SimpleLazyObject(lambda: get_cart_from_request(request))
@@ -16,9 +16,50 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
+import datetime
+import json
+import threading
+
+from decimal import Decimal
+from StringIO import StringIO
+
 from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core import mail
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.mail.backends import locmem
+from django.core.management import call_command
+from django.db import connection
+from django.db.models.fields import FieldDoesNotExist
+from django.dispatch import Signal
+from django.template import Template
+from django.utils import translation
+
+from shopkit.core import listeners
+from shopkit.core.context_processors import cart as cart_context
+from shopkit.core.utils import get_model_from_string, get_cart_from_request
+from shopkit.core.exceptions import AlreadyConfirmedException
+from shopkit.core.signals import order_state_change
+from shopkit.core.export import iter_orders, write_jsonl
+from shopkit.core.archive import archive_orders
+from shopkit.core.models import CustomerStatsMixin, SummarizedCartMixin
+from shopkit.core.settings import CART_ACTIVITY_FIELD
+from shopkit.core.snapshots import CartSnapshot, bump_cart_version, \
+                                   snapshots_enabled, get_cart_summary
+from shopkit.core.basemodels import SequenceNumberedOrderBase
+from shopkit.core.utils.numbering import NumberBlockAllocator
+from shopkit.core.listeners import EmailBatch, StateChangeListener, \
+                                   StateChangeRegistry, CustomerStatsListener, \
+                                   EmailingListener
+
+
+class FailingEmailBackend(locmem.EmailBackend):
+    """ Email backend failing to send any message. """
 
-from shopkit.core.utils import get_model_from_string
+    def send_messages(self, messages):
+        raise IOError('Connection refused')
 
 
 class CoreTestMixin(object):
@@ -61,6 +102,15 @@ class CoreTestMixin(object):
         """
         raise NotImplementedError
 
+    def make_customer(self):
+        """
+        Abstract function for creating an unsaved test customer. As the
+        actual properties of customers depend on the classes implementing
+        them, this function must be overridden in subclasses keeping
+        customer statistics.
+        """
+        raise NotImplementedError
+
     def test_basic_product(self):
         """ Test if we can create and save a simple product. """
         
@@ -88,6 +138,286 @@ class CoreTestMixin(object):
         """
         pass
     
+    def test_cart_item_prices(self):
+        """
+        Make sure pricing all items of a cart in one pass yields the same
+        prices as pricing them one by one.
+        """
+        cart = self.cart_class()
+        cart.save()
+
+        for quantity in (1, 3):
+            p = self.make_product()
+            p.save()
+
+            cart.add_item(p, quantity)
+
+        item_prices = cart.get_item_prices()
+        self.assertEqual(len(item_prices), 2)
+
+        total = Decimal('0.0')
+        for (cartitem, piece_price, total_price) in item_prices:
+            self.assertEqual(piece_price,
+                cartitem.product.get_price(quantity=cartitem.quantity))
+            self.assertEqual(total_price, cartitem.quantity*piece_price)
+
+            total += total_price
+
+        self.assertEqual(cart.get_total_price(), total)
+
+    def test_cart_add_items(self):
+        """
+        Add several products to a cart at once, some of which are already
+        in the cart.
+        """
+        cart = self.cart_class()
+        cart.save()
+
+        products = []
+        for i in range(3):
+            p = self.make_product()
+            p.save()
+
+            products.append(p)
+
+        cart.add_item(products[0], 2)
+
+        cart.add_items([(products[0], 1),
+                        (products[1], 2, {}),
+                        (products[2], 1),
+                        (products[2], 3)])
+
+        quantities = dict((cartitem.product_id, cartitem.quantity) \
+                          for cartitem in cart.get_items())
+
+        self.assertEqual(quantities, {products[0].pk: 3,
+                                      products[1].pk: 2,
+                                      products[2].pk: 4})
+        self.assertEqual(cart.get_total_items(), 9)
+
+    def test_cart_summary(self):
+        """
+        Change the items of a cart with a persistent summary in every
+        possible way, making sure the incrementally updated summary matches
+        a full recalculation after each change.
+        """
+        if not issubclass(self.cart_class, SummarizedCartMixin):
+            return
+
+        def assert_summary(cart):
+            stored = self.cart_class.objects.get(pk=cart.pk)
+
+            total_items = 0
+            total_price = Decimal('0.00')
+            for (cartitem, piece_price, price) in stored.get_item_prices():
+                total_items += cartitem.quantity
+                total_price += price
+
+            self.assertEqual(stored.get_total_items(), total_items)
+            self.assertEqual(stored.get_total_price(), total_price)
+
+            # The instance used should be kept up to date as well
+            self.assertEqual(cart.get_total_items(), total_items)
+            self.assertEqual(cart.get_total_price(), total_price)
+
+        cart = self.cart_class()
+        cart.save()
+
+        products = []
+        for i in range(3):
+            p = self.make_product()
+            p.save()
+
+            products.append(p)
+
+        # Saving a new item
+        cartitem = cart.get_item(products[0])
+        cartitem.quantity = 3
+        cartitem.save()
+        assert_summary(cart)
+
+        # Raising the quantity in the database, calling quantity_added()
+        cart.add_item(products[0], 2)
+        assert_summary(cart)
+
+        cart.add_item(products[1], 1)
+        assert_summary(cart)
+
+        # Saving a lower quantity
+        cartitem = cart.get_item(products[0], create=False)
+        cartitem.quantity = 1
+        cartitem.save()
+        assert_summary(cart)
+
+        # Deleting an item
+        self.assert_(cart.remove_item(products[1]))
+        assert_summary(cart)
+
+        # Adding in bulk, recalculating the summary afterwards
+        cart.add_items([(products[0], 2), (products[2], 4)])
+        assert_summary(cart)
+
+        # Nothing changed since
+        self.assertEqual(self.cart_class.update_summaries(), 0)
+
+        self.cart_class.objects.filter(pk=cart.pk).update(
+            total_items=0, total_price=Decimal('0.00'))
+
+        self.assertEqual(self.cart_class.update_summaries(), 1)
+        assert_summary(cart)
+
+        self.cart_class.objects.filter(pk=cart.pk).update(
+            total_items=0, total_price=Decimal('0.00'))
+
+        call_command('updatecartsummaries', verbosity=0)
+        assert_summary(cart)
+
+    def test_cart_purge(self):
+        """
+        Make sure changing the items of a cart marks it as active, and that
+        only carts without recent activity are purged.
+        """
+        try:
+            self.cart_class._meta.get_field(CART_ACTIVITY_FIELD)
+        except FieldDoesNotExist:
+            return
+
+        now = datetime.datetime.now()
+        inactive = {CART_ACTIVITY_FIELD: now - datetime.timedelta(days=60)}
+        before = now - datetime.timedelta(days=30)
+
+        def is_abandoned(cart):
+            return self.cart_class.get_abandoned(before).filter(
+                pk=cart.pk).exists()
+
+        p = self.make_product()
+        p.save()
+
+        cart = self.cart_class()
+        cart.save()
+
+        abandoned = self.cart_class()
+        abandoned.save()
+        abandoned.add_item(p, 1)
+
+        self.cart_class.objects.update(**inactive)
+        self.assert_(is_abandoned(cart))
+
+        cart.add_item(p, 1)
+        self.assertFalse(is_abandoned(cart))
+
+        self.cart_class.objects.filter(pk=cart.pk).update(**inactive)
+
+        cart.add_item(p, 2)
+        self.assertFalse(is_abandoned(cart))
+
+        self.cart_class.objects.filter(pk=cart.pk).update(**inactive)
+
+        cart.add_items([(p, 1)])
+        self.assertFalse(is_abandoned(cart))
+
+        self.assert_(is_abandoned(abandoned))
+
+        call_command('purgecarts', verbosity=0)
+
+        self.assert_(self.cart_class.objects.filter(pk=cart.pk).exists())
+        self.assertEqual(cart.get_total_items(), 4)
+        self.assertFalse(
+            self.cart_class.objects.filter(pk=abandoned.pk).exists())
+
+    def test_cart_from_request(self):
+        """
+        Get the cart for a request from views and the context processor,
+        making sure it is fetched only once and only when it is used.
+        """
+        class Request(object):
+            def __init__(self, session):
+                self.session = session
+                self.user = AnonymousUser()
+
+        cart = self.cart_class()
+        cart.save()
+
+        request = Request({'cart_pk': cart.pk})
+
+        # The context processor does not fetch the cart by itself
+        with self.assertNumQueries(0):
+            context = cart_context(request)
+
+        self.assertFalse(hasattr(request, '_shopkit_cart'))
+
+        self.assertEqual(context['cart'].pk, cart.pk)
+
+        # Views get the very same instance, without querying again
+        with self.assertNumQueries(0):
+            shared = get_cart_from_request(request)
+
+            context = cart_context(request)
+            self.assertEqual(context['cart'].pk, cart.pk)
+
+        self.assert_(shared is request._shopkit_cart)
+        self.assertEqual(shared.pk, cart.pk)
+
+        # Without a cart in the session, a new one is made
+        request = Request({})
+        self.assertEqual(get_cart_from_request(request).pk, None)
+
+    def test_cart_snapshot(self):
+        """
+        Store a snapshot of a cart in the session, making sure it matches
+        the cart and becomes stale once the cart changes.
+        """
+        if isinstance(cache, (LocMemCache, DummyCache)):
+            self.assertFalse(snapshots_enabled())
+
+        # Versions cannot be kept without a cache
+        if isinstance(cache, DummyCache):
+            return
+
+        class Request(object):
+            def __init__(self):
+                self.session = {}
+
+        p = self.make_product()
+        p.save()
+
+        cart = self.cart_class()
+        cart.save()
+        cart.add_item(p, 2)
+
+        request = Request()
+        request.session['cart_pk'] = cart.pk
+
+        CartSnapshot.from_cart(cart).to_request(request)
+
+        snapshot = CartSnapshot.from_request(request)
+        self.assert_(snapshot)
+        self.assertEqual(snapshot.get_items(), [(p.pk, 2)])
+        self.assertEqual(snapshot.get_total_items(), 2)
+        self.assertEqual(snapshot.get_total_price(), cart.get_total_price())
+
+        if snapshots_enabled():
+            self.assert_(isinstance(get_cart_summary(request), CartSnapshot))
+
+        cart.add_item(p, 1)
+
+        if not snapshots_enabled():
+            # Without a shared cache, changes are not tracked
+            self.assert_(CartSnapshot.from_request(request))
+
+            bump_cart_version(cart.pk)
+
+        self.assertEqual(CartSnapshot.from_request(request), None)
+
+        # The summary falls back to the cart itself
+        summary = get_cart_summary(request)
+        self.assertFalse(isinstance(summary, CartSnapshot))
+        self.assertEqual(summary.get_total_items(), 3)
+
+        # Snapshots of other carts are not used
+        request.session['cart_pk'] = cart.pk + 1
+        self.assertEqual(CartSnapshot.from_request(request), None)
+
     def test_order(self):
         """
         Create an order on the basis of a shopping cart and a customer
@@ -95,9 +425,688 @@ class CoreTestMixin(object):
         """
         pass
     
+    def test_order_from_cart(self):
+        """
+        Create an order from a shopping cart, making sure all items are
+        copied along with their prices.
+        """
+        cart = self.cart_class()
+        cart.save()
+
+        for quantity in (1, 2, 3):
+            p = self.make_product()
+            p.save()
+
+            cart.add_item(p, quantity)
+
+        total_price = cart.get_total_price()
+
+        order = self.order_class.from_cart(cart)
+
+        self.assertEqual(order.get_items().count(), 3)
+        self.assertEqual(order.get_total_items(), 6)
+        self.assertEqual(order.get_total_price(), total_price)
+
+    def test_order_with_totals(self):
+        """
+        Annotate orders with their totals, making sure they match the
+        totals calculated from the items.
+        """
+        cart = self.cart_class()
+        cart.save()
+
+        for quantity in (1, 2, 3):
+            p = self.make_product()
+            p.save()
+
+            cart.add_item(p, quantity)
+
+        order = self.order_class.from_cart(cart)
+        total_price = order.get_total_price()
+
+        empty_order = self.order_class()
+        empty_order.save()
+
+        orders = self.order_class.objects.with_totals().order_by('pk')
+        self.assertEqual(list(orders), [order, empty_order])
+
+        self.assertEqual(orders[0].get_total_items(), 6)
+        self.assertEqual(orders[0].get_total_price(), total_price)
+
+        self.assertEqual(orders[1].get_total_items(), 0)
+        self.assertEqual(orders[1].get_total_price(), Decimal('0.00'))
+
+    def test_order_export(self):
+        """
+        Export orders in chunks, making sure items and state changes are
+        included and the export can be resumed.
+        """
+        orders = []
+        for quantity in (1, 2, 3):
+            cart = self.cart_class()
+            cart.save()
+
+            p = self.make_product()
+            p.save()
+
+            cart.add_item(p, quantity)
+
+            orders.append(self.order_class.from_cart(cart))
+
+        stream = StringIO()
+        last_pk = write_jsonl(iter_orders(chunk_size=2), stream)
+
+        self.assertEqual(last_pk, orders[-1].pk)
+
+        exported = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([order['id'] for order in exported],
+                         [order.pk for order in orders])
+
+        for (order, quantity) in zip(exported, (1, 2, 3)):
+            self.assertEqual(len(order['items']), 1)
+            self.assertEqual(order['items'][0]['quantity'], quantity)
+            self.assert_(order['state_changes'])
+
+        # Resume after the first order
+        resumed = list(iter_orders(after=orders[0].pk))
+        self.assertEqual([order['id'] for order in resumed],
+                         [order.pk for order in orders[1:]])
+
+    def test_order_archive(self):
+        """
+        Archive a confirmed order, making sure it is removed and can be
+        loaded from the archive along with its items.
+        """
+        if not getattr(settings, 'SHOPKIT_ARCHIVED_ORDER_MODEL', None) or \
+                not getattr(settings, 'SHOPKIT_ORDER_ARCHIVE_PATH', None):
+            return
+
+        archived_order_class = \
+            get_model_from_string(settings.SHOPKIT_ARCHIVED_ORDER_MODEL)
+
+        cart = self.cart_class()
+        cart.save()
+
+        p = self.make_product()
+        p.save()
+
+        cart.add_item(p, 2)
+
+        order = self.order_class.from_cart(cart)
+        total_price = order.get_total_price()
+
+        unconfirmed = self.order_class.from_cart(cart)
+
+        order.confirmed = True
+        order.save()
+
+        event_model = getattr(settings, 'SHOPKIT_ORDERSTATE_EVENT_MODEL', None)
+        if event_model:
+            event_class = get_model_from_string(event_model)
+
+            # Processed events are removed along with the order
+            for event in event_class.objects.filter(order=order):
+                event.mark_processed()
+
+            # Pending events would be lost, so this order is skipped
+            pending = self.order_class.from_cart(cart)
+            pending.confirmed = True
+            pending.save()
+
+            skipped = [pending.pk]
+        else:
+            skipped = []
+
+        before = datetime.datetime.now() + datetime.timedelta(days=1)
+        self.assertEqual(archive_orders(before), (1, skipped))
+
+        self.assertFalse(self.order_class.objects.filter(pk=order.pk).exists())
+        self.assert_(self.order_class.objects.filter(pk=unconfirmed.pk).exists())
+
+        for pk in skipped:
+            self.assert_(self.order_class.objects.filter(pk=pk).exists())
+            self.assertFalse(
+                archived_order_class.objects.filter(order_pk=pk).exists()
+            )
+
+        archived_order = archived_order_class.objects.get(order_pk=order.pk)
+        self.assertEqual(archived_order.get_total_items(), 2)
+        self.assertEqual(archived_order.get_total_price(), total_price)
+
+        loaded = archived_order.load()
+        self.assertEqual(loaded['id'], order.pk)
+        self.assertEqual(len(loaded['items']), 1)
+        self.assert_(loaded['state_changes'])
+
+    def test_order_process_confirm(self):
+        """
+        Confirm an order through the confirmation pipeline, making sure it
+        cannot be confirmed twice.
+        """
+        cart = self.cart_class()
+        cart.save()
+
+        p = self.make_product()
+        p.save()
+
+        cart.add_item(p, 2)
+
+        order = self.order_class.from_cart(cart)
+        order.process_confirm()
+
+        order = self.order_class.objects.get(pk=order.pk)
+        self.assert_(order.confirmed)
+        self.assertFalse(order.cart)
+        self.assertFalse(self.cart_class.objects.filter(pk=cart.pk).exists())
+
+        self.assertRaises(AlreadyConfirmedException, order.process_confirm)
+
+    def test_customer_stats(self):
+        """
+        Place orders for a customer, making sure the statistics are updated
+        by `update_stats()`, `CustomerStatsListener` and the
+        `updatecustomerstats` command.
+        """
+        if not issubclass(self.customer_class, CustomerStatsMixin):
+            return
+
+        customer = self.make_customer()
+        customer.save()
+
+        cart = self.cart_class()
+        cart.save()
+
+        p = self.make_product()
+        p.save()
+
+        cart.add_item(p, 2)
+
+        order = self.order_class.from_cart(cart)
+        order.customer = customer
+        order.confirmed = True
+        order.save()
+
+        unconfirmed = self.order_class(customer=customer)
+        unconfirmed.save()
+
+        self.customer_class.update_stats(
+            self.customer_class.objects.filter(pk=customer.pk))
+
+        customer = self.customer_class.objects.get(pk=customer.pk)
+        self.assertEqual(customer.order_count, 1)
+        self.assertEqual(customer.lifetime_value, order.get_total_price())
+        self.assertEqual(customer.first_order_date, order.date_added)
+        self.assertEqual(customer.last_order_date, order.date_added)
+
+        # Nothing changed, so nothing should be updated
+        self.assertEqual(self.customer_class.update_stats(
+            self.customer_class.objects.filter(pk=customer.pk)), 0)
+
+        # Confirming another order is picked up by the listener
+        unconfirmed.confirmed = True
+        unconfirmed.save()
+
+        states = [state for (state, name) in settings.SHOPKIT_ORDER_STATES]
+
+        registry = StateChangeRegistry(signal=Signal())
+        registry.register(CustomerStatsListener)
+        registry.signal.send(sender=unconfirmed, old_state=states[0],
+                             new_state=states[1], state_change=None)
+
+        customer = self.customer_class.objects.get(pk=customer.pk)
+        self.assertEqual(customer.order_count, 2)
+        self.assertEqual(customer.last_order_date, unconfirmed.date_added)
+
+        # The command recalculates the statistics of all customers
+        self.customer_class.objects.filter(pk=customer.pk).update(
+            order_count=0, lifetime_value=Decimal('0.00'))
+
+        call_command('updatecustomerstats', verbosity=0)
+
+        customer = self.customer_class.objects.get(pk=customer.pk)
+        self.assertEqual(customer.order_count, 2)
+        self.assertEqual(customer.lifetime_value, order.get_total_price())
+
+        # Archived orders are still included
+        if not getattr(settings, 'SHOPKIT_ARCHIVED_ORDER_MODEL', None):
+            return
+
+        archived_order_class = \
+            get_model_from_string(settings.SHOPKIT_ARCHIVED_ORDER_MODEL)
+
+        archived_date = order.date_added - datetime.timedelta(days=10)
+        archived_order_class(order_pk=unconfirmed.pk + 1000,
+                             customer_pk=customer.pk,
+                             state=order.state,
+                             date_added=archived_date,
+                             total_price=Decimal('10.00'),
+                             archive='test.jsonl', line=0).save()
+
+        customer.update_customer_stats()
+
+        self.assertEqual(customer.order_count, 3)
+        self.assertEqual(customer.lifetime_value,
+                         order.get_total_price() + Decimal('10.00'))
+        self.assertEqual(customer.first_order_date, archived_date)
+
+    def test_number_sequence(self):
+        """
+        Allocate numbers from a number sequence, directly and in blocks,
+        making sure they are unique and increasing.
+        """
+        if not getattr(settings, 'SHOPKIT_NUMBER_SEQUENCE_MODEL', None):
+            return
+
+        sequence_class = \
+            get_model_from_string(settings.SHOPKIT_NUMBER_SEQUENCE_MODEL)
+
+        first = sequence_class.next_value('test')
+        self.assertEqual(sequence_class.next_value('test', 5), first + 5)
+        self.assertEqual(sequence_class.next_value('test'), first + 6)
+
+        allocator = NumberBlockAllocator('test-block', 3)
+        numbers = [allocator.allocate(sequence_class) for i in range(7)]
+
+        self.assertEqual(numbers, sorted(set(numbers)))
+
+        # Blocks and single numbers come from the same sequence
+        self.assert_(sequence_class.next_value('test-block') > numbers[-1])
+
+    def test_sequence_numbered_order(self):
+        """
+        Save and confirm orders numbered from number sequences, making sure
+        order and invoice numbers are unique.
+        """
+        if not issubclass(self.order_class, SequenceNumberedOrderBase):
+            return
+
+        orders = []
+        for i in range(3):
+            cart = self.cart_class()
+            cart.save()
+
+            p = self.make_product()
+            p.save()
+
+            cart.add_item(p, 1)
+
+            order = self.order_class.from_cart(cart)
+            order.process_confirm()
+
+            orders.append(self.order_class.objects.get(pk=order.pk))
+
+        order_numbers = [order.order_number for order in orders]
+        self.assertEqual(len(set(order_numbers)), 3)
+
+        invoice_numbers = [order.invoice_number for order in orders]
+        self.assert_(all(invoice_numbers))
+        self.assertEqual(len(set(invoice_numbers)), 3)
+
     def test_orderstate_change_tracking(self):
         """
         Change the state of an order, see if the state change gets logged.
         """
-        pass
+        statechange_class = \
+            get_model_from_string(settings.SHOPKIT_ORDERSTATE_CHANGE_MODEL)
+
+        order = self.order_class()
+        order.save()
+
+        changes = statechange_class.objects.filter(order=order)
+        self.assertEqual(changes.count(), 1)
+
+        # Saving without changing the state should not log anything
+        order.save()
+        self.assertEqual(changes.count(), 1)
+
+        order = self.order_class.objects.get(pk=order.pk)
+        order.state = settings.SHOPKIT_ORDER_STATES[1][0]
+        order.save()
+
+        self.assertEqual(changes.count(), 2)
+        self.assertEqual(statechange_class.get_latest(order).state,
+                         order.state)
+
+    def test_orderstate_events(self):
+        """
+        Change the state of an order with an outbox for state changes, see
+        if the listeners are only called by the `processorderevents` command
+        and if failing listeners are retried.
+        """
+        if not getattr(settings, 'SHOPKIT_ORDERSTATE_EVENT_MODEL', None):
+            return
+
+        event_class = \
+            get_model_from_string(settings.SHOPKIT_ORDERSTATE_EVENT_MODEL)
+
+        calls = []
+
+        def listener(sender, new_state, **kwargs):
+            calls.append(new_state)
+
+            # Fail on the first attempt
+            if len(calls) == 1:
+                raise Exception('Temporary failure')
+
+            mail.send_mail('State change', 'New state: %s' % new_state,
+                           None, ['customer@example.com'])
+
+        order_state_change.connect(listener)
+
+        try:
+            order = self.order_class()
+            order.save()
+
+            # Nothing should have been sent yet
+            self.assertEqual(calls, [])
+            self.assertEqual(len(mail.outbox), 0)
+
+            event = event_class.objects.get(order=order)
+            self.assertEqual(event.new_state, order.state)
+
+            call_command('processorderevents', verbosity=0)
+
+            event = event_class.objects.get(pk=event.pk)
+            self.assertEqual(event.attempts, 1)
+            self.assertFalse(event.processed)
+            self.assert_(event.last_error)
+            self.assertEqual(len(mail.outbox), 0)
+
+            call_command('processorderevents', verbosity=0)
+
+            event = event_class.objects.get(pk=event.pk)
+            self.assertEqual(event.attempts, 2)
+            self.assert_(event.processed)
+            self.assertEqual(len(mail.outbox), 1)
+
+            # Processed events should not be processed again
+            call_command('processorderevents', verbosity=0)
+            self.assertEqual(len(calls), 2)
+
+        finally:
+            order_state_change.disconnect(listener)
+
+    def test_orderstate_event_claim(self):
+        """
+        Claim an event from several workers, making sure it is only claimed
+        by one of them until the claim expires.
+        """
+        if not getattr(settings, 'SHOPKIT_ORDERSTATE_EVENT_MODEL', None):
+            return
+
+        event_class = \
+            get_model_from_string(settings.SHOPKIT_ORDERSTATE_EVENT_MODEL)
+
+        order = self.order_class()
+        order.save()
+
+        event = event_class.objects.get(order=order)
+        self.assert_(event.claim())
+
+        # Another worker fetching the event after it has been claimed
+        other = event_class.objects.get(pk=event.pk)
+        self.assertFalse(other.claim())
+        self.assertFalse(event_class.get_pending().filter(pk=event.pk))
+
+        # Expired claims can be taken over
+        event_class.objects.filter(pk=event.pk).update(
+            claimed_until=datetime.datetime.now() - \
+                          datetime.timedelta(seconds=1))
+
+        other = event_class.objects.get(pk=event.pk)
+        self.assert_(other.claim())
+        self.assertEqual(other.attempts, 2)
+
+    def test_orderstate_events_batch_emails(self):
+        """
+        Process events with `--batch-emails`, see if events are only marked
+        processed once their messages have been sent.
+        """
+        if not getattr(settings, 'SHOPKIT_ORDERSTATE_EVENT_MODEL', None):
+            return
+
+        event_class = \
+            get_model_from_string(settings.SHOPKIT_ORDERSTATE_EVENT_MODEL)
+
+        def listener(sender, new_state, **kwargs):
+            EmailBatch.get_active().add(
+                mail.EmailMessage('State change', 'New state: %s' % new_state,
+                                  None, ['customer@example.com']))
+
+        order_state_change.connect(listener)
+
+        email_backend = settings.EMAIL_BACKEND
+        settings.EMAIL_BACKEND = 'shopkit.core.tests.FailingEmailBackend'
+
+        try:
+            order = self.order_class()
+            order.save()
+
+            call_command('processorderevents', verbosity=0,
+                         batch_emails=True)
+
+            # Sending failed, so the event should be retried
+            event = event_class.objects.get(order=order)
+            self.assertEqual(event.attempts, 1)
+            self.assertFalse(event.processed)
+            self.assert_('Connection refused' in event.last_error)
+            self.assertEqual(len(mail.outbox), 0)
+
+            settings.EMAIL_BACKEND = email_backend
+
+            call_command('processorderevents', verbosity=0,
+                         batch_emails=True)
+
+            event = event_class.objects.get(pk=event.pk)
+            self.assertEqual(event.attempts, 2)
+            self.assert_(event.processed)
+            self.assertEqual(event.last_error, '')
+            self.assertEqual(len(mail.outbox), 1)
+
+        finally:
+            settings.EMAIL_BACKEND = email_backend
+            order_state_change.disconnect(listener)
+
+    def test_email_batch(self):
+        """ Send messages in batches over a single connection. """
+        def make_message(number):
+            return mail.EmailMessage('Message %d' % number, 'Body',
+                                     None, ['customer@example.com'])
+
+        with EmailBatch(batch_size=2) as batch:
+            self.assertEqual(EmailBatch.get_active(), batch)
+
+            batch.add(make_message(1))
+            self.assertEqual(len(mail.outbox), 0)
+
+            batch.add(make_message(2))
+            self.assertEqual(len(mail.outbox), 2)
+
+            batch.add(make_message(3))
+            self.assertEqual(len(mail.outbox), 2)
+
+        self.assertEqual(EmailBatch.get_active(), None)
+        self.assertEqual(len(mail.outbox), 3)
+
+        # Messages are kept when sending fails
+        batch = EmailBatch(batch_size=1, connection=FailingEmailBackend())
+        self.assertRaises(IOError, batch.add, make_message(4))
+        self.assertEqual(len(batch.messages), 1)
+
+        # Messages are discarded when an exception occurs
+        try:
+            with EmailBatch() as batch:
+                batch.add(make_message(4))
+
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_email_template_cache(self):
+        """
+        Render messages with an emailing listener, making sure templates are
+        only compiled once for every language.
+        """
+        class TestListener(EmailingListener):
+            _template_cache = {}
+
+        compiled = []
+
+        def select_template(template_names):
+            compiled.append(tuple(template_names))
+            return Template(u'{{ value }}')
+
+        original_select_template = listeners.select_template
+        original_debug = settings.DEBUG
+
+        listeners.select_template = select_template
+        settings.DEBUG = False
+
+        translation.activate('en')
+        try:
+            listener = TestListener()
+            names = ['test_subject.txt']
+
+            self.assertEqual(listener.render_template(names, {'value': 1}),
+                             u'1')
+            self.assertEqual(listener.render_template(names, {'value': 2}),
+                             u'2')
+            self.assertEqual(compiled, [('test_subject.txt', )])
+
+            # Every language has its own templates
+            translation.activate('nl')
+
+            listener.render_template(names, {'value': 3})
+            listener.render_template(names, {'value': 4})
+            self.assertEqual(len(compiled), 2)
+
+            # Templates are not cached in debug mode
+            settings.DEBUG = True
+            listener.render_template(names, {'value': 5})
+            self.assertEqual(len(compiled), 3)
+
+        finally:
+            translation.deactivate()
+
+            listeners.select_template = original_select_template
+            settings.DEBUG = original_debug
+
+    def test_state_change_registry(self):
+        """
+        Register listeners for different state changes, see if only the
+        matching ones are instantiated and called.
+        """
+        states = [state for (state, name) in settings.SHOPKIT_ORDER_STATES]
+        calls = []
+
+        class RecordingListener(StateChangeListener):
+            def __init__(self, **kwargs):
+                super(RecordingListener, self).__init__(**kwargs)
+                calls.append(self.name)
+
+            def handler(self, sender, **kwargs):
+                pass
+
+        class NewListener(RecordingListener):
+            name = 'new'
+            new_state = states[1]
+
+        class ChangeListener(RecordingListener):
+            name = 'change'
+            old_state = states[1]
+            new_state = states[2]
+
+        class AnyListener(RecordingListener):
+            name = 'any'
+
+        registry = StateChangeRegistry(signal=Signal())
+        registry.register(NewListener)
+        registry.register(ChangeListener)
+        registry.register(AnyListener)
+
+        registry.signal.send(sender=None, old_state=None,
+                             new_state=states[1], state_change=None)
+        self.assertEqual(calls, ['new', 'any'])
+
+        calls = []
+        registry.signal.send(sender=None, old_state=states[1],
+                             new_state=states[2], state_change=None)
+        self.assertEqual(calls, ['change', 'any'])
+
+        calls = []
+        registry.signal.send(sender=None, old_state=states[2],
+                             new_state=states[1], state_change=None)
+        self.assertEqual(calls, ['new', 'any'])
+
+
+class CoreTransactionTestMixin(object):
+    """
+    Base class for testing core webshop functionality using several
+    database connections at once. As data should be committed in order to
+    be visible to other connections, this class should be combined with
+    `TransactionTestCase` rather than `TestCase`. Like
+    :class:`CoreTestMixin`, it should be subclassed, overriding
+    `make_product()`.
+    """
+
+    def setUp(self):
+        """
+        This makes the cart class from `SHOPKIT_CART_MODEL` available as
+        `self.cart_class`.
+        """
+        super(CoreTransactionTestMixin, self).setUp()
+
+        self.cart_class = \
+            get_model_from_string(settings.SHOPKIT_CART_MODEL)
+
+    def make_product(self):
+        """
+        Abstract function for creating a test product, see
+        :meth:`CoreTestMixin.make_product`.
+        """
+        raise NotImplementedError
+
+    def test_cart_add_item_concurrency(self):
+        """
+        Add the same product to a cart from many threads at the same time,
+        making sure no additions get lost.
+        """
+        # SQLite locks the whole database, and in-memory test databases
+        # are not shared between connections
+        if getattr(connection, 'vendor', None) == 'sqlite':
+            self.skipTest('Concurrent connections are not supported by '
+                          'SQLite.')
+
+        cart = self.cart_class()
+        cart.save()
+
+        p = self.make_product()
+        p.save()
+
+        errors = []
+
+        def add_items():
+            try:
+                thread_cart = self.cart_class.objects.get(pk=cart.pk)
+
+                for i in range(5):
+                    thread_cart.add_item(p, 1)
+
+            except Exception as e:
+                errors.append(e)
+
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=add_items) for i in range(10)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
 
+        self.assertFalse(errors, errors)
+        self.assertEqual(cart.get_items().get().quantity, 50)
@@ -19,7 +19,10 @@
 import logging
 logger = logging.getLogger(__name__)
 
-from django.db import models
+from contextlib import contextmanager
+
+from django.db import models, connections, transaction, IntegrityError, \
+                      DEFAULT_DB_ALIAS
 
 from shopkit.core.settings import CART_MODEL
 
@@ -39,4 +42,183 @@ def get_model_from_string(model):
     assert isinstance(model_class, models.base.ModelBase), \
         '%s does not refer to a known Model class.' % model
 
-    return model_class
\ No newline at end of file
+    return model_class
+
+
+@contextmanager
+def transaction_or_savepoint(using=DEFAULT_DB_ALIAS):
+    """
+    Context manager running a block of code atomically: within its own
+    transaction when no transaction is being managed, or within a
+    savepoint of the managed transaction otherwise. Unlike
+    `transaction.commit_on_success()`, this never commits a transaction
+    managed by the caller.
+    """
+    if not transaction.is_managed(using=using):
+        with transaction.commit_on_success(using=using):
+            yield
+
+        return
+
+    sid = transaction.savepoint(using=using)
+    try:
+        yield
+    except:
+        transaction.savepoint_rollback(sid, using=using)
+        raise
+    else:
+        transaction.savepoint_commit(sid, using=using)
+
+
+def supports_upsert(using=DEFAULT_DB_ALIAS):
+    """
+    Whether the database supports `INSERT ... ON CONFLICT DO UPDATE`
+    queries, as PostgreSQL does from version 9.5 on.
+    """
+    connection = connections[using]
+
+    if getattr(connection, 'vendor', None) != 'postgresql':
+        return False
+
+    # The version of the server as an integer, such as 90500, as reported
+    # by the underlying psycopg2 connection
+    version = getattr(connection.cursor().connection, 'server_version', 0)
+
+    return version >= 90500
+
+
+def upsert_increment(obj, unique_fields, increments, using=DEFAULT_DB_ALIAS):
+    """
+    Insert `obj` into the database or, when a row with the same values for
+    `unique_fields` already exists, raise the fields in `increments` of that
+    row by the given amounts. This is done with a single
+    `INSERT ... ON CONFLICT` query, which should only be used when
+    :func:`supports_upsert` says so.
+
+    The primary key and the resulting values for the fields in `increments`
+    are set on `obj`. Note that `save()` is not called.
+
+    :returns: `True` when `obj` was inserted, `False` when a row was updated
+    """
+    connection = connections[using]
+
+    opts = obj._meta
+    qn = connection.ops.quote_name
+
+    for (name, value) in increments.iteritems():
+        setattr(obj, name, value)
+
+    fields = [f for f in opts.local_fields \
+                if not isinstance(f, models.AutoField)]
+    increment_fields = [opts.get_field(name) for name in increments]
+
+    sql = 'INSERT INTO %(table)s (%(columns)s) VALUES (%(values)s) ' \
+          'ON CONFLICT (%(unique)s) DO UPDATE SET %(updates)s ' \
+          'RETURNING %(returning)s, (xmax = 0)' % {
+        'table': qn(opts.db_table),
+        'columns': ', '.join([qn(f.column) for f in fields]),
+        'values': ', '.join(['%s'] * len(fields)),
+        'unique': ', '.join([qn(opts.get_field(name).column) \
+                             for name in unique_fields]),
+        'updates': ', '.join(['%(column)s = %(table)s.%(column)s + EXCLUDED.%(column)s' % \
+                              {'table': qn(opts.db_table),
+                               'column': qn(f.column)} \
+                              for f in increment_fields]),
+        'returning': ', '.join([qn(f.column) for f in \
+                                [opts.pk] + increment_fields])
+    }
+
+    params = [f.get_db_prep_save(f.pre_save(obj, True), connection=connection) \
+                for f in fields]
+
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    row = cursor.fetchone()
+
+    transaction.commit_unless_managed(using=using)
+
+    setattr(obj, opts.pk.attname, row[0])
+    for (f, value) in zip(increment_fields, row[1:-1]):
+        setattr(obj, f.attname, value)
+
+    logger.debug(u'Upserted %s with pk %s', opts.object_name, row[0])
+
+    return row[-1]
+
+
+def increment_or_create(model_class, lookup, increments, defaults=None,
+                        using=DEFAULT_DB_ALIAS):
+    """
+    Raise the fields in `increments` by the given amounts for the object
+    matching `lookup`, using a single F() based `UPDATE` query, without
+    reading the object first. When no such object exists, it is created with
+    the values from `lookup`, `defaults` and `increments`.
+
+    Creation happens within a savepoint: when it fails because a
+    concurrent request created the object in the meanwhile, the update is
+    retried.
+
+    :returns:
+        `(obj, created)` tuple, where `obj` is the created object or `None`
+        when an existing object was updated.
+    """
+    updates = dict((name, models.F(name) + value) \
+                   for (name, value) in increments.iteritems())
+
+    objects = model_class.objects.using(using)
+
+    if objects.filter(**lookup).update(**updates):
+        return (None, False)
+
+    values = dict(defaults or {})
+    values.update(lookup)
+    values.update(increments)
+
+    obj = model_class(**values)
+
+    sid = transaction.savepoint(using=using)
+    try:
+        obj.save(force_insert=True, using=using)
+        transaction.savepoint_commit(sid, using=using)
+
+    except IntegrityError:
+        transaction.savepoint_rollback(sid, using=using)
+
+        logger.debug(u'%s created concurrently, retrying update.',
+                     model_class._meta.object_name)
+
+        if not objects.filter(**lookup).update(**updates):
+            raise
+
+        return (None, False)
+
+    return (obj, True)
+
+
+def bulk_create(model_class, objs):
+    """
+    Insert `objs`, unsaved instances of `model_class`, using a single query
+    where the version of Django supports `bulk_create()`, or by saving them
+    one by one otherwise. Note that the former neither sets the primary keys
+    of `objs` nor calls `save()` or sends signals.
+    """
+    if hasattr(model_class.objects, 'bulk_create'):
+        model_class.objects.bulk_create(objs)
+    else:
+        for obj in objs:
+            obj.save()
+
+
+def get_cart_from_request(request):
+    """
+    Get the shopping cart for the current request, as returned by
+    `from_request()` on the `Cart` model. The cart is stored on the request
+    so that views, context processors and forms all share a single
+    instance, which is only fetched once.
+    """
+    if not hasattr(request, '_shopkit_cart'):
+        cart_class = get_model_from_string(CART_MODEL)
+
+        request._shopkit_cart = cart_class.from_request(request)
+
+    return request._shopkit_cart
@@ -0,0 +1,141 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import threading
+
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+
+""" Allocation of numbers from number sequences in blocks. """
+
+
+def get_autocommit_alias(using=DEFAULT_DB_ALIAS):
+    """
+    Return the alias of a second connection to the database `using`, which
+    commits independently of the transaction of the current connection, or
+    `None` for SQLite, which does not allow writing from a second
+    connection while the first one is in a transaction.
+    """
+    connection = connections[using]
+
+    if getattr(connection, 'vendor', None) == 'sqlite':
+        return None
+
+    alias = '%s-numbering' % using
+
+    if not alias in connections.databases:
+        # Share the settings, so the name of a test database is followed
+        connections.databases[alias] = connection.settings_dict
+
+    return alias
+
+
+class NumberBlockAllocator(object):
+    """
+    Hands out numbers from blocks reserved in a number sequence, so that
+    the sequence, and thereby the database, is only accessed once every
+    `block_size` numbers. This makes sure allocating numbers does not
+    become a point of contention between concurrent requests.
+
+    Blocks are kept per process. Numbers are unique but not gap-free, as
+    the remainder of a block is lost when a process ends.
+    """
+
+    def __init__(self, name, block_size):
+        self.name = name
+        self.block_size = block_size
+
+        self.lock = threading.Lock()
+
+        self.pid = None
+        self.next_number = 0
+        self.last_number = -1
+
+    def reserve_block(self, sequence_class):
+        """
+        Reserve a new block in a transaction of its own, which is committed
+        right away. This way the sequence is only locked for the duration of
+        a single query and a block kept in memory is never rolled back along
+        with the transaction of the caller, which would make another process
+        reserve the same block. Within a managed transaction, the block is
+        reserved using a second connection, see
+        :func:`get_autocommit_alias`.
+
+        :returns: whether a block was reserved, which is not the case when
+                  a transaction is being managed and no second connection
+                  can be used
+        """
+        using = DEFAULT_DB_ALIAS
+
+        if transaction.is_managed(using=using):
+            using = get_autocommit_alias(using)
+
+            if not using:
+                return False
+
+        with transaction.commit_on_success(using=using):
+            last_number = sequence_class.next_value(self.name,
+                                                    self.block_size,
+                                                    using=using)
+
+        self.pid = os.getpid()
+        self.next_number = last_number - self.block_size + 1
+        self.last_number = last_number
+
+        logger.debug(u'Reserved numbers %d to %d from sequence %s',
+                     self.next_number, self.last_number, self.name)
+
+        return True
+
+    def allocate(self, sequence_class):
+        """
+        Get the next number, reserving a new block when necessary. When no
+        block can be reserved, a single number is allocated from the
+        sequence within the transaction of the caller instead.
+        """
+        with self.lock:
+            # Blocks should not be shared with forked processes
+            if self.pid != os.getpid() or self.next_number > self.last_number:
+                reserved = self.reserve_block(sequence_class)
+            else:
+                reserved = True
+
+            if reserved:
+                number = self.next_number
+                self.next_number += 1
+
+                return number
+
+        return sequence_class.next_value(self.name)
+
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+
+
+def get_allocator(name, block_size):
+    """ Get the allocator for the sequence `name` in this process. """
+    with _allocators_lock:
+        if not name in _allocators:
+            _allocators[name] = NumberBlockAllocator(name, block_size)
+
+        return _allocators[name]
@@ -0,0 +1,85 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import logging
+logger = logging.getLogger(__name__)
+
+from django.db import models
+
+
+class DeferredIncrements(object):
+    """
+    Collects increments of numeric fields for many objects, in order to
+    apply them later on with as few `UPDATE` queries as possible: one for
+    every combination of model, field and amount.
+
+    Usage::
+
+        increments = DeferredIncrements()
+
+        increments.add(Product, product.pk, 'stock', -2)
+        increments.add(Discount, [discount.pk], 'used', 1)
+
+        increments.apply()
+
+    """
+
+    def __init__(self):
+        self.increments = {}
+
+    def add(self, model_class, pks, field, amount):
+        """
+        Register raising `field` by `amount` for the objects of `model_class`
+        with the given primary key(s).
+        """
+        if not isinstance(pks, (list, tuple, set)):
+            pks = [pks]
+
+        amounts = self.increments.setdefault((model_class, field), {})
+
+        for pk in pks:
+            amounts[pk] = amounts.get(pk, 0) + amount
+
+    def apply(self):
+        """
+        Apply all registered increments, grouping objects by the amount by
+        which they are raised.
+
+        :returns: the amount of queries performed
+        """
+        queries = 0
+
+        for ((model_class, field), amounts) in self.increments.iteritems():
+            pks_by_amount = {}
+            for (pk, amount) in amounts.iteritems():
+                if amount:
+                    pks_by_amount.setdefault(amount, []).append(pk)
+
+            for (amount, pks) in pks_by_amount.iteritems():
+                logger.debug(u'Raising %s of %d %s objects by %s',
+                             field, len(pks),
+                             model_class._meta.object_name, amount)
+
+                model_class.objects.filter(pk__in=pks).update(
+                    **{field: models.F(field) + amount})
+
+                queries += 1
+
+        self.increments = {}
+
+        return queries
@@ -26,7 +26,7 @@ from django.contrib import messages
 
 from django.utils.translation import ugettext_lazy as _
 
-from shopkit.core.utils import get_model_from_string
+from shopkit.core.utils import get_cart_from_request
 
 from shopkit.core.settings import CART_MODEL
 from shopkit.core.forms import CartItemAddForm
@@ -145,11 +145,12 @@ class CartAddBase(TemplateResponseMixin, CartAddFormMixin, BaseFormView):
 
         self.object = cart.add_item(product, quantity)
 
-        # Make sure that we know whether we updated an existing item
-        updated = self.object.pk or False
+        # The item has been saved by add_item(), any quantity on top of
+        # the one we added means we updated an existing item.
+        updated = self.object.quantity > quantity
 
-        # After this, it will allways have a pk.
-        self.object.save()
+        # Store the cart, and possibly a fresh snapshot, in the session
+        cart.to_request(self.request)
 
         if updated:
             # Object updated
@@ -621,9 +621,19 @@ class AccountedUseDiscountMixin(models.Model):
     """ The number of times this discount has been used. """
 
     @classmethod
-    def register_use(cls, qs, count=1):
-        """ Register `count` uses of discounts in queryset `qs`. """
-        qs.update(used=models.F('used') + count)
+    def register_use(cls, qs, count=1, order=None):
+        """
+        Register `count` uses of discounts in queryset `qs`. When `order`
+        (or an order item) is given, the uses are registered through its
+        `register_increment()`, so they are applied in bulk at the end of
+        the order's confirmation. Otherwise they are applied right away.
+        """
+        if order is not None:
+            pks = list(qs.values_list('pk', flat=True))
+
+            order.register_increment(cls, pks, 'used', count)
+        else:
+            qs.update(used=models.F('used') + count)
 
 
 class LimitedUseDiscountMixin(AccountedUseDiscountMixin):
@@ -234,8 +234,8 @@ class AccountedDiscountedItemMixin(object):
 
         discounts = self.discounts.all()
 
-        # Register discount usage for order
-        discount_class.register_use(discounts)
+        # Register discount usage for order, in bulk where possible
+        discount_class.register_use(discounts, order=self)
 
 
 class DiscountCouponMixin(models.Model):
@@ -0,0 +1,152 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import logging
+logger = logging.getLogger(__name__)
+
+import threading
+import uuid
+
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.db import router, transaction
+
+from shopkit.price.advanced.settings import PRICE_CACHE_TIMEOUT
+from shopkit.price.advanced.signals import prices_changed
+
+
+"""
+Generations for cached prices.
+
+Cached prices are stored under keys containing the generation of the price
+model as a whole and the generation of their product, both kept in Django's
+cache framework. Changing prices replaces the generations concerned, so
+that cached prices of earlier generations are no longer used. Generations
+are read before prices are looked up, so that prices fetched while they
+were being changed are stored under an outdated generation.
+
+Prices are usually changed within a transaction, for example when using
+Django's `TransactionMiddleware`. Until that transaction commits, other
+processes still read the old prices and might cache them under the new
+generation. Generations replaced within a managed transaction are therefore
+replaced once more by :func:`invalidate_pending`, which is called when a
+request has finished. Code changing prices in transactions of its own
+outside of requests, such as management commands, should call it after
+committing; otherwise, outdated prices might be used for up to
+`SHOPKIT_PRICE_CACHE_TIMEOUT` seconds.
+"""
+
+_local = threading.local()
+
+
+def _get_model_label(model_class):
+    """ Label of a price model, used in cache keys. """
+    return '%s.%s' % (model_class._meta.app_label,
+                      model_class._meta.object_name.lower())
+
+
+def _get_generation_key(model_class, product_pk=None):
+    """
+    Cache key for the generation of prices of the product with the given
+    pk, or for all prices when no pk is given.
+    """
+    if product_pk is None:
+        return 'shopkit.price.%s.generation' % _get_model_label(model_class)
+
+    return 'shopkit.price.%s.%d.generation' % \
+        (_get_model_label(model_class), product_pk)
+
+
+def get_generations(model_class, product_pks):
+    """
+    Get the current generation of the prices of every product in
+    `product_pks`, starting a new generation where none is known.
+
+    :returns: a dictionary mapping product pks to their generation
+    """
+    global_key = _get_generation_key(model_class)
+    keys = dict((pk, _get_generation_key(model_class, pk)) \
+                for pk in product_pks)
+
+    generations = cache.get_many([global_key] + keys.values())
+
+    new = {}
+    for key in [global_key] + keys.values():
+        if key not in generations:
+            new[key] = generations[key] = uuid.uuid4().hex
+
+    if new:
+        cache.set_many(new, PRICE_CACHE_TIMEOUT)
+
+    return dict((pk, '%s.%s' % (generations[global_key], generations[key])) \
+                for (pk, key) in keys.iteritems())
+
+
+def get_price_key(model_class, generation, product_pk, quantity):
+    """ Cache key for the cheapest price of a product and quantity. """
+    return 'shopkit.price.%s.%d.%d.%s' % \
+        (_get_model_label(model_class), product_pk, quantity, generation)
+
+
+def invalidate_prices(sender, products=None, **kwargs):
+    """
+    Start a new generation for cached prices of the given products, or of
+    all products when `products` is `None`.
+    """
+    if products is None:
+        keys = [_get_generation_key(sender)]
+    else:
+        keys = [_get_generation_key(sender, pk) for pk in products]
+
+    logger.debug(u'Invalidating %d price generations for %s',
+                 len(keys), sender)
+
+    _replace_generations(keys)
+
+    # The changes are not visible to others until they are committed
+    if transaction.is_managed(using=router.db_for_write(sender)):
+        if not hasattr(_local, 'pending'):
+            _local.pending = set()
+
+        _local.pending.update(keys)
+
+prices_changed.connect(invalidate_prices)
+
+
+def invalidate_pending(**kwargs):
+    """
+    Start yet another generation for cached prices which were invalidated
+    within a transaction in the current thread, as these might have been
+    cached again before the transaction was committed.
+    """
+    keys = getattr(_local, 'pending', None)
+
+    if keys:
+        logger.debug(u'Invalidating %d pending price generations', len(keys))
+
+        _local.pending = set()
+
+        _replace_generations(keys)
+
+request_finished.connect(invalidate_pending)
+
+
+def _replace_generations(keys):
+    """ Replace the generations stored under `keys` with new ones. """
+    cache.set_many(dict((key, uuid.uuid4().hex) for key in keys),
+                   PRICE_CACHE_TIMEOUT)
@@ -0,0 +1,273 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Streaming import of price lists.
+
+Price lists are read row by row from CSV or JSON Lines files, validated
+against the fields of the price model and stored in batches: existing
+prices are updated using a single `UPDATE` query for every distinct price in
+a batch and new prices are created in bulk. As only a single batch is kept
+in memory, files of any size can be imported.
+
+Rows should contain a `product` and a `price` and, depending on the mixins
+used by the price model, a `quantity` and a `start_date` and `end_date`.
+Prices are identified by their product and, where applicable, their
+quantity and dates: rows for an existing price update it.
+
+Usage::
+
+    importer = PriceImporter(batch_size=1000)
+
+    with open('prices.csv') as stream:
+        importer.run(iter_csv(stream))
+
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import csv
+import json
+
+from django.core.exceptions import ValidationError
+from shopkit.core.utils import get_model_from_string, \
+                               transaction_or_savepoint, bulk_create
+from shopkit.core.settings import PRODUCT_MODEL
+
+from shopkit.price.advanced.settings import PRICE_MODEL
+from shopkit.price.advanced.signals import prices_changed
+from shopkit.price.advanced.models import DateRangedPriceMixin, \
+                                          QuantifiedPriceMixin, \
+                                          suppress_prices_changed
+
+
+def _decode(value, encoding):
+    """ Decode a (list of) byte string(s) read by the `csv` module. """
+    if isinstance(value, list):
+        return [_decode(item, encoding) for item in value]
+
+    if isinstance(value, str):
+        return value.decode(encoding)
+
+    return value
+
+
+def iter_csv(stream, encoding='utf-8'):
+    """
+    Read price rows from a CSV file with a header row, decoding the
+    columns and values from `encoding`.
+    """
+    for row in csv.DictReader(stream):
+        yield dict((_decode(name, encoding), _decode(value, encoding))
+                   for (name, value) in row.iteritems())
+
+
+def iter_jsonl(stream):
+    """ Read price rows from a JSON Lines file, one object per line. """
+    for line in stream:
+        line = line.strip()
+
+        if line:
+            yield json.loads(line)
+
+
+class PriceImporter(object):
+    """
+    Importer for price rows into `SHOPKIT_PRICE_MODEL`.
+
+    :param batch_size: amount of rows stored at a time
+    :param product_field: unique field used to look up products from the
+                          `product` column, defaults to the primary key
+    :param rejects: optional callable, called with the line number, row and
+                    error message for every rejected row
+    """
+
+    def __init__(self, batch_size=1000, product_field='pk', rejects=None):
+        self.price_class = get_model_from_string(PRICE_MODEL)
+        self.product_class = get_model_from_string(PRODUCT_MODEL)
+
+        self.batch_size = batch_size
+        self.product_field = product_field
+        self.rejects = rejects
+
+        self.key_fields = []
+        if issubclass(self.price_class, QuantifiedPriceMixin):
+            self.key_fields.append('quantity')
+        if issubclass(self.price_class, DateRangedPriceMixin):
+            self.key_fields.extend(['start_date', 'end_date'])
+
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.superseded = 0
+        self.rejected = 0
+
+    def clean(self, row):
+        """
+        Validate and convert the values in `row` to Python, returning a
+        dictionary of field values without the product.
+
+        :raises: `ValidationError`
+        """
+        values = {}
+
+        for name in ['price'] + self.key_fields:
+            field = self.price_class._meta.get_field(name)
+            value = row.get(name)
+
+            if value in (None, ''):
+                raise ValidationError('Missing value for %s.' % name)
+
+            values[name] = field.to_python(value)
+
+        if 'quantity' in values and values['quantity'] < 0:
+            raise ValidationError('Quantity should not be negative.')
+
+        if 'start_date' in values and \
+                values['end_date'] < values['start_date']:
+            raise ValidationError('End date before start date.')
+
+        return values
+
+    def reject(self, line, row, message):
+        """ Register a rejected row. """
+        self.rejected += 1
+
+        logger.debug(u'Rejecting line %d: %s', line, message)
+
+        if self.rejects:
+            self.rejects(line, row, message)
+
+    def get_key(self, product_pk, values):
+        """ Key identifying the price for a product and values. """
+        return (product_pk, ) + \
+            tuple(values[name] for name in self.key_fields)
+
+    def store_batch(self, batch):
+        """
+        Store a batch of `(line, row, product, values)` tuples, where
+        `product` is the value of the product column. Rows for unknown
+        products are rejected and rows followed by a later row for the same
+        price in the batch are counted as superseded. When several existing
+        prices match a row, all of them are updated.
+
+        The batch is stored atomically: in a transaction of its own, or in
+        a savepoint when a transaction is being managed.
+        """
+        with transaction_or_savepoint():
+            products = self.product_class.objects.filter(**{
+                    '%s__in' % self.product_field: set(b[2] for b in batch)
+                }).values_list(self.product_field, 'pk')
+
+            # Values from files are text, so match products as such
+            products = dict((unicode(value), pk) for (value, pk) in products)
+
+            prices = {}
+            for (line, row, product, values) in batch:
+                product_pk = products.get(unicode(product))
+
+                if product_pk is None:
+                    self.reject(line, row, u'Unknown product %s.' % product)
+                    continue
+
+                key = self.get_key(product_pk, values)
+
+                # Later rows for the same price take precedence
+                if key in prices:
+                    self.superseded += 1
+
+                prices[key] = values
+
+            product_pks = set(key[0] for key in prices.iterkeys())
+
+            existing = {}
+            current = self.price_class.objects.filter(product__in=product_pks)
+            for values in current.values('pk', 'product', 'price',
+                                         *self.key_fields):
+                key = self.get_key(values['product'], values)
+                existing.setdefault(key, []).append(
+                    (values['pk'], values['price']))
+
+            new_prices = []
+            pks_by_price = {}
+            for (key, values) in prices.iteritems():
+                if key in existing:
+                    pks = [pk for (pk, price) in existing[key]
+                           if price != values['price']]
+
+                    if pks:
+                        pks_by_price.setdefault(values['price'], [])
+                        pks_by_price[values['price']].extend(pks)
+                        self.updated += 1
+                    else:
+                        self.unchanged += 1
+                else:
+                    new_prices.append(self.price_class(product_id=key[0],
+                                                       **values))
+
+            for (price, pks) in pks_by_price.iteritems():
+                self.price_class.objects.filter(pk__in=pks).update(price=price)
+
+            # prices_changed is sent once for the whole batch below
+            with suppress_prices_changed():
+                bulk_create(self.price_class, new_prices)
+
+            self.created += len(new_prices)
+
+        # Bulk operations bypass, or suppress, the signals sent when
+        # saving prices
+        if pks_by_price or new_prices:
+            prices_changed.send(sender=self.price_class,
+                                products=list(product_pks))
+
+    def run(self, rows):
+        """
+        Import an iterable of rows, which are dictionaries with the values
+        of the columns, as yielded by :func:`iter_csv` and
+        :func:`iter_jsonl`.
+
+        :returns: the amount of rows processed
+        """
+        batch = []
+        line = 0
+
+        for row in rows:
+            line += 1
+
+            try:
+                values = self.clean(row)
+            except ValidationError as e:
+                self.reject(line, row, u' '.join(e.messages))
+                continue
+
+            product = row.get('product')
+            if product in (None, ''):
+                self.reject(line, row, 'Missing value for product.')
+                continue
+
+            batch.append((line, row, product, values))
+
+            if len(batch) >= self.batch_size:
+                self.store_batch(batch)
+                batch = []
+
+        if batch:
+            self.store_batch(batch)
+
+        return line
@@ -0,0 +1,122 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import csv
+import json
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shopkit.price.advanced.importer import PriceImporter, iter_csv, \
+                                            iter_jsonl
+
+
+class Command(BaseCommand):
+    """
+    Import a price list from a CSV or JSON Lines file, see
+    :mod:`shopkit.price.advanced.importer`.
+    """
+
+    args = '<file>'
+    help = 'Import prices from a CSV or JSON Lines file.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='store', type='choice',
+                    choices=('csv', 'jsonl'), dest='format', default=None,
+                    help='Input format: csv or jsonl, defaults to the '
+                         'extension of the file.'),
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=1000,
+                    help='Amount of rows to store at a time.'),
+        make_option('--encoding', action='store',
+                    dest='encoding', default='utf-8',
+                    help='Encoding of CSV files, defaults to utf-8.'),
+        make_option('--product-field', action='store',
+                    dest='product_field', default='pk',
+                    help='Unique product field matching the product column, '
+                         'defaults to the primary key.'),
+        make_option('--rejects', action='store',
+                    dest='rejects', default=None,
+                    help='CSV file to write rejected rows to.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Please specify a single file to import.')
+
+        filename = args[0]
+
+        input_format = options['format']
+        if not input_format:
+            if filename.endswith('.csv'):
+                input_format = 'csv'
+            elif filename.endswith('.jsonl') or filename.endswith('.json'):
+                input_format = 'jsonl'
+            else:
+                raise CommandError('Unknown file type, please specify '
+                                   '--format.')
+
+        verbosity = int(options['verbosity'])
+
+        rejects_file = None
+        rejects = None
+        if options['rejects']:
+            rejects_file = open(options['rejects'], 'w')
+            rejects_writer = csv.writer(rejects_file)
+            rejects_writer.writerow(['line', 'error', 'row'])
+
+            def rejects(line, row, message):
+                # The csv module only writes byte strings
+                row = json.dumps(row, ensure_ascii=False)
+
+                rejects_writer.writerow([line,
+                                         unicode(message).encode('utf-8'),
+                                         row.encode('utf-8')])
+
+        importer = PriceImporter(batch_size=options['batch_size'],
+                                 product_field=options['product_field'],
+                                 rejects=rejects)
+
+        if input_format == 'csv':
+            reader = lambda stream: iter_csv(stream, options['encoding'])
+        else:
+            reader = iter_jsonl
+
+        started = time.time()
+
+        stream = open(filename)
+        try:
+            rows = importer.run(reader(stream))
+        finally:
+            stream.close()
+
+            if rejects_file:
+                rejects_file.close()
+
+        if verbosity > 0:
+            elapsed = time.time() - started
+
+            self.stdout.write('Processed %d rows in %.1fs (%.1f rows/s): '
+                              '%d created, %d updated, %d unchanged, '
+                              '%d superseded, %d rejected.\n' % \
+                              (rows, elapsed, rows / max(elapsed, 0.001),
+                               importer.created, importer.updated,
+                               importer.unchanged, importer.superseded,
+                               importer.rejected))
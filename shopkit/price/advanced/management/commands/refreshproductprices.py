@@ -0,0 +1,66 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import time
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from shopkit.core.utils import get_model_from_string
+from shopkit.price.advanced.settings import EFFECTIVE_PRICE_MODEL
+
+
+class Command(NoArgsCommand):
+    """
+    Recalculate the effective prices of products, see
+    :class:`EffectivePriceBase <shopkit.price.advanced.models.EffectivePriceBase>`.
+    """
+
+    help = 'Recalculate the effective prices of products.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--stale', action='store_true',
+                    dest='stale', default=False,
+                    help='Only refresh products for which prices might have '
+                         'changed since the last refresh.'),
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=500,
+                    help='Amount of products to process at a time.'),
+    )
+
+    def handle_noargs(self, **options):
+        if not EFFECTIVE_PRICE_MODEL:
+            raise CommandError('Please configure '
+                               'SHOPKIT_EFFECTIVE_PRICE_MODEL.')
+
+        effective_price_class = get_model_from_string(EFFECTIVE_PRICE_MODEL)
+
+        if options['stale']:
+            products = list(effective_price_class.get_stale_products())
+        else:
+            products = None
+
+        started = time.time()
+
+        stored = effective_price_class.refresh(products,
+                                               batch_size=options['batch_size'])
+
+        if int(options['verbosity']) > 0:
+            self.stdout.write('Stored %d effective prices in %.1fs.\n' % \
+                              (stored, time.time() - started))
@@ -16,16 +16,35 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
+import logging
+logger = logging.getLogger(__name__)
+
 import datetime
+import threading
+
+from contextlib import contextmanager
 
+from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import class_prepared, post_save, post_delete
 
 from django.utils.translation import ugettext_lazy as _
 
-from shopkit.core.utils import get_model_from_string
+from shopkit.core.utils import get_model_from_string, \
+                               transaction_or_savepoint, bulk_create
 from shopkit.core.settings import PRODUCT_MODEL
 from shopkit.core.basemodels import QuantizedItemBase
 from shopkit.price.models import PricedItemBase
+from shopkit.price.advanced.settings import PRICE_MODEL, PRICE_CACHE_TIMEOUT, \
+                                           EFFECTIVE_PRICE_MODEL, \
+                                           PRICE_TIER_CACHE_SIZE
+from shopkit.price.advanced.signals import prices_changed
+from shopkit.price.advanced.cache import get_generations, get_price_key
+from shopkit.price.advanced.tiers import PriceTierCache, PriceTiers
+
+# Get the currently configured currency field, whatever it is
+from shopkit.currency.utils import get_currency_field
+PriceField = get_currency_field()
 
 
 class PriceBase(PricedItemBase):
@@ -43,13 +62,17 @@ class PriceBase(PricedItemBase):
     def _get_minimal_price(qs):
         """
         Get the price object with the lowest price
-        within the given QuerySet.
+        within the given QuerySet, using a single query.
+
+        :raises: `DoesNotExist` when no prices are found
         """
 
-        assert qs.count(), \
-            'FIXME: No prices found. This will raise an exception that should be called.'
+        prices = list(qs.order_by('price')[:1])
 
-        return qs.order_by('price')[0]
+        if not prices:
+            raise qs.model.DoesNotExist('No prices found.')
+
+        return prices[0]
 
 
     @classmethod
@@ -62,6 +85,41 @@ class PriceBase(PricedItemBase):
         return cls._get_minimal_price(valid)
 
 
+    @classmethod
+    def get_cheapest_for_products(cls, products, **kwargs):
+        """
+        Get the cheapest available prices for many products at once under
+        given conditions. The prices are filtered by `get_valid_prices()`,
+        just like in `get_cheapest()`. The lowest price of every product is
+        determined by a grouped query, after which only the price objects
+        with these prices are fetched.
+
+        :returns: a dictionary mapping the primary keys of the products to
+                  their cheapest price object; products without a valid
+                  price are left out
+        """
+
+        valid = cls.get_valid_prices(products=products, **kwargs)
+
+        # Default ordering would end up in the GROUP BY clause
+        lowest = dict((row['product'], row['lowest']) for row in \
+            valid.order_by().values('product').annotate(
+                lowest=models.Min('price')))
+
+        if not lowest:
+            return {}
+
+        candidates = valid.filter(price__in=set(lowest.itervalues()))
+
+        cheapest = {}
+        for price in candidates.order_by('product', 'pk'):
+            if price.product_id not in cheapest and \
+                    price.price == lowest[price.product_id]:
+                cheapest[price.product_id] = price
+
+        return cheapest
+
+
     @classmethod
     def get_valid_prices(cls, **kwargs):
         """
@@ -101,13 +159,22 @@ class ProductPriceMixin(models.Model):
     """ Product this price relates to. """
 
     @classmethod
-    def get_valid_prices(cls, product, *args, **kwargs):
-        """ Return valid prices for a specified product """
+    def get_valid_prices(cls, product=None, products=None, *args, **kwargs):
+        """
+        Return valid prices for a specified product, or for a sequence of
+        `products`.
+        """
+
+        assert product or products is not None, \
+            'Please specify either a product or products.'
 
         valid = \
             super(ProductPriceMixin, cls).get_valid_prices(*args, **kwargs)
 
-        valid = valid.filter(product=product)
+        if products is not None:
+            valid = valid.filter(product__in=products)
+        else:
+            valid = valid.filter(product=product)
 
         return valid
 
@@ -138,11 +205,40 @@ class DateRangedPriceMixin(models.Model):
             date = datetime.datetime.today()
 
         # First get valid prices for the current situation
-        valid = valid.filter(start_date__gte=date,
-                             end_date__lte=date)
+        valid = valid.filter(start_date__lte=date,
+                             end_date__gte=date)
 
         return valid
 
+    @classmethod
+    def get_next_boundaries(cls, product_pks, date=None):
+        """
+        Get the first date after `date`, or today, on which the valid prices
+        for each of the given products might change: the start date or the
+        day after the end date of any of their prices. Requires
+        :class:`ProductPriceMixin`.
+
+        :returns: a dictionary mapping product pks to dates, leaving out
+                  products for which prices do not change after `date`
+        """
+
+        if not date:
+            date = datetime.date.today()
+
+        prices = cls.objects.filter(product__in=product_pks).values_list(
+            'product', 'start_date', 'end_date')
+
+        boundaries = {}
+        for (pk, start_date, end_date) in prices:
+            # Prices apply from the start of the start date until the end of
+            # the end date.
+            for boundary in (start_date, end_date + datetime.timedelta(days=1)):
+                if boundary > date and \
+                        (pk not in boundaries or boundary < boundaries[pk]):
+                    boundaries[pk] = boundary
+
+        return boundaries
+
 
 class QuantifiedPriceMixin(QuantizedItemBase):
     """ Base class for a price that is only valid above a certain quantity.
@@ -155,18 +251,598 @@ class QuantifiedPriceMixin(QuantizedItemBase):
     @classmethod
     def get_valid_prices(cls, quantity=1, *args, **kwargs):
         """ Get valid prices for a given quantity of items. If no
-            quantity is given, 1 is assumed.
+            quantity is given, 1 is assumed. When `quantity` is `None`,
+            prices for any quantity are returned.
         """
 
         valid = \
             super(QuantifiedPriceMixin, cls).get_valid_prices(*args, **kwargs)
 
-        # First get valid prices for the current situation
-        valid = valid.filter(quantity__gte=quantity)
+        # Prices apply from their quantity onwards
+        if quantity is not None:
+            valid = valid.filter(quantity__lte=quantity)
 
         return valid
 
 
+def is_current_lookup(kwargs):
+    """
+    Whether or not the arguments for a price lookup only concern products,
+    quantities and the current date, so the resulting prices can be taken
+    from a cache.
+    """
+
+    if set(kwargs.keys()) - set(['product', 'products', 'quantity', 'date']):
+        return False
+
+    date = kwargs.get('date')
+    if isinstance(date, datetime.datetime):
+        date = date.date()
+
+    if date and date != datetime.date.today():
+        return False
+
+    return True
+
+
+class CachedPriceMixin(object):
+    """
+    Mixin class for price models, which should use
+    :class:`ProductPriceMixin`, caching the cheapest price per product and
+    quantity using Django's cache framework. It should precede
+    :class:`PriceBase` in the base classes of the price model.
+
+    Cached prices are invalidated whenever prices for their product are
+    saved or deleted, or `prices_changed` is sent otherwise. For models
+    using :class:`DateRangedPriceMixin`, prices are cached no longer than
+    until the next start or end date of a price for the same product, after
+    which a different price might apply. Only prices for the current date
+    are cached. See :mod:`shopkit.price.advanced.cache` for prices changed
+    within transactions.
+    """
+
+    @classmethod
+    def _get_cache_timeouts(cls, product_pks):
+        """
+        Get the time in seconds until the next date on which the prices for
+        every product might change, limited to `SHOPKIT_PRICE_CACHE_TIMEOUT`.
+
+        :returns: a dictionary mapping product pks to timeouts
+        """
+
+        timeouts = dict((pk, PRICE_CACHE_TIMEOUT) for pk in product_pks)
+
+        if not issubclass(cls, DateRangedPriceMixin):
+            return timeouts
+
+        now = datetime.datetime.now()
+
+        boundaries = cls.get_next_boundaries(product_pks, now.date())
+
+        for (pk, boundary) in boundaries.iteritems():
+            delta = datetime.datetime.combine(boundary, datetime.time()) - now
+            seconds = delta.days*24*60*60 + delta.seconds + 1
+
+            if seconds < timeouts[pk]:
+                timeouts[pk] = seconds
+
+        return timeouts
+
+    @classmethod
+    def get_cheapest(cls, **kwargs):
+        """
+        Get the cheapest available price under given conditions, from the
+        cache when possible.
+        """
+
+        if not 'product' in kwargs or not is_current_lookup(kwargs):
+            return super(CachedPriceMixin, cls).get_cheapest(**kwargs)
+
+        product = kwargs.pop('product')
+        product_pk = getattr(product, 'pk', product)
+
+        prices = cls.get_cheapest_for_products([product_pk], **kwargs)
+
+        if not product_pk in prices:
+            raise cls.DoesNotExist('No prices found.')
+
+        return prices[product_pk]
+
+    @classmethod
+    def get_cheapest_for_products(cls, products, **kwargs):
+        """
+        Get the cheapest available prices for many products at once, taking
+        the prices available in the cache from there and fetching the others
+        using a single query.
+        """
+
+        if not is_current_lookup(kwargs):
+            return super(CachedPriceMixin, cls).get_cheapest_for_products(
+                products, **kwargs)
+
+        quantity = kwargs.get('quantity', 1)
+        product_pks = [getattr(product, 'pk', product) for product in products]
+
+        # Read generations before the prices, so prices changed in the
+        # meantime are stored under an outdated generation.
+        generations = get_generations(cls, product_pks)
+        keys = dict((pk, get_price_key(cls, generations[pk], pk, quantity)) \
+                    for pk in product_pks)
+
+        cached = cache.get_many(keys.values())
+
+        prices = {}
+        missing = []
+        for pk in product_pks:
+            if keys[pk] in cached:
+                prices[pk] = cached[keys[pk]]
+            else:
+                missing.append(pk)
+
+        if missing:
+            logger.debug(u'Fetching %d uncached prices', len(missing))
+
+            fetched = super(CachedPriceMixin, cls).get_cheapest_for_products(
+                missing, **kwargs)
+
+            timeouts = cls._get_cache_timeouts(fetched.keys())
+
+            for (pk, price) in fetched.iteritems():
+                cache.set(keys[pk], price, timeouts[pk])
+
+            prices.update(fetched)
+
+        return prices
+
+
+class TieredPriceMixin(object):
+    """
+    Mixin class for price models using :class:`ProductPriceMixin` and
+    :class:`QuantifiedPriceMixin`, keeping the price tiers of recently used
+    products in memory, so that prices for any quantity of these products
+    are found without querying the database. It should precede
+    :class:`PriceBase` in the base classes of the price model.
+
+    Every lookup checks the generations of the prices concerned in the
+    cache, so changes to prices are picked up by all processes. Only prices
+    for the current date are kept in memory.
+    """
+
+    _tier_caches = {}
+
+    @classmethod
+    def get_tier_cache(cls):
+        """ Return the :class:`PriceTierCache` for this price model. """
+
+        tier_cache = cls._tier_caches.get(cls)
+
+        if tier_cache is None:
+            tier_cache = PriceTierCache(cls, PRICE_TIER_CACHE_SIZE)
+            cls._tier_caches[cls] = tier_cache
+
+        return tier_cache
+
+    @classmethod
+    def get_cheapest(cls, **kwargs):
+        """
+        Get the cheapest available price under given conditions, using the
+        price tiers in memory when possible.
+        """
+
+        if not 'product' in kwargs or not is_current_lookup(kwargs):
+            return super(TieredPriceMixin, cls).get_cheapest(**kwargs)
+
+        product = kwargs.pop('product')
+        product_pk = getattr(product, 'pk', product)
+
+        prices = cls.get_cheapest_for_products([product_pk], **kwargs)
+
+        if not product_pk in prices:
+            raise cls.DoesNotExist('No prices found.')
+
+        return prices[product_pk]
+
+    @classmethod
+    def get_cheapest_for_products(cls, products, **kwargs):
+        """
+        Get the cheapest available prices for many products at once, using
+        the price tiers in memory when possible.
+        """
+
+        if not is_current_lookup(kwargs):
+            return super(TieredPriceMixin, cls).get_cheapest_for_products(
+                products, **kwargs)
+
+        quantity = kwargs.get('quantity', 1)
+        product_pks = [getattr(product, 'pk', product) for product in products]
+
+        tiers = cls.get_tier_cache().get_tiers(product_pks)
+
+        prices = {}
+        for pk in product_pks:
+            price = tiers[pk].get_price(quantity)
+
+            if price is not None:
+                prices[pk] = price
+
+        return prices
+
+
+def invalidate_price_tiers(sender, products=None, **kwargs):
+    """
+    Remove the price tiers for changed prices from the memory of the
+    current process. Other processes notice the change by the generation of
+    the prices.
+    """
+
+    tier_cache = TieredPriceMixin._tier_caches.get(sender)
+
+    if tier_cache:
+        tier_cache.invalidate(products)
+
+prices_changed.connect(invalidate_price_tiers)
+
+
+_signals = threading.local()
+
+
+@contextmanager
+def suppress_prices_changed():
+    """
+    Context manager keeping saved or deleted prices from sending
+    `prices_changed` in the current thread, for code changing many prices
+    at once which sends `prices_changed` for all of them afterwards, such
+    as :class:`PriceImporter <shopkit.price.advanced.importer.PriceImporter>`.
+    """
+    _signals.suppressed = getattr(_signals, 'suppressed', 0) + 1
+    try:
+        yield
+    finally:
+        _signals.suppressed -= 1
+
+
+def send_prices_changed(sender, instance, **kwargs):
+    """
+    Send `prices_changed` for the product of a saved or deleted price,
+    unless suppressed by :func:`suppress_prices_changed`.
+    """
+
+    if getattr(_signals, 'suppressed', 0):
+        return
+
+    product_pk = getattr(instance, 'product_id', None)
+
+    if product_pk is None:
+        products = None
+    else:
+        products = [product_pk]
+
+    prices_changed.send(sender=sender, products=products)
+
+
+def connect_price_model(sender, **kwargs):
+    """
+    Make price models send `prices_changed` whenever a price is saved or
+    deleted.
+    """
+
+    if issubclass(sender, PriceBase) and not sender._meta.abstract and \
+            not getattr(sender, '_deferred', False):
+        post_save.connect(send_prices_changed, sender=sender)
+        post_delete.connect(send_prices_changed, sender=sender)
+
+class_prepared.connect(connect_price_model)
+
+
+class CheapestPriceCartItemMixin(object):
+    """
+    Mixin class for `CartItem`'s of products priced by the cheapest valid
+    price in `SHOPKIT_PRICE_MODEL`, which should use
+    :class:`ProductPriceMixin`. When pricing a shopping cart, the prices for
+    all items are fetched at once, rather than querying every product
+    separately.
+    """
+
+    @classmethod
+    def get_piece_prices(cls, cartitems, **kwargs):
+        """
+        Gets the prices per piece for a sequence of cart items.
+
+        For price models using :class:`QuantifiedPriceMixin`, all valid
+        prices for the products are fetched using a single query and the
+        prices for the quantities of the items are resolved from these using
+        :class:`PriceTiers <shopkit.price.advanced.tiers.PriceTiers>`.
+        Price models using :class:`CachedPriceMixin` or
+        :class:`TieredPriceMixin` are looked up through
+        `get_cheapest_for_products()` once for every distinct quantity
+        instead, so their caches are used.
+        """
+
+        price_class = get_model_from_string(PRICE_MODEL)
+
+        if issubclass(price_class, QuantifiedPriceMixin) and not \
+                issubclass(price_class, (CachedPriceMixin, TieredPriceMixin)):
+            return cls._get_tiered_piece_prices(price_class, cartitems,
+                                                **kwargs)
+
+        by_quantity = {}
+        for cartitem in cartitems:
+            by_quantity.setdefault(cartitem.quantity, []).append(
+                cartitem.product_id)
+
+        cheapest = {}
+        for (quantity, product_pks) in by_quantity.iteritems():
+            prices = price_class.get_cheapest_for_products(product_pks,
+                quantity=quantity, **kwargs)
+
+            for (product_pk, price) in prices.iteritems():
+                cheapest[(product_pk, quantity)] = price
+
+        piece_prices = []
+        for cartitem in cartitems:
+            price = cheapest.get((cartitem.product_id, cartitem.quantity))
+
+            if price is None:
+                raise price_class.DoesNotExist(
+                    'No price found for %s.' % cartitem.product)
+
+            piece_prices.append(price.get_price())
+
+        return piece_prices
+
+    @classmethod
+    def _get_tiered_piece_prices(cls, price_class, cartitems, **kwargs):
+        """
+        Gets the prices per piece for a sequence of cart items from all
+        valid prices of their products, fetched using a single query.
+        """
+
+        product_pks = set(cartitem.product_id for cartitem in cartitems)
+
+        valid = price_class.get_valid_prices(products=product_pks,
+                                             quantity=None, **kwargs)
+
+        prices = dict((pk, []) for pk in product_pks)
+        for price in valid:
+            prices[price.product_id].append(price)
+
+        tiers = dict((pk, PriceTiers(product_prices)) \
+                     for (pk, product_prices) in prices.iteritems())
+
+        piece_prices = []
+        for cartitem in cartitems:
+            price = tiers[cartitem.product_id].get_price(cartitem.quantity)
+
+            if price is None:
+                raise price_class.DoesNotExist(
+                    'No price found for %s.' % cartitem.product)
+
+            piece_prices.append(price.get_price())
+
+        return piece_prices
+
+
+class EffectivePriceBase(models.Model):
+    """
+    Abstract base class for a materialized table of the prices currently
+    in effect for every product: the cheapest valid price for a quantity of
+    1 and, for price models using :class:`QuantifiedPriceMixin`, for the
+    minimal quantity of every price tier. This allows products to be
+    filtered and ordered by price in SQL, see :meth:`filter_products`.
+
+    Effective prices are refreshed for the products concerned whenever
+    `prices_changed` is sent, or marked stale when it is sent without
+    products, and fully by the `refreshproductprices` management command.
+    As prices valid within a date range change over time, the date from
+    which effective prices might be outdated is kept in `valid_until`.
+    Running `refreshproductprices --stale` daily keeps them up to date.
+    """
+
+    class Meta:
+        verbose_name = _('effective price')
+        verbose_name_plural = _('effective prices')
+        abstract = True
+        unique_together = ('product', 'quantity')
+
+    product = models.ForeignKey(PRODUCT_MODEL, verbose_name=_('product'))
+
+    quantity = models.PositiveIntegerField(_('quantity'), default=1)
+    """ Minimal quantity for which this price applies. """
+
+    price = PriceField(verbose_name=_('price'), db_index=True,
+                       null=True, blank=True)
+    """
+    Cheapest price per piece for `quantity` items or more. This is `None`
+    for products without a current price but with prices starting later
+    on, so their `valid_until` is kept as well.
+    """
+
+    valid_until = models.DateField(_('valid until'), null=True, blank=True,
+                                   db_index=True)
+    """ Date on which the price might change, if any. """
+
+    @classmethod
+    def refresh_batch(cls, product_pks):
+        """
+        Recalculate the effective prices for the products with the given
+        primary keys, replacing their rows atomically: in a transaction of
+        its own, or in a savepoint when a transaction is being managed.
+
+        :returns: the amount of effective prices stored
+        """
+
+        price_class = get_model_from_string(PRICE_MODEL)
+
+        tiers = dict((pk, set([1])) for pk in product_pks)
+
+        if issubclass(price_class, QuantifiedPriceMixin):
+            quantities = price_class.objects.filter(product__in=product_pks)
+            for (pk, quantity) in quantities.values_list('product',
+                                                         'quantity'):
+                tiers[pk].add(max(quantity, 1))
+
+        if issubclass(price_class, DateRangedPriceMixin):
+            boundaries = price_class.get_next_boundaries(product_pks)
+        else:
+            boundaries = {}
+
+        effective_prices = []
+        for quantity in sorted(set().union(*tiers.values())):
+            tier_pks = [pk for pk in product_pks if quantity in tiers[pk]]
+
+            prices = price_class.get_cheapest_for_products(tier_pks,
+                                                           quantity=quantity)
+
+            for (pk, price) in prices.iteritems():
+                effective_prices.append(cls(product_id=pk,
+                                            quantity=quantity,
+                                            price=price.get_price(),
+                                            valid_until=boundaries.get(pk)))
+
+        # Keep track of when products without a current price get one
+        priced = set(effective_price.product_id \
+                     for effective_price in effective_prices)
+
+        for (pk, boundary) in boundaries.iteritems():
+            if pk not in priced:
+                effective_prices.append(cls(product_id=pk, quantity=1,
+                                            price=None, valid_until=boundary))
+
+        with transaction_or_savepoint():
+            cls.objects.filter(product__in=product_pks).delete()
+
+            bulk_create(cls, effective_prices)
+
+        return len(effective_prices)
+
+    @classmethod
+    def refresh(cls, products=None, batch_size=500):
+        """
+        Recalculate the effective prices for the given products (or their
+        primary keys), or for all products when not given, `batch_size`
+        products at a time.
+
+        :returns: the amount of effective prices stored
+        """
+
+        if products is None:
+            product_class = get_model_from_string(PRODUCT_MODEL)
+            products = product_class.objects.order_by('pk').values_list(
+                'pk', flat=True).iterator()
+
+        stored = 0
+        batch = []
+        for product in products:
+            batch.append(getattr(product, 'pk', product))
+
+            if len(batch) >= batch_size:
+                stored += cls.refresh_batch(batch)
+                batch = []
+
+        if batch:
+            stored += cls.refresh_batch(batch)
+
+        logger.debug(u'Stored %d effective prices', stored)
+
+        return stored
+
+    @classmethod
+    def mark_stale(cls, products=None, date=None):
+        """
+        Mark the effective prices of the given products (or their primary
+        keys), or of all products when not given, as possibly outdated from
+        `date` (or today) on, so `refreshproductprices --stale` refreshes
+        them.
+
+        :returns: the amount of effective prices marked
+        """
+
+        if not date:
+            date = datetime.date.today()
+
+        effective_prices = cls.objects.exclude(valid_until__lte=date)
+
+        if products is not None:
+            product_pks = [getattr(product, 'pk', product)
+                           for product in products]
+            effective_prices = effective_prices.filter(
+                product__in=product_pks)
+
+        return effective_prices.update(valid_until=date)
+
+    @classmethod
+    def get_stale_products(cls, date=None):
+        """
+        Return the primary keys of products with effective prices which
+        might have changed by `date`, or today.
+        """
+
+        if not date:
+            date = datetime.date.today()
+
+        return cls.objects.filter(valid_until__lte=date).values_list(
+            'product', flat=True).distinct()
+
+    @classmethod
+    def filter_products(cls, queryset, quantity=1, min_price=None,
+                        max_price=None):
+        """
+        Filter a `QuerySet` of products by their effective price for
+        `quantity` items, leaving out products without a price, and order
+        them by this price. For example::
+
+            products = EffectivePrice.filter_products(
+                category.product_set.all(), max_price=Decimal('10.00'))
+
+        """
+
+        prefix = cls._meta.object_name.lower()
+
+        filters = {'%s__quantity' % prefix: quantity,
+                   '%s__price__isnull' % prefix: False}
+
+        if min_price is not None:
+            filters['%s__price__gte' % prefix] = min_price
+
+        if max_price is not None:
+            filters['%s__price__lte' % prefix] = max_price
+
+        return queryset.filter(**filters).order_by('%s__price' % prefix)
+
+    def __unicode__(self):
+        return _(u'%(product)s from %(quantity)d: %(price)s') % \
+            {'product': self.product,
+             'quantity': self.quantity,
+             'price': self.price
+            }
+
+
+def refresh_effective_prices(sender, products=None, **kwargs):
+    """
+    Refresh the effective prices in `SHOPKIT_EFFECTIVE_PRICE_MODEL`, if
+    configured, for products of which the prices have changed. This is
+    connected after the price cache has been connected to `prices_changed`,
+    so cached prices are invalidated before effective prices are refreshed.
+
+    When prices of any product might have changed, all effective prices are
+    only marked stale rather than rebuilding them inline; running
+    `refreshproductprices --stale` then catches up.
+    """
+
+    if not EFFECTIVE_PRICE_MODEL:
+        return
+
+    effective_price_class = get_model_from_string(EFFECTIVE_PRICE_MODEL)
+
+    if products is None:
+        marked = effective_price_class.mark_stale()
+        logger.debug(u'Marked %d effective prices stale', marked)
+    else:
+        effective_price_class.refresh(products)
+
+prices_changed.connect(refresh_effective_prices)
+
+
 # class PricedItemBase(models.Model):
 #     """ Abstract base class for an advanced priced product.
 #         This base class allows for more complex pricing of articles, it
@@ -19,3 +19,28 @@
 from django.conf import settings
 
 PRICE_MODEL = getattr(settings, 'SHOPKIT_PRICE_MODEL')
+""" The model used for prices. """
+
+PRICE_CACHE_TIMEOUT = getattr(settings, 'SHOPKIT_PRICE_CACHE_TIMEOUT', 60*60*24)
+"""
+(Optional) Maximum time in seconds for which prices are cached by
+:class:`CachedPriceMixin <shopkit.price.advanced.models.CachedPriceMixin>`.
+Prices valid within a date range are never cached beyond the next start or
+end date of a price for the same product. This defaults to one day.
+"""
+
+EFFECTIVE_PRICE_MODEL = getattr(settings, 'SHOPKIT_EFFECTIVE_PRICE_MODEL', None)
+"""
+(Optional) Model, based on
+:class:`EffectivePriceBase <shopkit.price.advanced.models.EffectivePriceBase>`,
+storing the current cheapest price of every product, so that products can
+be filtered and ordered by price in SQL.
+"""
+
+PRICE_TIER_CACHE_SIZE = getattr(settings, 'SHOPKIT_PRICE_TIER_CACHE_SIZE', 10000)
+"""
+(Optional) Maximum amount of products for which price tiers are kept in
+memory by every process using
+:class:`TieredPriceMixin <shopkit.price.advanced.models.TieredPriceMixin>`.
+The least recently used products are evicted first. This defaults to 10000.
+"""
@@ -0,0 +1,37 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+from django.dispatch import Signal
+
+prices_changed = Signal()
+"""
+Signal sent whenever prices have been changed, for example when a price
+has been saved or deleted. Caches of prices should be invalidated upon
+receiving it.
+
+Listeners should have the following signature::
+
+    def mylistener(sender, products, **kwargs):
+        ...
+
+
+:param sender: `Price` model class
+:param products: list of primary keys of the products for which prices
+                 have changed, or `None` when prices of any product might
+                 have changed
+"""
@@ -16,9 +16,27 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
+import datetime
+
+from decimal import Decimal
+from StringIO import StringIO
+
 from django.conf import settings
+from django.core.management import call_command
+from django.db import transaction
 
 from shopkit.core.utils import get_model_from_string
+from shopkit.price.advanced.models import CachedPriceMixin, \
+                                          TieredPriceMixin, \
+                                          QuantifiedPriceMixin, \
+                                          CheapestPriceCartItemMixin, \
+                                          DateRangedPriceMixin, \
+                                          suppress_prices_changed
+from shopkit.price.advanced.signals import prices_changed
+from shopkit.price.advanced.tiers import PriceTiers
+from shopkit.price.advanced.cache import get_generations, \
+                                         invalidate_pending
+from shopkit.price.advanced.importer import PriceImporter, iter_csv
 
 
 class AdvancedPriceTestMixin(object):
@@ -36,3 +54,364 @@ class AdvancedPriceTestMixin(object):
         
         self.price_class = \
             get_model_from_string(settings.SHOPKIT_PRICE_MODEL)
+
+    def make_price(self, product, price, **kwargs):
+        """
+        Abstract function for creating an unsaved test price for `product`,
+        valid today for any quantity unless specified otherwise in
+        `kwargs`. As the actual properties of prices depend on the classes
+        implementing them, this function must be overridden in subclasses,
+        which should also provide `make_product()`.
+        """
+        raise NotImplementedError
+
+    def test_cheapest_for_products(self):
+        """
+        Get the cheapest prices for many products at once, making sure they
+        match the cheapest prices for the individual products.
+        """
+        products = []
+        for amount in ('1.00', '2.00', '3.00'):
+            p = self.make_product()
+            p.save()
+
+            self.make_price(p, Decimal(amount)).save()
+            self.make_price(p, Decimal(amount) + 1).save()
+
+            products.append(p)
+
+        unpriced = self.make_product()
+        unpriced.save()
+
+        cheapest = self.price_class.get_cheapest_for_products(
+            products + [unpriced])
+
+        self.assertEqual(set(cheapest.keys()), set(p.pk for p in products))
+
+        for (p, amount) in zip(products, ('1.00', '2.00', '3.00')):
+            self.assertEqual(cheapest[p.pk].get_price(), Decimal(amount))
+            self.assertEqual(cheapest[p.pk],
+                             self.price_class.get_cheapest(product=p))
+
+        self.assertRaises(self.price_class.DoesNotExist,
+                          self.price_class.get_cheapest, product=unpriced)
+
+    def test_cached_prices(self):
+        """
+        Get a cached price, making sure it is invalidated when prices for
+        the product change.
+        """
+        if not issubclass(self.price_class, CachedPriceMixin):
+            return
+
+        p = self.make_product()
+        p.save()
+
+        self.make_price(p, Decimal('2.00')).save()
+
+        self.assertEqual(self.price_class.get_cheapest(product=p).get_price(),
+                         Decimal('2.00'))
+
+        # The second lookup should come from the cache
+        self.assertNumQueries(0, self.price_class.get_cheapest, product=p)
+
+        price = self.make_price(p, Decimal('1.00'))
+        price.save()
+
+        self.assertEqual(self.price_class.get_cheapest(product=p).get_price(),
+                         Decimal('1.00'))
+
+        price.delete()
+
+        self.assertEqual(self.price_class.get_cheapest(product=p).get_price(),
+                         Decimal('2.00'))
+
+    def test_cached_prices_transaction(self):
+        """
+        Change a price within a transaction, making sure the generation of
+        its cached prices is replaced again afterwards, as prices might have
+        been cached before the transaction committed.
+        """
+        if not issubclass(self.price_class, CachedPriceMixin):
+            return
+
+        p = self.make_product()
+        p.save()
+
+        generation = get_generations(self.price_class, [p.pk])[p.pk]
+
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            self.make_price(p, Decimal('1.00')).save()
+            transaction.commit()
+        finally:
+            transaction.leave_transaction_management()
+
+        changed = get_generations(self.price_class, [p.pk])[p.pk]
+        self.assertNotEqual(changed, generation)
+
+        # As done when the request has finished
+        invalidate_pending()
+
+        committed = get_generations(self.price_class, [p.pk])[p.pk]
+        self.assertNotEqual(committed, changed)
+
+        # Nothing is pending anymore
+        invalidate_pending()
+
+        self.assertEqual(get_generations(self.price_class, [p.pk])[p.pk],
+                         committed)
+
+    def test_effective_prices(self):
+        """
+        Change prices, making sure the effective prices follow and products
+        can be ordered by them.
+        """
+        if not getattr(settings, 'SHOPKIT_EFFECTIVE_PRICE_MODEL', None):
+            return
+
+        effective_price_class = \
+            get_model_from_string(settings.SHOPKIT_EFFECTIVE_PRICE_MODEL)
+
+        cheap = self.make_product()
+        cheap.save()
+        self.make_price(cheap, Decimal('1.00')).save()
+
+        expensive = self.make_product()
+        expensive.save()
+        price = self.make_price(expensive, Decimal('5.00'))
+        price.save()
+
+        self.assertEqual(
+            effective_price_class.objects.get(product=expensive,
+                                              quantity=1).price,
+            Decimal('5.00'))
+
+        products = effective_price_class.filter_products(
+            cheap.__class__.objects.filter(pk__in=[cheap.pk, expensive.pk]))
+        self.assertEqual(list(products), [cheap, expensive])
+
+        products = effective_price_class.filter_products(
+            cheap.__class__.objects.all(), min_price=Decimal('2.00'))
+        self.assertEqual(list(products), [expensive])
+
+        # Changes to prices of any product only mark effective prices stale
+        self.price_class.objects.filter(pk=price.pk).update(
+            price=Decimal('0.50'))
+        prices_changed.send(sender=self.price_class, products=None)
+
+        self.assertEqual(
+            effective_price_class.objects.get(product=expensive,
+                                              quantity=1).price,
+            Decimal('5.00'))
+        self.assert_(expensive.pk in
+                     effective_price_class.get_stale_products())
+
+        call_command('refreshproductprices', stale=True, verbosity=0)
+
+        self.assertEqual(
+            effective_price_class.objects.get(product=expensive,
+                                              quantity=1).price,
+            Decimal('0.50'))
+
+        price.delete()
+
+        self.assertFalse(
+            effective_price_class.objects.filter(product=expensive).exists())
+
+    def test_effective_prices_future(self):
+        """
+        Add a price starting tomorrow, making sure the product is refreshed
+        by `refreshproductprices --stale` once the price starts.
+        """
+        if not getattr(settings, 'SHOPKIT_EFFECTIVE_PRICE_MODEL', None) or \
+                not issubclass(self.price_class, DateRangedPriceMixin):
+            return
+
+        effective_price_class = \
+            get_model_from_string(settings.SHOPKIT_EFFECTIVE_PRICE_MODEL)
+
+        today = datetime.date.today()
+        tomorrow = today + datetime.timedelta(days=1)
+
+        p = self.make_product()
+        p.save()
+
+        self.make_price(p, Decimal('3.00'), start_date=tomorrow,
+                        end_date=tomorrow + datetime.timedelta(days=10)).save()
+
+        # The product has no price yet, but will be stale tomorrow
+        products = effective_price_class.filter_products(
+            p.__class__.objects.filter(pk=p.pk))
+        self.assertFalse(products)
+
+        self.assertFalse(p.pk in effective_price_class.get_stale_products())
+        self.assert_(p.pk in effective_price_class.get_stale_products(tomorrow))
+
+    def test_price_tiers(self):
+        """ Look up prices for quantities in price tiers. """
+
+        class TierPrice(object):
+            def __init__(self, quantity, price):
+                self.quantity = quantity
+                self.price = Decimal(price)
+
+            def get_price(self):
+                return self.price
+
+        tiers = PriceTiers([TierPrice(10, '2.00'), TierPrice(1, '3.00'),
+                            TierPrice(5, '4.00'), TierPrice(20, '1.50')])
+
+        # Tiers which are not cheaper than a lower tier are left out
+        self.assertEqual(tiers.quantities, [1, 10, 20])
+
+        self.assertEqual(tiers.get_price(0), None)
+        self.assertEqual(tiers.get_price(1).get_price(), Decimal('3.00'))
+        self.assertEqual(tiers.get_price(9).get_price(), Decimal('3.00'))
+        self.assertEqual(tiers.get_price(10).get_price(), Decimal('2.00'))
+        self.assertEqual(tiers.get_price(100).get_price(), Decimal('1.50'))
+
+    def test_tiered_prices(self):
+        """
+        Get prices for different quantities of a product, making sure they
+        come from memory once the tiers have been loaded.
+        """
+        if not issubclass(self.price_class, TieredPriceMixin):
+            return
+
+        p = self.make_product()
+        p.save()
+
+        self.make_price(p, Decimal('3.00'), quantity=1).save()
+        self.make_price(p, Decimal('2.00'), quantity=10).save()
+
+        self.assertEqual(
+            self.price_class.get_cheapest(product=p, quantity=5).get_price(),
+            Decimal('3.00'))
+
+        self.assertNumQueries(0, self.price_class.get_cheapest,
+                              product=p, quantity=10)
+        self.assertEqual(
+            self.price_class.get_cheapest(product=p, quantity=10).get_price(),
+            Decimal('2.00'))
+
+        self.make_price(p, Decimal('1.00'), quantity=20).save()
+
+        self.assertEqual(
+            self.price_class.get_cheapest(product=p, quantity=25).get_price(),
+            Decimal('1.00'))
+
+    def test_piece_prices(self):
+        """
+        Price several cart items with different quantities at once, making
+        sure the prices match the cheapest prices for these quantities.
+        """
+        price_model = getattr(settings, 'SHOPKIT_PRICE_MODEL', None)
+        if not issubclass(self.price_class, QuantifiedPriceMixin) or \
+                get_model_from_string(price_model) is not self.price_class:
+            return
+
+        class CartItem(object):
+            def __init__(self, product, quantity):
+                self.product = product
+                self.product_id = product.pk
+                self.quantity = quantity
+
+        cheap = self.make_product()
+        cheap.save()
+
+        self.make_price(cheap, Decimal('3.00'), quantity=1).save()
+        self.make_price(cheap, Decimal('2.00'), quantity=10).save()
+
+        expensive = self.make_product()
+        expensive.save()
+
+        self.make_price(expensive, Decimal('5.00'), quantity=1).save()
+
+        cartitems = [CartItem(cheap, 5), CartItem(cheap, 10),
+                     CartItem(expensive, 20)]
+
+        piece_prices = CheapestPriceCartItemMixin.get_piece_prices(cartitems)
+
+        self.assertEqual(piece_prices, [Decimal('3.00'), Decimal('2.00'),
+                                        Decimal('5.00')])
+
+        for (cartitem, piece_price) in zip(cartitems, piece_prices):
+            self.assertEqual(piece_price, self.price_class.get_cheapest(
+                product=cartitem.product,
+                quantity=cartitem.quantity).get_price())
+
+    def test_import_prices(self):
+        """
+        Import price rows, making sure prices are created, updated and
+        invalid rows are rejected.
+        """
+        p = self.make_product()
+        p.save()
+
+        rejects = []
+        importer = PriceImporter(batch_size=2,
+            rejects=lambda line, row, message: rejects.append(line))
+
+        price = self.make_price(p, Decimal('2.00'))
+        row = dict((name, unicode(getattr(price, name))) \
+                   for name in ['price'] + importer.key_fields)
+        row['product'] = unicode(p.pk)
+
+        rows = [row,
+                dict(row, price='1.50'),
+                dict(row, product='-1'),
+                dict(row, price='invalid')]
+
+        self.assertEqual(importer.run(rows), 4)
+        self.assertEqual(importer.created, 1)
+        self.assertEqual(importer.superseded, 1)
+        self.assertEqual(sorted(rejects), [3, 4])
+
+        self.assertEqual(self.price_class.get_cheapest(product=p).get_price(),
+                         Decimal('1.50'))
+
+        importer.run([dict(row, price='1.75')])
+        self.assertEqual(importer.updated, 1)
+        self.assertEqual(self.price_class.objects.filter(product=p).count(), 1)
+
+        self.assertEqual(self.price_class.get_cheapest(product=p).get_price(),
+                         Decimal('1.75'))
+
+    def test_suppress_prices_changed(self):
+        """
+        Save prices while suppressing `prices_changed`, as the importer
+        does, making sure it is only sent outside of the block.
+        """
+        p = self.make_product()
+        p.save()
+
+        calls = []
+
+        def listener(sender, products, **kwargs):
+            calls.append(products)
+
+        prices_changed.connect(listener)
+
+        try:
+            price = self.make_price(p, Decimal('1.00'))
+
+            with suppress_prices_changed():
+                price.save()
+
+            self.assertEqual(calls, [])
+
+            price.save()
+
+            self.assertEqual(calls, [[p.pk]])
+
+        finally:
+            prices_changed.disconnect(listener)
+
+    def test_import_prices_unicode(self):
+        """ Read CSV rows with non-ASCII values, see if they are decoded. """
+        stream = StringIO('product,price\n\xc3\xa9t\xc3\xa9,1.00\n')
+
+        self.assertEqual(list(iter_csv(stream)),
+                         [{u'product': u'\xe9t\xe9', u'price': u'1.00'}])
@@ -0,0 +1,191 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import logging
+logger = logging.getLogger(__name__)
+
+import datetime
+import threading
+
+from bisect import bisect_right
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+from shopkit.price.advanced.cache import get_generations
+
+
+"""
+In-memory price tiers for prices depending on quantity.
+
+For every product, the quantities from which its prices apply are kept in a
+sorted list, along with the cheapest price applying from each of these
+quantities onwards. The price for any quantity is then found by bisection,
+without querying the database.
+"""
+
+
+class PriceTiers(object):
+    """
+    Compact price tiers for a single product: parallel lists of quantity
+    breaks, in ascending order, and the cheapest price object valid from
+    each break onwards.
+    """
+
+    __slots__ = ('quantities', 'prices', 'generation', 'valid_until')
+
+    def __init__(self, prices, generation=None, valid_until=None):
+        """
+        Build the tiers from the valid price objects for a product, which
+        should have `quantity` and `get_price()`.
+        """
+        self.quantities = []
+        self.prices = []
+
+        self.generation = generation
+        self.valid_until = valid_until
+
+        cheapest = None
+        for price in sorted(prices, key=lambda p: (p.quantity, p.get_price())):
+            # Only add breaks at which the price actually drops
+            if cheapest is None or price.get_price() < cheapest.get_price():
+                cheapest = price
+
+                self.quantities.append(price.quantity)
+                self.prices.append(price)
+
+    def get_price(self, quantity):
+        """
+        Return the cheapest price object for `quantity` items, or `None`
+        when no price applies.
+        """
+        index = bisect_right(self.quantities, quantity) - 1
+
+        if index < 0:
+            return None
+
+        return self.prices[index]
+
+    def is_valid(self, generation, date):
+        """ Whether or not these tiers are still current. """
+        return self.generation == generation and \
+            (self.valid_until is None or self.valid_until > date)
+
+
+class PriceTierCache(object):
+    """
+    Least recently used cache of :class:`PriceTiers` for the products of a
+    price model, which is shared by all threads of a process.
+
+    Tiers are loaded for many products at once on lookup. They are reloaded
+    when the generation of the prices of their product changed, as kept by
+    :mod:`shopkit.price.advanced.cache`, so that changes in other processes
+    are picked up as well, or when a date on which their prices change has
+    passed.
+    """
+
+    def __init__(self, price_class, max_size):
+        self.price_class = price_class
+        self.max_size = max_size
+
+        self._tiers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, product_pks, generations):
+        """ Load the tiers for the given products from the database. """
+        today = datetime.date.today()
+
+        valid = self.price_class.get_valid_prices(products=product_pks,
+                                                  quantity=None, date=today)
+
+        prices = dict((pk, []) for pk in product_pks)
+        for price in valid:
+            prices[price.product_id].append(price)
+
+        if hasattr(self.price_class, 'get_next_boundaries'):
+            boundaries = self.price_class.get_next_boundaries(product_pks,
+                                                              today)
+        else:
+            boundaries = {}
+
+        logger.debug(u'Loaded price tiers for %d products', len(product_pks))
+
+        return dict((pk, PriceTiers(prices[pk], generations[pk],
+                                    boundaries.get(pk))) \
+                    for pk in product_pks)
+
+    def get_tiers(self, product_pks):
+        """
+        Get the tiers for the given products, loading those which are not
+        cached, or no longer valid, using a single query.
+
+        :returns: a dictionary mapping product pks to :class:`PriceTiers`
+        """
+        today = datetime.date.today()
+        generations = get_generations(self.price_class, product_pks)
+
+        tiers = {}
+        missing = []
+
+        self._lock.acquire()
+        try:
+            for pk in product_pks:
+                product_tiers = self._tiers.pop(pk, None)
+
+                if product_tiers and \
+                        product_tiers.is_valid(generations[pk], today):
+                    # Move to the end as most recently used
+                    self._tiers[pk] = tiers[pk] = product_tiers
+                else:
+                    missing.append(pk)
+        finally:
+            self._lock.release()
+
+        if missing:
+            loaded = self.load(missing, generations)
+            tiers.update(loaded)
+
+            self._lock.acquire()
+            try:
+                self._tiers.update(loaded)
+
+                # Evict the least recently used tiers
+                while len(self._tiers) > self.max_size:
+                    del self._tiers[iter(self._tiers).next()]
+            finally:
+                self._lock.release()
+
+        return tiers
+
+    def invalidate(self, product_pks=None):
+        """
+        Remove the tiers for the given products, or for all products when
+        `None`, from the cache of this process.
+        """
+        self._lock.acquire()
+        try:
+            if product_pks is None:
+                self._tiers.clear()
+            else:
+                for pk in product_pks:
+                    self._tiers.pop(pk, None)
+        finally:
+            self._lock.release()
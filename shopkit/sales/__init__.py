@@ -0,0 +1,34 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Sales reporting based on rollups: the quantity sold and revenue for every
+product per day, updated as orders are confirmed. Reports read these
+rollups rather than aggregating over all order items.
+
+Usage:
+
+* Create a `SalesRollup` model based on
+  :class:`SalesRollupBase <shopkit.sales.models.SalesRollupBase>` and
+  configure it as `SHOPKIT_SALES_ROLLUP_MODEL`.
+* Add :class:`SalesRollupOrderMixin <shopkit.sales.models.SalesRollupOrderMixin>`
+  to the `Order` model.
+* Fill the rollups for existing orders with the `rebuildsalesrollups`
+  management command.
+
+"""
@@ -0,0 +1,74 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import datetime
+import time
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from shopkit.core.utils import get_model_from_string
+from shopkit.sales.settings import SALES_ROLLUP_MODEL
+
+
+class Command(NoArgsCommand):
+    """
+    Recalculate the sales rollups from the items of confirmed orders, see
+    :meth:`SalesRollupBase.rebuild <shopkit.sales.models.SalesRollupBase.rebuild>`.
+    """
+
+    help = 'Recalculate sales rollups from confirmed orders.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--start', action='store',
+                    dest='start', default=None,
+                    help='First day to rebuild, as YYYY-MM-DD.'),
+        make_option('--end', action='store',
+                    dest='end', default=None,
+                    help='Last day to rebuild, as YYYY-MM-DD.'),
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=1000,
+                    help='Amount of order items to read at a time.'),
+    )
+
+    def parse_date(self, value):
+        if not value:
+            return None
+
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            raise CommandError('Invalid date %s, please use YYYY-MM-DD.' % \
+                               value)
+
+    def handle_noargs(self, **options):
+        if not SALES_ROLLUP_MODEL:
+            raise CommandError('Please configure SHOPKIT_SALES_ROLLUP_MODEL.')
+
+        rollup_class = get_model_from_string(SALES_ROLLUP_MODEL)
+
+        started = time.time()
+
+        created = rollup_class.rebuild(start=self.parse_date(options['start']),
+                                       end=self.parse_date(options['end']),
+                                       batch_size=options['batch_size'])
+
+        if int(options['verbosity']) > 0:
+            self.stdout.write('Created %d sales rollups in %.1fs.\n' % \
+                              (created, time.time() - started))
@@ -0,0 +1,250 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import logging
+logger = logging.getLogger(__name__)
+
+import datetime
+
+from decimal import Decimal
+
+from django.db import models, connections, router
+from django.utils.translation import ugettext_lazy as _
+
+from shopkit.core.settings import PRODUCT_MODEL, ORDERITEM_MODEL, \
+                                  ARCHIVED_ORDER_MODEL
+from shopkit.core.utils import get_model_from_string, increment_or_create, \
+                               transaction_or_savepoint, bulk_create
+
+from shopkit.sales.settings import SALES_ROLLUP_MODEL
+
+# Get the currently configured currency field, whatever it is
+from shopkit.currency.utils import get_currency_field
+PriceField = get_currency_field()
+
+
+class SalesRollupBase(models.Model):
+    """
+    Abstract base class for rollups of sales: the quantity sold and the
+    revenue for a product on a given day. Sales are attributed to the day
+    on which the order was added.
+    """
+
+    class Meta:
+        verbose_name = _('sales rollup')
+        verbose_name_plural = _('sales rollups')
+        abstract = True
+        unique_together = ('date', 'product')
+
+    date = models.DateField(_('date'), db_index=True)
+    product = models.ForeignKey(PRODUCT_MODEL, verbose_name=_('product'))
+
+    quantity = models.IntegerField(_('quantity'), default=0)
+    """ Amount of items sold. """
+
+    revenue = PriceField(verbose_name=_('revenue'), default=Decimal('0.00'))
+    """ Total price of the items sold. """
+
+    @classmethod
+    def register_order(cls, order):
+        """
+        Add the items of a confirmed `order` to the rollups, using an
+        `UPDATE` query for every product in the order, or an `INSERT` when
+        the product has no rollup for the day yet.
+        """
+        date = order.date_added.date()
+
+        sales = {}
+        for item in order.get_items().select_related('product'):
+            (product, quantity, revenue) = sales.get(item.product_id,
+                (item.product, 0, Decimal('0.00')))
+
+            sales[item.product_id] = (product,
+                                      quantity + item.quantity,
+                                      revenue + item.get_total_price())
+
+        for (product, quantity, revenue) in sales.itervalues():
+            increment_or_create(cls, {'date': date, 'product': product},
+                                {'quantity': quantity, 'revenue': revenue})
+
+        logger.debug(u'Registered sales of %d products for %s',
+                     len(sales), order)
+
+    @classmethod
+    def get_first_rebuildable_date(cls):
+        """
+        Return the first date for which the rollups can be rebuilt from the
+        orders, or `None` when all of them can. As archived orders no longer
+        have their items in the database, this is the day after the latest
+        order in `SHOPKIT_ARCHIVED_ORDER_MODEL`, if configured.
+        """
+        if not ARCHIVED_ORDER_MODEL:
+            return None
+
+        archived_order_class = get_model_from_string(ARCHIVED_ORDER_MODEL)
+
+        latest = archived_order_class.objects.aggregate(
+            latest=models.Max('date_added'))['latest']
+
+        if latest is None:
+            return None
+
+        return latest.date() + datetime.timedelta(days=1)
+
+    @classmethod
+    def lock_rollups(cls):
+        """
+        Lock the rollups against concurrent changes until the end of the
+        current transaction. On PostgreSQL, the whole table is locked for
+        writing. Other databases rely on the rollups being deleted before
+        the orders are read by :meth:`rebuild`, which locks the rows or, as
+        on SQLite, the database.
+        """
+        connection = connections[router.db_for_write(cls)]
+
+        if getattr(connection, 'vendor', None) == 'postgresql':
+            cursor = connection.cursor()
+            cursor.execute('LOCK TABLE %s IN EXCLUSIVE MODE' % \
+                           connection.ops.quote_name(cls._meta.db_table))
+
+    @classmethod
+    def rebuild(cls, start=None, end=None, batch_size=1000):
+        """
+        Recalculate the rollups from the items of all confirmed orders added
+        between `start` and `end` (both dates, inclusive), or of all orders
+        when not given. Items are read `batch_size` at a time. Reading the
+        items and replacing the rollups happens atomically, in a transaction
+        of its own or in a savepoint when a transaction is being managed,
+        while the rollups are locked by :meth:`lock_rollups`, so sales
+        registered concurrently are not lost.
+
+        The rollups of days with archived orders are kept, as they cannot be
+        recalculated: `start` is moved forward to
+        :meth:`get_first_rebuildable_date` when needed.
+
+        :returns: the amount of rollups created
+        """
+        first_date = cls.get_first_rebuildable_date()
+
+        if first_date and (not start or start < first_date):
+            logger.debug(u'Only rebuilding sales rollups from %s, as older '
+                         u'orders have been archived', first_date)
+
+            start = first_date
+
+        orderitem_class = get_model_from_string(ORDERITEM_MODEL)
+
+        items = orderitem_class.objects.filter(order__confirmed=True,
+                                               quantity__gt=0)
+        rollups = cls.objects.all()
+
+        if start:
+            items = items.filter(order__date_added__gte=start)
+            rollups = rollups.filter(date__gte=start)
+
+        if end:
+            items = items.filter(order__date_added__lt=end + \
+                                 datetime.timedelta(days=1))
+            rollups = rollups.filter(date__lte=end)
+
+        with transaction_or_savepoint():
+            # Keep register_order() from changing rollups until the rebuilt
+            # ones have been committed
+            cls.lock_rollups()
+
+            rollups.delete()
+
+            sales = {}
+            last_pk = None
+            while True:
+                batch = items.order_by('pk')
+                if last_pk is not None:
+                    batch = batch.filter(pk__gt=last_pk)
+
+                rows = list(batch.values_list('pk', 'order__date_added',
+                                              'product', 'quantity',
+                                              'piece_price')[:batch_size])
+                if not rows:
+                    break
+
+                last_pk = rows[-1][0]
+
+                for (pk, date_added, product_pk, quantity, piece_price) \
+                        in rows:
+                    key = (date_added.date(), product_pk)
+                    (total_quantity, revenue) = \
+                        sales.get(key, (0, Decimal('0.00')))
+
+                    sales[key] = (total_quantity + quantity,
+                                  revenue + quantity*piece_price)
+
+            new_rollups = [cls(date=date, product_id=product_pk,
+                               quantity=quantity, revenue=revenue) \
+                           for ((date, product_pk), (quantity, revenue)) \
+                           in sales.iteritems()]
+
+            bulk_create(cls, new_rollups)
+
+        logger.debug(u'Rebuilt %d sales rollups', len(new_rollups))
+
+        return len(new_rollups)
+
+    @classmethod
+    def get_totals(cls, start, end, group_by=('product', ), **filters):
+        """
+        Return the total quantity and revenue between the dates `start` and
+        `end` (inclusive), grouped by the fields in `group_by`, as a
+        `ValuesQuerySet` of dictionaries with `quantity`, `revenue` and
+        the grouped fields. Fields of products can be used as well, for
+        example to report sales per category::
+
+            SalesRollup.get_totals(start, end,
+                                   group_by=('product__category', ))
+
+        Further `filters` are applied to the rollups.
+        """
+        rollups = cls.objects.filter(date__gte=start, date__lte=end,
+                                     **filters)
+
+        return rollups.values(*group_by).annotate(
+            quantity=models.Sum('quantity'),
+            revenue=models.Sum('revenue')).order_by(*group_by)
+
+    def __unicode__(self):
+        return _(u'%(product)s on %(date)s: %(quantity)d') % \
+            {'product': self.product,
+             'date': self.date,
+             'quantity': self.quantity
+            }
+
+
+class SalesRollupOrderMixin(object):
+    """
+    Mixin class for `Order`'s registering their sales in the rollups of
+    `SHOPKIT_SALES_ROLLUP_MODEL` upon confirmation. Within
+    `process_confirm()`, this happens in the same transaction as the
+    confirmation itself.
+    """
+
+    def confirm(self):
+        """ Register the sales of this order after confirming it. """
+
+        super(SalesRollupOrderMixin, self).confirm()
+
+        rollup_class = get_model_from_string(SALES_ROLLUP_MODEL)
+        rollup_class.register_order(self)
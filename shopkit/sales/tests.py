@@ -0,0 +1,149 @@
+# Copyright (C) 2010-2011 Mathijs de Bruin <mathijs@mathijsfietst.nl>
+#
+# This file is part of django-shopkit.
+#
+# django-shopkit is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import datetime
+
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management import call_command
+
+from shopkit.core.utils import get_model_from_string
+
+
+class SalesTestMixin(object):
+    """
+    Base class for testing sales rollups. This class should be combined
+    with :class:`CoreTestMixin <shopkit.core.tests.CoreTestMixin>`, which
+    provides the order classes and `make_product()`.
+    """
+
+    def setUp(self):
+        """
+        This makes the `SalesRollup` class from `SHOPKIT_SALES_ROLLUP_MODEL`
+        available as `self.rollup_class` for unittests to make use of.
+        """
+
+        super(SalesTestMixin, self).setUp()
+
+        self.rollup_class = \
+            get_model_from_string(settings.SHOPKIT_SALES_ROLLUP_MODEL)
+
+    def make_confirmed_order(self, quantity=2):
+        """ Create a confirmed order for `quantity` items of a product. """
+
+        cart = self.cart_class()
+        cart.save()
+
+        p = self.make_product()
+        p.save()
+
+        cart.add_item(p, quantity)
+
+        order = self.order_class.from_cart(cart)
+        order.confirmed = True
+        order.save()
+
+        return order
+
+    def test_register_order(self):
+        """
+        Register the sales of an order, making sure the rollups are added
+        up and can be totalled.
+        """
+        order = self.make_confirmed_order(quantity=2)
+        item = order.get_items().get()
+
+        self.rollup_class.objects.all().delete()
+
+        self.rollup_class.register_order(order)
+        self.rollup_class.register_order(order)
+
+        rollup = self.rollup_class.objects.get()
+        self.assertEqual(rollup.product_id, item.product_id)
+        self.assertEqual(rollup.date, order.date_added.date())
+        self.assertEqual(rollup.quantity, 4)
+        self.assertEqual(rollup.revenue, 2*item.get_total_price())
+
+        date = order.date_added.date()
+        totals = list(self.rollup_class.get_totals(date, date))
+        self.assertEqual(len(totals), 1)
+        self.assertEqual(totals[0]['product'], item.product_id)
+        self.assertEqual(totals[0]['quantity'], 4)
+
+    def test_rebuild(self):
+        """
+        Rebuild the rollups, making sure they match the confirmed orders
+        again and the `rebuildsalesrollups` command does the same.
+        """
+        order = self.make_confirmed_order(quantity=3)
+        item = order.get_items().get()
+
+        self.rollup_class.objects.all().delete()
+        self.rollup_class.register_order(order)
+        self.rollup_class.objects.update(quantity=0)
+
+        self.assertEqual(self.rollup_class.rebuild(batch_size=1), 1)
+
+        rollup = self.rollup_class.objects.get()
+        self.assertEqual(rollup.quantity, 3)
+        self.assertEqual(rollup.revenue, item.get_total_price())
+
+        self.rollup_class.objects.update(quantity=0)
+
+        call_command('rebuildsalesrollups', verbosity=0)
+
+        self.assertEqual(self.rollup_class.objects.get().quantity, 3)
+
+    def test_rebuild_archived(self):
+        """
+        Rebuild the rollups after orders have been archived, making sure
+        the rollups of archived days are kept.
+        """
+        if not getattr(settings, 'SHOPKIT_ARCHIVED_ORDER_MODEL', None):
+            return
+
+        archived_order_class = \
+            get_model_from_string(settings.SHOPKIT_ARCHIVED_ORDER_MODEL)
+
+        order = self.make_confirmed_order()
+        product_pk = order.get_items().get().product_id
+
+        archived_date = order.date_added - datetime.timedelta(days=10)
+
+        archived_order_class(order_pk=order.pk + 1000,
+                             state=order.state,
+                             date_added=archived_date,
+                             archive='test.jsonl', line=0).save()
+
+        archived_rollup = self.rollup_class(date=archived_date.date(),
+                                            product_id=product_pk,
+                                            quantity=5,
+                                            revenue=Decimal('10.00'))
+        archived_rollup.save()
+
+        self.assertEqual(self.rollup_class.get_first_rebuildable_date(),
+                         archived_date.date() + datetime.timedelta(days=1))
+
+        self.rollup_class.rebuild()
+
+        archived_rollup = self.rollup_class.objects.get(pk=archived_rollup.pk)
+        self.assertEqual(archived_rollup.quantity, 5)
+
+        rollup = self.rollup_class.objects.get(date=order.date_added.date())
+        self.assertEqual(rollup.quantity, 2)
@@ -60,8 +60,11 @@ class StockedOrderItemMixin(StockedItemBase, StockedOrderItemBase):
                      stocked_item,
                      self.quantity)
 
-        stocked_item.stock -= self.quantity
-        stocked_item.save()
+        if hasattr(stocked_item, 'lower_stock'):
+            stocked_item.lower_stock(self.quantity, order=self)
+        else:
+            stocked_item.stock -= self.quantity
+            stocked_item.save()
 
 
 class StockedOrderMixin(StockedOrderBase):
@@ -97,3 +100,24 @@ class StockedItemMixin(models.Model, StockedItemBase):
 
         return False
 
+    def lower_stock(self, quantity, order=None):
+        """
+        Lower the stock of this item by `quantity`. When `order` (or an
+        order item) is given, this is registered through its
+        `register_increment()`, so stock changes are applied in bulk at the
+        end of the order's confirmation. Otherwise it is applied right away.
+
+        The stock is lowered with an `UPDATE` query rather than by calling
+        `save()`, so overrides of `save()` and the `pre_save` and
+        `post_save` signals are not triggered; override this method in
+        order to hook into stock changes.
+        """
+        self.stock -= quantity
+
+        if order is not None:
+            order.register_increment(self.__class__, self.pk,
+                                     'stock', -quantity)
+        else:
+            self.__class__.objects.filter(pk=self.pk).update(
+                stock=models.F('stock') - quantity)
+
@@ -16,6 +16,8 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
+from django.db import models
+
 from shopkit.stock.exceptions import NoStockAvailableException
 
 
@@ -65,9 +67,12 @@ class StockedCartBase(object):
 
         # Check whether enough stock is available
         if not cartitem.is_available(cartitem.quantity):
-            # Substract the quantity again. Inefficient but necessary for now
+            # Substract the quantity again, atomically like it was added
+            cartitem.__class__.objects.filter(pk=cartitem.pk).update(
+                quantity=models.F('quantity') - quantity)
+
             cartitem.quantity -= quantity
-            cartitem.save()
+            cartitem.quantity_added(-quantity)
 
             # Raise error
             raise NoStockAvailableException(item=cartitem)